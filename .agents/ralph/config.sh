@@ -52,6 +52,18 @@ ROLLBACK_ENABLED=true
 # Error context is preserved in .ralph/PRD-N/runs/failure-context-*.log
 # ─────────────────────────────────────────────────────────────────────────────
 
+# ─────────────────────────────────────────────────────────────────────────────
+# Story Claims
+# ─────────────────────────────────────────────────────────────────────────────
+# Parallel builds on one PRD can claim stories with a lease instead of taking
+# the shared story-selection lock. Each loop holds one claim at a time and
+# releases it when the iteration ends; a crashed loop's claim expires after
+# RALPH_TIMEOUT_ITERATION seconds.
+#
+# Enable leased story claims (default: false):
+# STORY_CLAIMS=true
+# ─────────────────────────────────────────────────────────────────────────────
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Intelligent Retry Configuration (US-002)
 # ─────────────────────────────────────────────────────────────────────────────
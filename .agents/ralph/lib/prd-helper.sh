@@ -0,0 +1,134 @@
+#!/usr/bin/env bash
+# ─────────────────────────────────────────────────────────────────────────────
+# PRD Helper Client Library
+# ─────────────────────────────────────────────────────────────────────────────
+# Keeps one `prd-parser.py serve` process alive as a bash coproc so a build
+# pays Python interpreter startup once instead of once per helper call.
+# Responses come back as "<ok|error> <byte length>" frames that are decoded
+# with bash builtins alone. Falls back to spawning prd-parser.py directly
+# when the helper is not running or its fds are not reachable, as in a
+# ( ... ) subshell or a pipeline stage.
+#
+# Usage:
+#   source "$(dirname "${BASH_SOURCE[0]}")/prd-helper.sh"
+#   prd_helper_start
+#   prd_helper_call story_field "$meta_file" id
+#   prd_helper_stop
+#
+# Functions:
+#   prd_helper_start                     - Start the helper coproc
+#   prd_helper_call <command> [args...]  - Run a prd-parser command
+#   prd_helper_stop                      - Shut the helper down
+#   prd_helper_json_escape <string>      - Escape a string for a JSON literal
+# ─────────────────────────────────────────────────────────────────────────────
+
+PRD_PARSER_PY="${PRD_PARSER_PY:-$(dirname "${BASH_SOURCE[0]}")/prd-parser.py}"
+PRD_HELPER_PID=""
+PRD_HELPER_SEQ=0
+
+# Escape a string for use as a JSON string literal (without quotes)
+prd_helper_json_escape() {
+  local s="$1" i hex c
+  s="${s//\\/\\\\}"
+  s="${s//\"/\\\"}"
+  s="${s//$'\n'/\\n}"
+  s="${s//$'\r'/\\r}"
+  s="${s//$'\t'/\\t}"
+  # Remaining control characters (below 0x20) as \u00XX
+  if [[ "$s" == *[[:cntrl:]]* ]]; then
+    for ((i = 1; i < 32; i++)); do
+      printf -v hex '%02x' "$i"
+      printf -v c "\\x$hex"
+      s="${s//"$c"/\\u00$hex}"
+    done
+  fi
+  printf '%s' "$s"
+}
+
+# ─────────────────────────────────────────────────────────────────────────────
+# prd_helper_start
+# ─────────────────────────────────────────────────────────────────────────────
+# Start prd-parser.py in serve mode as a coproc. Safe to call repeatedly.
+#
+# Returns:
+#   0 if the helper is running, 1 if it could not be started
+# ─────────────────────────────────────────────────────────────────────────────
+prd_helper_start() {
+  if [[ -n "$PRD_HELPER_PID" ]] && kill -0 "$PRD_HELPER_PID" 2>/dev/null; then
+    return 0
+  fi
+  command -v python3 >/dev/null 2>&1 || return 1
+
+  # coproc sets PRD_HELPER_PID and the PRD_HELPER fd array
+  # stderr is shared, so command warnings show up as they do from the CLI
+  coproc PRD_HELPER { python3 "$PRD_PARSER_PY" serve --frames; }
+  [[ -n "$PRD_HELPER_PID" ]]
+}
+
+# ─────────────────────────────────────────────────────────────────────────────
+# prd_helper_call
+# ─────────────────────────────────────────────────────────────────────────────
+# Run a prd-parser.py command, through the helper when it is running.
+# Whatever the command prints is written to stdout, like the CLI.
+#
+# Arguments:
+#   $1    - Command name (e.g. select_story, story_field)
+#   $2... - Command arguments
+#
+# Returns:
+#   0 on success, 1 on failure
+# ─────────────────────────────────────────────────────────────────────────────
+prd_helper_call() {
+  local method="$1"
+  shift
+
+  # Coproc fds are closed in ( ... ) subshells and pipeline stages, so check
+  # they are still open rather than failing with "Bad file descriptor"
+  if [[ -z "$PRD_HELPER_PID" ]] || ! kill -0 "$PRD_HELPER_PID" 2>/dev/null \
+    || [[ -z "${PRD_HELPER[0]:-}" || -z "${PRD_HELPER[1]:-}" ]] \
+    || [[ ! -e "/dev/fd/${PRD_HELPER[0]}" || ! -e "/dev/fd/${PRD_HELPER[1]}" ]]; then
+    python3 "$PRD_PARSER_PY" "$method" "$@"
+    return $?
+  fi
+
+  local params="" arg
+  for arg in "$@"; do
+    params+="${params:+,}\"$(prd_helper_json_escape "$arg")\""
+  done
+
+  PRD_HELPER_SEQ=$((PRD_HELPER_SEQ + 1))
+  printf '{"id":%d,"method":"%s","params":[%s]}\n' \
+    "$PRD_HELPER_SEQ" "$method" "$params" >&"${PRD_HELPER[1]}"
+
+  # Frame: "<ok|error> <byte length>\n" then exactly that many bytes
+  local header status len body=""
+  if ! IFS= read -r header <&"${PRD_HELPER[0]}"; then
+    return 1
+  fi
+  status="${header%% *}"
+  len="${header#* }"
+  [[ "$len" =~ ^[0-9]+$ ]] || return 1
+  if ((len > 0)); then
+    local LC_ALL=C
+    IFS= read -r -N "$len" body <&"${PRD_HELPER[0]}" || return 1
+  fi
+
+  if [[ "$status" != "ok" ]]; then
+    printf '%s\n' "$body" >&2
+    return 1
+  fi
+  printf '%s' "$body"
+}
+
+# ─────────────────────────────────────────────────────────────────────────────
+# prd_helper_stop
+# ─────────────────────────────────────────────────────────────────────────────
+# Ask the helper to shut down and reap it.
+# ─────────────────────────────────────────────────────────────────────────────
+prd_helper_stop() {
+  if [[ -n "$PRD_HELPER_PID" ]] && kill -0 "$PRD_HELPER_PID" 2>/dev/null; then
+    printf '{"method":"shutdown"}\n' >&"${PRD_HELPER[1]}" 2>/dev/null || true
+    wait "$PRD_HELPER_PID" 2>/dev/null || true
+  fi
+  PRD_HELPER_PID=""
+}
@@ -0,0 +1,3372 @@
+#!/usr/bin/env python3
+"""
+PRD Parser Library for Ralph CLI.
+
+This module provides PRD (Product Requirements Document) parsing utilities
+including prompt rendering, story selection, and activity log management.
+
+Usage from bash:
+    python3 "$SCRIPT_DIR/lib/prd-parser.py" <command> [args...]
+    PYTHONPATH="$SCRIPT_DIR/lib" python3 -m prd_parser <command> [args...]
+
+Commands:
+    render_prompt <src> <dst> <json_vars_file> [story_meta] [story_block]
+    render_retry_prompt <src> <dst> <json_vars_file> [story_meta] [story_block] [failure_context_file] [retry_attempt] [retry_max]
+    failure_context <log_file> [budget_bytes]
+    classify_failure <log_file>
+    retry_outcome <prd_path> <story_id> <success|failure>
+    select_story <prd_path> <meta_out> <block_out>
+    story_index <prd_path>
+    complete_story <prd_path> <story_id>
+    ready_stories <prd_path>
+    progress <prd_path>
+    prd_ast <prd_path>
+    claim_stories <prd_path> [--count N] [--worker ID] [--lease SECONDS] [--block-dir DIR]
+    release_claim <prd_path> <story_id> [worker]
+    scan_all [ralph_dir] [workers]
+    query [--ralph-dir DIR] [--prd LIST] [--status open|done|any] [--ids US-N..US-M] [--title REGEX] [--has-deps yes|no|any]
+    remaining_stories <meta_file>
+    story_field <meta_file> <field>
+    append_run_summary <activity_log_path> <line>
+    materialize_activity_log <activity_log_path>
+    activity_log <activity_log_path>
+    rotate_logs <prd_folder> [--max-bytes N] [--max-age SECONDS]
+    log_query <prd_folder> <log_name> [--since TS] [--until TS]
+    profile_report <profile.jsonl|prd_folder> [command]
+    batch <manifest_file|->
+    serve [--socket <path>] [--frames]
+    watch [--ralph-dir DIR] [--socket PATH|-] [--poll] [--interval SECONDS] [--max-events N]
+
+Serve mode keeps one interpreter alive and answers line-delimited JSON-RPC
+requests ({"id": 1, "method": "select_story", "params": [...]}) on stdin/stdout
+or on a Unix socket, so loops avoid paying interpreter startup per call.
+With --frames, each response is instead a "<ok|error> <byte length>" line
+followed by exactly that many bytes of output (or error message), which
+bash can read with builtins alone.
+
+Watch mode keeps every PRD's story index current as prd.md files change
+(inotify, or stat polling) and publishes NDJSON change events on a Unix
+socket, so consumers can subscribe to deltas instead of re-parsing.
+
+Set RALPH_PROFILE=1 to append a timing record per command to the PRD
+folder's .profile.jsonl (see ralph_profile.py).
+"""
+
+# Taken before the other imports so the profiler's import span covers them
+import time
+_STARTED = time.perf_counter()
+
+import json
+import os
+import re
+import sys
+from pathlib import Path
+
+
+# Profiler of the running command while RALPH_PROFILE is set, else None
+PROFILER = None
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _span(name: str):
+    """Time a block under `name` when profiling; a no-op otherwise."""
+    return _NO_SPAN if PROFILER is None else PROFILER.span(name)
+
+
+def _io(read: int = 0, written: int = 0) -> None:
+    """Count bytes read and written when profiling."""
+    if PROFILER is not None:
+        PROFILER.count(read, written)
+
+
+def _blake2b(data, digest_size: int) -> str:
+    # hashlib loads the OpenSSL bindings, so it is only imported by commands
+    # that hash (see the import-time budget in tests/bench-python.py)
+    import hashlib
+    return hashlib.blake2b(data, digest_size=digest_size).hexdigest()
+
+
+# {{NAME}} placeholders in prompt templates
+PLACEHOLDER = re.compile(r"\{\{([A-Za-z_][A-Za-z0-9_]*)\}\}")
+
+# Compiled templates keyed by content hash (reused across calls in serve mode)
+_TEMPLATE_CACHE = {}
+
+
+def compile_template(source: str) -> tuple:
+    """
+    Split a template into literal text and placeholder names.
+
+    Args:
+        source: Template text
+
+    Returns:
+        Tuple of (literals, names) where literals has one more entry than
+        names and the template is literals[0] + names[0] + literals[1] + ...
+    """
+    parts = PLACEHOLDER.split(source)
+    return tuple(parts[0::2]), tuple(parts[1::2])
+
+
+def load_template(src_path: str) -> tuple:
+    """Read and compile a template, reusing a cached compile for the same content."""
+    with _span("read"):
+        source = Path(src_path).read_text()
+    _io(read=len(source))
+    key = _blake2b(source.encode("utf-8"), 16)
+    compiled = _TEMPLATE_CACHE.get(key)
+    if compiled is None:
+        with _span("parse"):
+            compiled = _TEMPLATE_CACHE[key] = compile_template(source)
+    return compiled
+
+
+# Chunk size for copying file-backed values into rendered output
+STREAM_CHUNK = 64 * 1024
+
+
+class FileValue:
+    """A template value streamed from a file instead of held in memory."""
+
+    __slots__ = ("path",)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __str__(self) -> str:
+        return Path(self.path).read_text()
+
+
+def render_template(compiled: tuple, values: dict) -> tuple:
+    """
+    Render a compiled template in a single pass.
+
+    Substituted values are not re-scanned, so a value that itself contains
+    {{NAME}} text is inserted verbatim. Placeholders with no value are left
+    in place.
+
+    Args:
+        compiled: Result of compile_template()
+        values: Placeholder values
+
+    Returns:
+        Tuple of (rendered text, sorted list of unresolved placeholder names)
+    """
+    literals, names = compiled
+    out = [literals[0]]
+    unresolved = set()
+    for name, literal in zip(names, literals[1:]):
+        if name in values:
+            out.append(str(values[name]))
+        else:
+            out.append("{{" + name + "}}")
+            unresolved.add(name)
+        out.append(literal)
+    return "".join(out), sorted(unresolved)
+
+
+def stream_template(compiled: tuple, values: dict, out) -> list:
+    """
+    Render a compiled template segment by segment into a binary stream.
+
+    FileValue values are copied from their files in STREAM_CHUNK pieces, so
+    memory use does not grow with the size of injected blocks.
+
+    Args:
+        compiled: Result of compile_template()
+        values: Placeholder values (str or FileValue)
+        out: Binary file object to write to
+
+    Returns:
+        Sorted list of unresolved placeholder names
+    """
+    literals, names = compiled
+    unresolved = set()
+    out.write(literals[0].encode("utf-8"))
+    for name, literal in zip(names, literals[1:]):
+        value = values.get(name)
+        if isinstance(value, FileValue):
+            with open(value.path, "rb") as src:
+                while True:
+                    chunk = src.read(STREAM_CHUNK)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+        elif name in values:
+            out.write(str(value).encode("utf-8"))
+        else:
+            out.write(("{{" + name + "}}").encode("utf-8"))
+            unresolved.add(name)
+        out.write(literal.encode("utf-8"))
+    return sorted(unresolved)
+
+
+def render_template_file(src_path: str, dst_path: str, values: dict) -> list:
+    """
+    Render a template file straight to a destination file.
+
+    Unresolved placeholders are reported on stderr.
+
+    Returns:
+        Sorted list of unresolved placeholder names
+    """
+    compiled = load_template(src_path)
+    with _span("substitute"), open(dst_path, "wb") as out:
+        unresolved = stream_template(compiled, values, out)
+        _io(written=out.tell())
+    if unresolved:
+        print(f"Warning: unresolved placeholders in {src_path}: {', '.join(unresolved)}", file=sys.stderr)
+    return unresolved
+
+
+# Parsed vars files keyed by (path, mtime_ns, size), shared within a process
+_VARS_CACHE = {}
+
+
+def load_vars(vars_file) -> dict:
+    """
+    Load template variables, reusing an earlier parse of an unchanged file.
+
+    Args:
+        vars_file: Path to a JSON vars file, or an already-loaded dict
+
+    Returns:
+        A fresh dict of variables the caller may modify
+    """
+    if isinstance(vars_file, dict):
+        return dict(vars_file)
+    st = os.stat(vars_file)
+    key = (str(vars_file), st.st_mtime_ns, st.st_size)
+    cached = _VARS_CACHE.get(key)
+    if cached is None:
+        _io(read=st.st_size)
+        with _span("read"):
+            raw = Path(vars_file).read_text()
+        with _span("parse"):
+            cached = _VARS_CACHE[key] = json.loads(raw)
+    return dict(cached)
+
+
+def render_prompt(src_path: str, dst_path: str, vars_file: str,
+                  story_meta_path: str = "", story_block_path: str = "") -> list:
+    """
+    Render a prompt template by substituting {{VAR}} placeholders.
+
+    Args:
+        src_path: Path to source template file
+        dst_path: Path to write rendered prompt
+        vars_file: Path to JSON file containing template variables
+        story_meta_path: Optional path to story metadata JSON file
+        story_block_path: Optional path to story content block file
+
+    Returns:
+        Sorted list of placeholders left unresolved
+    """
+    # Load template variables (JSON file path, or a dict in batch mode)
+    repl = load_vars(vars_file)
+
+    # Load story metadata if provided
+    story = {"id": "", "title": "", "block": ""}
+    if story_meta_path and Path(story_meta_path).exists():
+        try:
+            meta = json.loads(Path(story_meta_path).read_text())
+            story["id"] = meta.get("id", "") or ""
+            story["title"] = meta.get("title", "") or ""
+        except Exception:
+            pass
+
+    # Stream story block content from its file if provided
+    if story_block_path and Path(story_block_path).exists():
+        story["block"] = FileValue(story_block_path)
+
+    # Add story fields to replacements
+    repl["STORY_ID"] = story["id"]
+    repl["STORY_TITLE"] = story["title"]
+    repl["STORY_BLOCK"] = story["block"]
+
+    return render_template_file(src_path, dst_path, repl)
+
+
+# Error keywords, the same set extract_error_context uses in events.sh
+ERROR_LINE = re.compile(
+    rb'[Ee]rror|[Ff]ail|[Ee]xception|[Aa]bort|[Pp]anic|[Ff]atal|[Cc]rashed|[Tt]imeout'
+    rb'|[Rr]efused|ENOENT|EACCES|EPERM|ERR!|\xe2\x9c\x97|\xe2\x9c\x96|\xf0\x9f\x94\xb4'
+)
+
+# Default failure context budget (bytes); roughly 16k tokens at 4 bytes/token
+FAILURE_CONTEXT_BYTES = 64 * 1024
+
+
+def failure_context_budget() -> int:
+    """
+    Return the failure context byte budget.
+
+    RALPH_FAILURE_CONTEXT_BYTES sets it directly; RALPH_FAILURE_CONTEXT_TOKENS
+    sets it in tokens (4 bytes each). Defaults to FAILURE_CONTEXT_BYTES.
+    """
+    if os.environ.get("RALPH_FAILURE_CONTEXT_BYTES", "").isdigit():
+        return int(os.environ["RALPH_FAILURE_CONTEXT_BYTES"])
+    if os.environ.get("RALPH_FAILURE_CONTEXT_TOKENS", "").isdigit():
+        return int(os.environ["RALPH_FAILURE_CONTEXT_TOKENS"]) * 4
+    return FAILURE_CONTEXT_BYTES
+
+
+def read_failure_tail(path: str, budget: int = 0, scan_limit: int = 0) -> str:
+    """
+    Extract the last error-bearing region of a log without reading all of it.
+
+    Seeks backwards from the end of the file in chunks until it finds the
+    last line with an error keyword, then returns up to `budget` bytes
+    ending a little after it (a quarter of the budget is kept for what
+    follows the error, such as test summaries). If no error keyword appears
+    within `scan_limit` bytes of the end, the last `budget` bytes are used.
+    The region starts on a line boundary and notes how much was omitted.
+
+    Args:
+        path: Log or failure context file
+        budget: Maximum bytes to return (default failure_context_budget())
+        scan_limit: Maximum bytes to search backwards (default 16 x budget)
+
+    Returns:
+        The extracted text
+    """
+    budget = budget or failure_context_budget()
+    scan_limit = scan_limit or budget * 16
+
+    with _span("read"), open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size <= budget:
+            f.seek(0)
+            _io(read=size)
+            return f.read().decode("utf-8", errors="replace")
+
+        # Walk backwards for the last error keyword; keep a little overlap so
+        # keywords split across chunk boundaries are still found
+        error_at = -1
+        pos = size
+        overlap = b""
+        while pos > 0 and size - pos < scan_limit:
+            step = min(STREAM_CHUNK, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + overlap
+            last = None
+            for last in ERROR_LINE.finditer(buf):
+                pass
+            if last is not None:
+                error_at = pos + last.start()
+                break
+            overlap = buf[:16]
+
+        if error_at >= 0:
+            end = min(size, error_at + budget // 4)
+            start = max(0, end - budget)
+        else:
+            start, end = size - budget, size
+
+        f.seek(start)
+        region = f.read(end - start)
+        _io(read=size - pos + len(region))
+
+    if start > 0:
+        nl = region.find(b"\n")
+        region = region[nl + 1:] if nl != -1 else region
+    text = region.decode("utf-8", errors="replace")
+    omitted = size - len(region)
+    if omitted > 0:
+        text = f"[... {omitted} bytes of log omitted ...]\n" + text
+    return text
+
+
+def failure_context(path: str, budget: str = "") -> None:
+    """
+    Print the bounded failure context extracted from a log.
+
+    Args:
+        path: Log or failure context file
+        budget: Optional byte budget
+    """
+    sys.stdout.write(read_failure_tail(path, int(budget) if budget else 0))
+
+
+# Failure keywords, matched case-insensitively as substrings
+FAILURE_KEYWORDS = (
+    "import", "error", "fail", "module", "route", "not found", "404",
+    "expect", "received", "assert", "undefined", "null", "type", "timeout",
+    "permission", "access", "syntax", "enoent", "no such file",
+    "eaddrinuse", "address already in use",
+)
+
+# Analysis rules, checked per line: every keyword group must have a hit on
+# the same line (a group is satisfied by any one of its keywords)
+ANALYSIS_RULES = (
+    ((("import",), ("error", "fail")), "- Import statements may have issues"),
+    ((("route",), ("not found", "404")), "- Route registration may be missing"),
+    ((("expect",), ("received",)), "- Test assertions did not match expected values"),
+    ((("undefined", "null"),), "- Some variables or properties were undefined/null"),
+    ((("type",), ("error",)), "- Type mismatches were detected"),
+    ((("enoent", "no such file"),), "- Expected files or paths were missing"),
+    ((("eaddrinuse", "address already in use"),), "- A port or address was already in use"),
+)
+
+# Suggestion rules, checked against the keywords seen anywhere in the text
+SUGGESTION_RULES = (
+    ((("import",), ("error", "module")), (
+        "- Verify all import paths are correct and modules exist",
+        "- Check for circular dependencies",
+    )),
+    ((("route", "404"),), (
+        "- Ensure the route is registered in the router/app",
+        "- Check route path spelling and parameters",
+    )),
+    ((("expect", "assert"),), (
+        "- Match the expected output format exactly",
+        "- Check data types (string vs number, etc.)",
+    )),
+    ((("undefined", "null"),), (
+        "- Add null checks and default values",
+        "- Verify object properties exist before accessing",
+    )),
+    ((("timeout",),), (
+        "- Reduce operation complexity or add pagination",
+        "- Check for infinite loops or blocking operations",
+    )),
+    ((("permission", "access"),), (
+        "- Check file/directory permissions",
+        "- Verify authentication/authorization is set up",
+    )),
+    ((("syntax",),), (
+        "- Check for missing brackets, semicolons, or quotes",
+        "- Validate JSON/YAML/config file formats",
+    )),
+    ((("enoent", "no such file"),), (
+        "- Verify file paths exist relative to the working directory",
+        "- Create missing files or directories before using them",
+    )),
+    ((("eaddrinuse", "address already in use"),), (
+        "- Stop leftover servers or pick a free port",
+    )),
+)
+
+# Cap on line positions kept per signature (counts are always exact)
+MAX_MATCH_LINES = 100
+
+_CLASSIFIER_CACHE = {}
+
+
+def errors_registry_path() -> Path:
+    """Return the error registry path (ERRORS_JSON, as in errors.sh)."""
+    return Path(os.environ.get("ERRORS_JSON") or Path(__file__).with_name("errors.json"))
+
+
+def _signature_pattern(keywords, signatures) -> str:
+    """
+    Build one regex matching any keyword or signature.
+
+    Keywords are factored into a prefix trie and signatures that start with
+    a plain character are grouped under the same first character, so every
+    top-level branch begins with a literal and the regex engine can skip
+    non-candidate positions quickly. Signatures come before keywords within
+    a branch so they win where both match.
+    """
+    trie = {}
+    for word in keywords:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 and "" not in node else "(?:" + "|".join(branches) + ")"
+        return body + ("?" if "" in node else "")
+
+    tails = {}
+    unfactored = []
+    for signature in signatures:
+        if signature[:1].isalnum() and "|" not in signature and signature[1:2] not in ("*", "+", "?", "{"):
+            tails.setdefault(signature[0], []).append(signature[1:])
+        else:
+            unfactored.append(f"(?:{signature})")
+
+    branches = []
+    for char in sorted(set(tails) | set(trie)):
+        options = tails.get(char, []) + ([emit(trie[char])] if char in trie else [])
+        branches.append(re.escape(char) + "(?:" + "|".join(options) + ")")
+    return "|".join(unfactored + branches)
+
+
+def load_failure_classifier():
+    """
+    Compile every failure signature into one regex.
+
+    The "signatures" regexes of error registry entries and the built-in
+    keywords become alternatives of a single groupless pattern run over
+    lowercased text, so one finditer pass finds all of them. Signatures
+    must therefore be written in lowercase; text they match is not
+    rescanned for keywords. Compiles are cached per registry mtime.
+
+    Returns:
+        (pattern, signatures, registry) where signatures lists
+        (compiled signature, code) pairs used to attribute registry matches
+        and registry maps codes to their entries
+    """
+    path = errors_registry_path()
+    try:
+        stamp = path.stat().st_mtime_ns
+    except OSError:
+        stamp = None
+    cached = _CLASSIFIER_CACHE.get(str(path))
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    registry = {}
+    if stamp is not None:
+        try:
+            registry = {
+                code: entry for code, entry in json.loads(path.read_text()).items()
+                if isinstance(entry, dict) and entry.get("signatures")
+            }
+        except (OSError, ValueError):
+            registry = {}
+
+    signatures = []
+    for code, entry in registry.items():
+        for signature in entry["signatures"]:
+            try:
+                signatures.append((re.compile(signature), code))
+            except re.error:
+                print(f"Warning: invalid signature for {code}: {signature}", file=sys.stderr)
+
+    pattern = _signature_pattern(FAILURE_KEYWORDS, [sig.pattern for sig, _ in signatures])
+    compiled = (re.compile(pattern), signatures, registry)
+    _CLASSIFIER_CACHE[str(path)] = (stamp, compiled)
+    return compiled
+
+
+def _rule_matches(groups, seen) -> bool:
+    return all(any(keyword in seen for keyword in group) for group in groups)
+
+
+def classify_failure(context: str) -> dict:
+    """
+    Classify a failure context in a single pass.
+
+    Args:
+        context: The failure context from previous run
+
+    Returns:
+        Dict with per-signature "counts" and 1-based "lines" (capped at
+        MAX_MATCH_LINES each), the matched registry "codes", and the
+        "analysis" and "suggestions" bullet lists
+    """
+    pattern, signatures, registry = load_failure_classifier()
+    keywords = frozenset(FAILURE_KEYWORDS)
+    counts = {}
+    lines = {}
+    analysis = []
+    line_keywords = set()
+    line_no = 1
+    pos = 0
+
+    def close_line():
+        for groups, bullet in ANALYSIS_RULES:
+            if bullet not in analysis and _rule_matches(groups, line_keywords):
+                analysis.append(bullet)
+        line_keywords.clear()
+
+    # Lowercasing can change string length, so positions refer to `text`
+    text = context.lower()
+    for match in pattern.finditer(text):
+        start = match.start()
+        newlines = text.count("\n", pos, start)
+        if newlines:
+            close_line()
+            line_no += newlines
+        pos = start
+        key = match.group()
+        if key not in keywords:
+            key = next((code for sig, code in signatures if sig.fullmatch(key)), key)
+        counts[key] = counts.get(key, 0) + 1
+        hits = lines.setdefault(key, [])
+        if len(hits) < MAX_MATCH_LINES and (not hits or hits[-1] != line_no):
+            hits.append(line_no)
+        line_keywords.add(key)
+    close_line()
+
+    codes = [key for key in counts if key in registry]
+    # Registry matches are the most specific, so they lead both lists
+    analysis = [f"- {registry[code].get('message', code)} ({code})" for code in codes] + analysis
+    suggestions = []
+    for code in codes:
+        suggestions.extend(f"- {step}" for step in registry[code].get("remediation", [])[:2])
+    for groups, bullets in SUGGESTION_RULES:
+        if _rule_matches(groups, counts):
+            suggestions.extend(bullets)
+
+    return {
+        "counts": counts,
+        "lines": lines,
+        "codes": codes,
+        "analysis": analysis,
+        "suggestions": suggestions,
+    }
+
+
+def analyze_previous_approach(context: str, classified: dict = None) -> str:
+    """
+    Analyze what the previous approach tried based on failure context.
+
+    Args:
+        context: The failure context from previous run
+        classified: Optional classify_failure() result for the same context
+
+    Returns:
+        Analysis string with bullet points
+    """
+    if not context:
+        return "No previous failure context available."
+
+    analysis = (classified or classify_failure(context))["analysis"]
+    if not analysis:
+        return "- Review the full log for specific failure details"
+    return '\n'.join(analysis[:5])  # Limit to 5
+
+
+def suggest_alternatives(context: str, classified: dict = None) -> str:
+    """
+    Suggest alternative approaches based on failure patterns.
+
+    Args:
+        context: The failure context from previous run
+        classified: Optional classify_failure() result for the same context
+
+    Returns:
+        Suggestions string with bullet points
+    """
+    if not context:
+        return "- Try a simpler approach first\n- Double-check the requirements"
+
+    suggestions = (classified or classify_failure(context))["suggestions"]
+    if not suggestions:
+        suggestions = [
+            "- Read the failing test/verification command carefully",
+            "- Check if dependencies are installed",
+            "- Try a more incremental approach",
+        ]
+    return '\n'.join(suggestions[:4])  # Limit to 4 suggestions
+
+
+def classify_failure_log(path: str) -> None:
+    """
+    Print the classification of a log's bounded failure context as JSON.
+
+    Args:
+        path: Log or failure context file
+    """
+    context = read_failure_tail(path)
+    with _span("parse"):
+        classified = classify_failure(context)
+    print(json.dumps(classified, indent=2))
+
+
+# Failure signature cache: entries per PRD, least recently used evicted first
+FAILURE_CACHE_SIZE = 64
+FAILURE_CACHE_VERSION = 1
+
+# Volatile details stripped before hashing a failure context, in order
+FAILURE_NORMALIZERS = (
+    (re.compile(r'^\[\.\.\. \d+ bytes of log omitted \.\.\.\]\n'), ''),
+    (re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?'), '<ts>'),
+    (re.compile(r'\b\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?\b'), '<ts>'),
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b', re.I), '<id>'),
+    (re.compile(r'\b0x[0-9a-f]+\b', re.I), '<id>'),
+    (re.compile(r'\b(?=[0-9a-f]*\d)(?=[0-9a-f]*[a-f])[0-9a-f]{7,}\b', re.I), '<id>'),
+    (re.compile(r'(?:[A-Za-z]:)?(?:[\w.@~+-]*[/\\])+(?=[\w.@~+-])'), ''),
+    (re.compile(r'\d+'), '#'),
+    (re.compile(r'[ \t]+'), ' '),
+)
+
+
+def failure_signature(context: str) -> str:
+    """
+    Hash a failure context into a signature that is stable across runs.
+
+    Timestamps, UUIDs, hex ids, directory parts of paths and numbers (line
+    numbers, durations, counts) are stripped first, so the same failure
+    seen in two runs hashes the same.
+
+    Args:
+        context: The failure context from previous run
+
+    Returns:
+        Hex signature
+    """
+    text = context
+    for pattern, replacement in FAILURE_NORMALIZERS:
+        text = pattern.sub(replacement, text)
+    normalized = "\n".join(line.strip() for line in text.splitlines() if line.strip())
+    return _blake2b(normalized.encode("utf-8"), 12)
+
+
+def failure_cache_path(prd_path: str) -> Path:
+    """Return the failure cache file kept next to a PRD."""
+    return Path(prd_path).parent / ".failure-cache.json"
+
+
+def load_failure_cache(cache_path: Path) -> dict:
+    """Load a failure cache, starting empty when it is missing or unreadable."""
+    try:
+        cache = json.loads(cache_path.read_text())
+        if cache.get("version") == FAILURE_CACHE_VERSION:
+            return cache
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {"version": FAILURE_CACHE_VERSION, "entries": {}, "pending": {}}
+
+
+class _FailureCacheLock:
+    """flock on <cache>.lock held across a failure cache read-modify-write."""
+
+    def __init__(self, cache_path: Path):
+        self.path = cache_path.with_name(f"{cache_path.name}.lock")
+
+    def __enter__(self):
+        import fcntl
+
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            # The cache is best-effort, like its writes
+            self.fd = None
+            return self
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            os.close(self.fd)
+        return False
+
+
+def _write_failure_cache(cache_path: Path, cache: dict) -> None:
+    # Entries are kept in least-recently-used order; evict from the front
+    entries = cache["entries"]
+    for signature in list(entries)[:max(0, len(entries) - FAILURE_CACHE_SIZE)]:
+        del entries[signature]
+    cache["pending"] = {k: v for k, v in cache["pending"].items() if v in entries}
+
+    tmp = cache_path.with_name(f"{cache_path.name}.tmp.{os.getpid()}")
+    try:
+        tmp.write_text(json.dumps(cache, indent=2) + "\n", encoding="utf-8")
+        os.replace(tmp, cache_path)
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def _settle_pending(cache: dict, story_id: str, outcome: str) -> bool:
+    signature = cache["pending"].pop(story_id, None)
+    entry = cache["entries"].get(signature)
+    if entry is None:
+        return False
+    entry["outcomes"][outcome] = entry["outcomes"].get(outcome, 0) + 1
+    return True
+
+
+def _outcome_note(entry: dict) -> str:
+    succeeded = entry["outcomes"].get("success", 0)
+    failed = entry["outcomes"].get("failure", 0)
+    if succeeded:
+        return (f"- These suggestions led to a successful retry {succeeded} of "
+                f"{succeeded + failed} times for this failure")
+    if failed:
+        plural = "retry" if failed == 1 else "retries"
+        return (f"- These suggestions did not fix this failure in {failed} earlier "
+                f"{plural}; try a different approach")
+    return ""
+
+
+def cached_failure_analysis(cache_path: Path, story_id: str, context: str) -> tuple:
+    """
+    Return PREVIOUS_APPROACH and SUGGESTIONS for a failure, reusing the cache.
+
+    A context whose signature is cached reuses the stored analysis, and the
+    suggestions gain a note on how earlier retries with them turned out.
+    Otherwise the failure is classified and stored. The signature is left
+    pending for the story until retry_outcome records how the retry went;
+    a story retried again before that counts the pending retry as failed.
+
+    Args:
+        cache_path: Failure cache file
+        story_id: Story being retried
+        context: The failure context from previous run
+
+    Returns:
+        (previous_approach, suggestions)
+    """
+    signature = failure_signature(context)
+    with _FailureCacheLock(cache_path):
+        cache = load_failure_cache(cache_path)
+        _settle_pending(cache, story_id, "failure")
+
+        entry = cache["entries"].pop(signature, None)
+        if entry is None:
+            with _span("parse"):
+                classified = classify_failure(context)
+            entry = {
+                "previous_approach": analyze_previous_approach(context, classified),
+                "suggestions": suggest_alternatives(context, classified),
+                "story": story_id,
+                "hits": 0,
+                "outcomes": {},
+            }
+        entry["hits"] += 1
+        entry["last_used"] = int(time.time())
+        cache["entries"][signature] = entry
+        cache["pending"][story_id] = signature
+
+        note = _outcome_note(entry)
+        _write_failure_cache(cache_path, cache)
+    suggestions = entry["suggestions"] + ("\n" + note if note else "")
+    return entry["previous_approach"], suggestions
+
+
+def retry_outcome(prd_path: str, story_id: str, outcome: str) -> None:
+    """
+    Record how the latest retry of a story turned out.
+
+    Args:
+        prd_path: Path to the PRD whose failure cache to update
+        story_id: Story that was retried
+        outcome: "success" or "failure"
+    """
+    if outcome not in ("success", "failure"):
+        raise UsageError(f"Unknown outcome: {outcome} (expected success or failure)")
+    cache_path = failure_cache_path(prd_path)
+    with _FailureCacheLock(cache_path):
+        cache = load_failure_cache(cache_path)
+        recorded = _settle_pending(cache, story_id, outcome)
+        if recorded:
+            _write_failure_cache(cache_path, cache)
+    print("recorded" if recorded else "no-pending")
+
+
+def render_retry_prompt(src_path: str, dst_path: str, vars_file: str,
+                        story_meta_path: str = "", story_block_path: str = "",
+                        failure_context_file: str = "", retry_attempt: str = "1",
+                        retry_max: str = "3") -> list:
+    """
+    Render a retry prompt template with failure context variables.
+
+    Args:
+        src_path: Path to source template file
+        dst_path: Path to write rendered prompt
+        vars_file: Path to JSON file containing template variables; must
+            set PRD_PATH, whose folder holds the failure cache
+        story_meta_path: Optional path to story metadata JSON file
+        story_block_path: Optional path to story content block file
+        failure_context_file: Optional path to failure context file
+        retry_attempt: Current retry attempt number
+        retry_max: Maximum retry attempts
+
+    Returns:
+        Sorted list of placeholders left unresolved
+
+    Raises:
+        UsageError: If the vars do not set PRD_PATH
+    """
+    # Load template variables (JSON file path, or a dict in batch mode)
+    repl = load_vars(vars_file)
+    if not repl.get("PRD_PATH"):
+        raise UsageError("render_retry_prompt: the vars file must set PRD_PATH (it locates the failure cache)")
+
+    # Read the bounded tail of the failure context (large agent logs are
+    # never read whole; the same excerpt feeds the analysis and the template)
+    failure_context = ""
+    if failure_context_file and Path(failure_context_file).exists():
+        failure_context = read_failure_tail(failure_context_file)
+
+    # Load story metadata if provided
+    story = {"id": "", "title": "", "block": ""}
+    if story_meta_path and Path(story_meta_path).exists():
+        try:
+            meta = json.loads(Path(story_meta_path).read_text())
+            story["id"] = meta.get("id", "") or ""
+            story["title"] = meta.get("title", "") or ""
+        except Exception:
+            pass
+
+    # Reuse the analysis of an earlier identical failure from the PRD's
+    # failure cache, or classify it once (analysis and suggestions share the pass)
+    if failure_context:
+        previous_approach, suggestions = cached_failure_analysis(
+            failure_cache_path(repl["PRD_PATH"]), story["id"], failure_context)
+    else:
+        previous_approach = analyze_previous_approach(failure_context)
+        suggestions = suggest_alternatives(failure_context)
+
+    # Add retry-specific variables
+    repl["FAILURE_CONTEXT"] = failure_context
+    repl["PREVIOUS_APPROACH"] = previous_approach
+    repl["SUGGESTIONS"] = suggestions
+    repl["RETRY_ATTEMPT"] = retry_attempt
+    repl["RETRY_MAX"] = retry_max
+
+    # Stream story block content from its file if provided
+    if story_block_path and Path(story_block_path).exists():
+        story["block"] = FileValue(story_block_path)
+
+    # Add story fields to replacements
+    repl["STORY_ID"] = story["id"]
+    repl["STORY_TITLE"] = story["title"]
+    repl["STORY_BLOCK"] = story["block"]
+
+    return render_template_file(src_path, dst_path, repl)
+
+
+# Story header pattern, matched against raw bytes so only header lines are decoded
+STORY_HEADER = re.compile(rb'^###\s+(\[(?P<status>[ xX])\]\s+)?(?P<id>US-\d+):\s*(?P<title>.+)$')
+
+# Lines the header scan has to look at: code fences and ### headings.
+# Patterns are anchored on a literal newline rather than ^ with MULTILINE so
+# the regex engine can skip ahead with a fast literal search.
+CANDIDATE_LINE = re.compile(rb'\n(?:[ \t\r\x0b\x0c]*```|###)')
+CANDIDATE_AT_START = re.compile(rb'(?:[ \t\r\x0b\x0c]*```|###)')
+
+# PRDs at least this large are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 1024 * 1024
+
+STORY_INDEX_VERSION = 2
+
+# Story fields as stored on disk, one row per story
+STORY_INDEX_FIELDS = ("id", "title", "status", "start", "end", "hash", "deps")
+
+# Dependency declarations inside a story block, e.g. "**Depends on:** US-003, US-004"
+DEPENDS_LINE = re.compile(
+    rb'\n[ \t>*-]*(?:\*\*|__)?(?:depends on|dependencies|blocked by)(?:\*\*|__)?[ \t]*:(?P<rest>[^\n]*)',
+    re.IGNORECASE,
+)
+STORY_ID = re.compile(rb'US-\d+')
+FENCE_LINE = re.compile(rb'\n[ \t\r\x0b\x0c]*```')
+
+
+def story_index_path(prd_path) -> Path:
+    """Return the on-disk story index path for a PRD (stored next to it)."""
+    prd_path = Path(prd_path)
+    return prd_path.with_name(f".{prd_path.stem}.story-index.json")
+
+
+def _content_hash(data: bytes) -> str:
+    return _blake2b(data, 12)
+
+
+def _candidate_line_starts(data, start: int, end: int):
+    """Yield the start offset of every fence or ### line in data[start:end]."""
+    if start == 0 and CANDIDATE_AT_START.match(data, 0, end):
+        yield 0
+    # start is a line start, so searching from the newline before it finds its line too
+    for m in CANDIDATE_LINE.finditer(data, max(start - 1, 0), end):
+        yield m.start() + 1
+
+
+def scan_story_headers(data: bytes, start: int = 0, end: int = -1):
+    """
+    Scan a byte region of a PRD for story headers, skipping code fences.
+
+    The region must begin at a line start outside any code fence.
+
+    Args:
+        data: Full PRD contents
+        start: Byte offset to start scanning at
+        end: Byte offset to stop at (-1 for end of data)
+
+    Returns:
+        Tuple of (stories, in_code_block) where each story is a dict with
+        id, title, status, start and end, and in_code_block reports whether
+        the region ended inside an unclosed code fence
+    """
+    if end < 0:
+        end = len(data)
+    stories = []
+    in_code_block = False
+
+    # Jump straight to lines that can matter (fences and ### headers) so the
+    # work done here tracks the number of those lines, not the PRD size
+    for pos in _candidate_line_starts(data, start, end):
+        nl = data.find(b"\n", pos, end)
+        line = data[pos:end if nl == -1 else nl].rstrip(b"\r")
+
+        # Track code fences (``` or ```language)
+        if line.strip().startswith(b"```"):
+            in_code_block = not in_code_block
+        elif not in_code_block:
+            m = STORY_HEADER.match(line)
+            if m:
+                if stories:
+                    stories[-1]["end"] = pos
+                stories.append({
+                    "id": m.group("id").decode("ascii"),
+                    "title": m.group("title").decode("utf-8", errors="replace").strip(),
+                    "status": (m.group("status") or b" ").decode("ascii"),
+                    "start": pos,
+                    "end": end,
+                })
+
+    return stories, in_code_block
+
+
+def parse_dependencies(block: bytes, own_id: str = "") -> list:
+    """
+    Extract declared story dependencies from a story block.
+
+    Recognizes "Depends on:", "Dependencies:" and "Blocked by:" lines
+    (optionally bold or bulleted) outside code fences and collects every
+    US-NNN id on them.
+
+    Args:
+        block: Story block bytes
+        own_id: The story's own id, excluded from the result
+
+    Returns:
+        Ordered, de-duplicated list of story ids
+    """
+    # Byte ranges inside code fences, which never declare dependencies
+    # (the first line is the story header, so every fence follows a newline)
+    fences = [m.start() + 1 for m in FENCE_LINE.finditer(block)]
+    fenced = list(zip(fences[0::2], fences[1::2] + [len(block)]))
+
+    deps = []
+    for m in DEPENDS_LINE.finditer(block):
+        if any(start <= m.start() + 1 < end for start, end in fenced):
+            continue
+        for dep in STORY_ID.findall(m.group("rest")):
+            dep = dep.decode("ascii")
+            if dep != own_id and dep not in deps:
+                deps.append(dep)
+    return deps
+
+
+def read_prd_bytes(prd_path):
+    """
+    Return a PRD's contents as bytes, memory-mapping large files.
+
+    Mapped PRDs are searched and hashed in place; only header lines and the
+    selected story block are ever copied out.
+
+    Args:
+        prd_path: Path to PRD file
+
+    Returns:
+        bytes, or a read-only mmap for files of at least MMAP_THRESHOLD bytes
+    """
+    with _span("read"), open(prd_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        _io(read=size)
+        if size < MMAP_THRESHOLD:
+            return f.read()
+        import mmap
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _finish_index(data: bytes, stories: list, rehash_missing: bool = False) -> dict:
+    """Attach block hashes, dependencies and file-level keys to scanned stories."""
+    for story in stories:
+        if not rehash_missing or "hash" not in story:
+            block = data[story["start"]:story["end"]]
+            story["hash"] = _content_hash(block)
+            story["deps"] = parse_dependencies(block, story["id"])
+    prefix_end = stories[0]["start"] if stories else len(data)
+    return {
+        "version": STORY_INDEX_VERSION,
+        "size": len(data),
+        "hash": _content_hash(data),
+        "prefix_end": prefix_end,
+        "prefix_hash": _content_hash(data[:prefix_end]),
+        "stories": stories,
+    }
+
+
+def build_story_index(data: bytes) -> dict:
+    """Build a story index from scratch by scanning the whole PRD."""
+    stories, _ = scan_story_headers(data)
+    return _finish_index(data, stories)
+
+
+def update_story_index(old: dict, data: bytes) -> dict:
+    """
+    Update a story index after the PRD changed, re-scanning only the edit.
+
+    Leading story blocks that still hash the same at their old offsets and
+    trailing blocks that hash the same at their offsets shifted by the size
+    change are kept. Only the bytes between them are re-scanned. Falls back
+    to a full rebuild when the edit touches the preamble or leaves the
+    re-scanned region inside an open code fence.
+
+    Args:
+        old: Previous index for this PRD
+        data: New PRD contents
+
+    Returns:
+        Updated story index
+    """
+    stories = old.get("stories", [])
+    prefix_end = old.get("prefix_end", 0)
+    if (not stories or prefix_end > len(data)
+            or _content_hash(data[:prefix_end]) != old.get("prefix_hash")):
+        return build_story_index(data)
+
+    def unchanged(story, shift=0):
+        s, e = story["start"] + shift, story["end"] + shift
+        return 0 <= s and e <= len(data) and _content_hash(data[s:e]) == story["hash"]
+
+    # Leading blocks unchanged in place (the last block must also still end at EOF)
+    n = len(stories)
+    head = 0
+    while head < n and unchanged(stories[head]) and (head < n - 1 or stories[head]["end"] == len(data)):
+        head += 1
+    region_start = stories[head]["start"] if head < n else len(data)
+
+    # Trailing blocks unchanged after shifting by the size delta
+    delta = len(data) - old.get("size", 0)
+    tail = 0
+    while (head + tail < n
+           and stories[n - 1 - tail]["start"] + delta >= region_start
+           and unchanged(stories[n - 1 - tail], delta)):
+        tail += 1
+    region_end = stories[n - tail]["start"] + delta if tail else len(data)
+
+    # A kept trailing header must still start a line
+    if tail and region_end > 0 and data[region_end - 1:region_end] != b"\n":
+        return build_story_index(data)
+
+    middle, in_code_block = scan_story_headers(data, region_start, region_end)
+    if in_code_block:
+        return build_story_index(data)
+
+    kept_head = [dict(s) for s in stories[:head]]
+    kept_tail = []
+    for s in stories[n - tail:]:
+        s = dict(s)
+        s["start"] += delta
+        s["end"] += delta
+        kept_tail.append(s)
+
+    # Lines before the first re-scanned header belong to the previous block
+    if head and (not middle or middle[0]["start"] > region_start):
+        kept_head[-1]["end"] = middle[0]["start"] if middle else region_end
+    elif not head and (not middle or middle[0]["start"] > region_start):
+        return build_story_index(data)
+
+    # The block before the edit may have grown; re-hash it with the new blocks
+    for s in kept_head[-1:]:
+        del s["hash"]
+    return _finish_index(data, kept_head + middle + kept_tail, rehash_missing=True)
+
+
+# Story indexes loaded by this process, keyed by PRD path (serve/batch reuse)
+_INDEX_MEMO = {}
+
+
+def load_story_index(prd_path, data: bytes = None, summary_only: bool = False) -> tuple:
+    """
+    Load the cached story index for a PRD, refreshing it if the PRD changed.
+
+    The index is keyed by mtime, size and content hash. A stale index is
+    updated incrementally and written back atomically; failures to write the
+    cache are ignored since the index can always be rebuilt.
+
+    The index file holds a JSON header line (keys, total, remaining and the
+    next open story) followed by a line with one row per story, so a cache
+    hit with summary_only=True reads just the header regardless of story count.
+
+    Args:
+        prd_path: Path to PRD file
+        data: PRD contents if already read
+        summary_only: Skip loading story rows when the cache is fresh
+
+    Returns:
+        Tuple of (index, data); index["stories"] is absent for summary-only hits
+    """
+    prd_path = Path(prd_path)
+    idx_path = story_index_path(prd_path)
+    if data is None:
+        data = read_prd_bytes(prd_path)
+
+    # Reuse an index already loaded by this process for identical content
+    memo = _INDEX_MEMO.get(str(prd_path))
+    if memo is not None and memo["size"] == len(data) and memo["hash"] == _content_hash(data) and "stories" in memo:
+        return memo, data
+
+    try:
+        mtime_ns = prd_path.stat().st_mtime_ns
+    except OSError:
+        mtime_ns = 0
+
+    old = None
+    try:
+        with open(idx_path, "r", encoding="utf-8") as f:
+            old = json.loads(f.readline())
+            if old.get("version") != STORY_INDEX_VERSION:
+                old = None
+            elif old.get("size") == len(data) and old.get("hash") == _content_hash(data):
+                if summary_only and old.get("mtime_ns") == mtime_ns:
+                    return old, data
+                old["stories"] = [dict(zip(STORY_INDEX_FIELDS, row)) for row in json.loads(f.readline())]
+                if old.get("mtime_ns") != mtime_ns:
+                    old["mtime_ns"] = mtime_ns
+                    _write_story_index(idx_path, old)
+                _INDEX_MEMO[str(prd_path)] = old
+                return old, data
+            else:
+                old["stories"] = [dict(zip(STORY_INDEX_FIELDS, row)) for row in json.loads(f.readline())]
+    except (OSError, ValueError, AttributeError, TypeError):
+        old = None
+
+    with _span("parse"):
+        index = update_story_index(old, data) if old else build_story_index(data)
+    index["mtime_ns"] = mtime_ns
+    _write_story_index(idx_path, index)
+    _INDEX_MEMO[str(prd_path)] = index
+    return index, data
+
+
+def _write_story_index(idx_path: Path, index: dict) -> None:
+    stories = index["stories"]
+    remaining = [s for s in stories if not is_done(s)]
+    index["total"] = len(stories)
+    index["remaining"] = len(remaining)
+    index["next"] = {k: remaining[0][k] for k in STORY_INDEX_FIELDS} if remaining else None
+
+    header = {k: v for k, v in index.items() if k != "stories"}
+    rows = [[s[f] for f in STORY_INDEX_FIELDS] for s in stories]
+    lines = [json.dumps(header, separators=(",", ":")), json.dumps(rows, separators=(",", ":"))]
+
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+    tmp = idx_path.with_name(f"{idx_path.name}.tmp.{os.getpid()}")
+    try:
+        with _span("write"):
+            tmp.write_bytes(payload)
+            os.replace(tmp, idx_path)
+        _io(written=len(payload))
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def is_done(story: dict) -> bool:
+    """Return True if a story's checkbox is checked."""
+    return str(story.get("status", "")).strip().lower() == "x"
+
+
+def story_block_text(data: bytes, story: dict) -> str:
+    """Return a story's block as text, without its trailing newline."""
+    block = data[story["start"]:story["end"]].decode("utf-8", errors="replace")
+    return "\n".join(block.splitlines())
+
+
+def select_story(prd_path: str, meta_out: str, block_out: str) -> None:
+    """
+    Select the next uncompleted story from a PRD file.
+
+    Uses the cached story index, so only the selected block is decoded.
+
+    Args:
+        prd_path: Path to PRD file
+        meta_out: Path to write story metadata JSON
+        block_out: Path to write story content block
+    """
+    meta_out = Path(meta_out)
+    block_out = Path(block_out)
+
+    index, data = load_story_index(prd_path, summary_only=True)
+
+    if not index["total"]:
+        with _span("write"):
+            meta_out.write_text(json.dumps({"ok": False, "error": "No stories found in PRD"}, indent=2) + "\n")
+            block_out.write_text("")
+        return
+
+    meta = {"ok": True, "total": index["total"], "remaining": index["remaining"]}
+    target = index["next"]
+
+    with _span("write"):
+        if target:
+            meta.update({
+                "id": target["id"],
+                "title": target["title"],
+            })
+            _io(written=block_out.write_text(story_block_text(data, target)))
+        else:
+            block_out.write_text("")
+
+        _io(written=meta_out.write_text(json.dumps(meta, indent=2) + "\n"))
+
+
+def story_index(prd_path: str) -> None:
+    """
+    Print the story index for a PRD (id, title, status, byte range).
+
+    Args:
+        prd_path: Path to PRD file
+    """
+    index, _ = load_story_index(prd_path)
+    print(json.dumps({
+        "size": index["size"],
+        "hash": index["hash"],
+        "stories": [
+            {k: s[k] for k in ("id", "title", "status", "start", "end")}
+            for s in index["stories"]
+        ],
+    }, indent=2))
+
+
+class PrdEditError(Exception):
+    """Raised when an in-place PRD edit cannot be applied safely."""
+
+
+def complete_story(prd_path: str, story_id: str) -> None:
+    """
+    Mark a story done by flipping its header checkbox in place.
+
+    The PRD is locked with flock for the whole operation, so concurrent
+    complete_story calls serialize. The story is located through the story
+    index, the single status byte is overwritten, and the index is updated
+    for the new content in the same step. If the PRD was changed or
+    replaced by a writer that does not take the lock between reading it and
+    writing the byte, nothing is written and PrdEditError is raised (as it
+    is for an unknown story or a header without a checkbox).
+
+    Args:
+        prd_path: Path to PRD file
+        story_id: Story to complete (e.g. US-003)
+
+    Prints:
+        {"ok", "id", "changed", "offset", "remaining"}
+    """
+    import fcntl
+
+    fd = os.open(prd_path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        before = os.fstat(fd)
+        with _span("read"):
+            data = os.pread(fd, before.st_size, 0)
+        _io(read=len(data))
+        index, data = load_story_index(prd_path, data)
+
+        story = next((s for s in index["stories"] if s["id"] == story_id), None)
+        if story is None:
+            raise PrdEditError(f"Story not found in {prd_path}: {story_id}")
+        nl = data.find(b"\n", story["start"], story["end"])
+        header = STORY_HEADER.match(data[story["start"]:story["end"] if nl == -1 else nl].rstrip(b"\r"))
+        if header is None or header.group("id").decode("ascii") != story_id:
+            raise PrdEditError(f"Story index is out of date for {prd_path}")
+        if header.group("status") is None:
+            raise PrdEditError(f"Story {story_id} has no checkbox to complete")
+
+        offset = story["start"] + header.start("status")
+        changed = not is_done(story)
+        if changed:
+            after = os.fstat(fd)
+            try:
+                current = os.stat(prd_path)
+            except OSError:
+                current = None
+            if (current is None or (current.st_dev, current.st_ino) != (before.st_dev, before.st_ino) or
+                    (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns)):
+                raise PrdEditError(f"{prd_path} changed while completing {story_id}; nothing written")
+            with _span("write"):
+                os.pwrite(fd, b"x", offset)
+            _io(written=1)
+
+            # Only the story's block and the file hash are affected by the flip
+            data = data[:offset] + b"x" + data[offset + 1:]
+            story["status"] = "x"
+            story["hash"] = _content_hash(data[story["start"]:story["end"]])
+            index["hash"] = _content_hash(data)
+            index["mtime_ns"] = os.fstat(fd).st_mtime_ns
+            _write_story_index(story_index_path(prd_path), index)
+            _INDEX_MEMO[str(Path(prd_path))] = index
+    finally:
+        os.close(fd)
+
+    print(json.dumps({
+        "ok": True,
+        "id": story_id,
+        "changed": changed,
+        "offset": offset,
+        "remaining": index["remaining"],
+    }, indent=2))
+
+
+def story_graph(stories: list) -> dict:
+    """
+    Build the dependency DAG of a PRD's stories and rank the open ones.
+
+    A story is ready when it is open and every dependency is done. Open
+    stories are ranked by critical path length: the longest chain of open
+    stories (including itself) that transitively wait on it. Dependencies
+    on ids that are not in the PRD block the story and are reported as
+    missing; stories on a dependency cycle are never ready.
+
+    Args:
+        stories: Story dicts from the story index
+
+    Returns:
+        Dict with ready, blocked, cycles and missing lists
+    """
+    by_id = {}
+    for story in stories:
+        by_id.setdefault(story["id"], story)
+    open_ids = [sid for sid, s in by_id.items() if not is_done(s)]
+
+    # dependents[d] = open stories that list d as a dependency
+    dependents = {sid: [] for sid in by_id}
+    missing = set()
+    for sid in open_ids:
+        for dep in by_id[sid].get("deps") or []:
+            if dep in by_id:
+                dependents[dep].append(sid)
+            else:
+                missing.add(dep)
+
+    # Critical path over open stories, with cycle detection (iterative DFS)
+    critical = {}
+    on_cycle = set()
+    for root in open_ids:
+        if root in critical:
+            continue
+        stack = [(root, iter(dependents[root]))]
+        visiting = {root}
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                visiting.discard(node)
+                critical[node] = 1 + max((critical.get(c, 0) for c in dependents[node]), default=0)
+            elif child in visiting:
+                # Every node on the stack from child upward is on the cycle
+                names = [n for n, _ in stack]
+                on_cycle.update(names[names.index(child):])
+            elif child not in critical:
+                visiting.add(child)
+                stack.append((child, iter(dependents[child])))
+
+    order = {sid: i for i, sid in enumerate(open_ids)}
+    ready, blocked = [], []
+    for sid in open_ids:
+        waiting = [d for d in by_id[sid].get("deps") or [] if d not in by_id or not is_done(by_id[d])]
+        entry = {
+            "id": sid,
+            "title": by_id[sid]["title"],
+            "critical_path": critical[sid],
+            "unblocks": len(dependents[sid]),
+        }
+        if waiting or sid in on_cycle:
+            entry["waiting_on"] = waiting
+            blocked.append(entry)
+        else:
+            ready.append(entry)
+
+    ready.sort(key=lambda e: (-e["critical_path"], order[e["id"]]))
+    return {
+        "ready": ready,
+        "blocked": blocked,
+        "cycles": [sid for sid in open_ids if sid in on_cycle],
+        "missing": sorted(missing),
+    }
+
+
+def ready_stories(prd_path: str) -> None:
+    """
+    Print every open story whose dependencies are done, longest critical path first.
+
+    Args:
+        prd_path: Path to PRD file
+
+    Prints:
+        {"ok", "total", "remaining", "ready": [...], "blocked": [...], "cycles", "missing"}
+    """
+    index, _ = load_story_index(prd_path)
+    graph = story_graph(index["stories"])
+    print(json.dumps(dict({
+        "ok": bool(index["stories"]),
+        "total": index["total"],
+        "remaining": index["remaining"],
+    }, **graph), indent=2))
+
+
+# Structured PRD AST: document sections, plus each story's subsections and
+# checkbox items (acceptance criteria), cached next to the PRD per version
+PRD_AST_VERSION = 1
+
+# An AST built less than this long after the PRD's mtime is not trusted on
+# size and mtime alone: the PRD may have been rewritten within the same
+# timestamp tick (2s on FAT), so the content hash is checked once more
+MTIME_GRANULARITY_NS = 2 * 10**9
+
+# Lines the AST cares about: code fences, headings and "- [ ]" checkbox items
+_AST_LINE = (rb'[ \t\r\x0b\x0c]*(?:```|(?P<hashes>#{1,6})[ \t]+(?P<heading>[^\n]*)'
+             rb'|[-*+][ \t]+\[(?P<state>[ xX])\][ \t]+(?P<item>[^\n]*))')
+AST_LINE = re.compile(rb'\n' + _AST_LINE)
+
+# Lines that delimit document sections: code fences and level 1-2 headings
+_DOC_LINE = rb'[ \t\r\x0b\x0c]*(?:```|(?P<hashes>#{1,2})[ \t]+(?P<heading>[^\n]*))'
+DOC_LINE = re.compile(rb'\n' + _DOC_LINE)
+DOC_LINE_AT_START = re.compile(_DOC_LINE)
+
+
+def prd_ast_path(prd_path) -> Path:
+    """Return the on-disk AST cache path for a PRD (stored next to it)."""
+    prd_path = Path(prd_path)
+    return prd_path.with_name(f".{prd_path.stem}.prd-ast.json")
+
+
+def _ast_text(raw: bytes) -> str:
+    return raw.decode("utf-8", errors="replace").strip().rstrip("#").strip()
+
+
+def parse_story_ast(block: bytes) -> tuple:
+    """
+    Parse a story block's subsections and checkbox items, skipping code fences.
+
+    The block ends early at a level 1 or 2 heading, which starts a new
+    document section rather than continuing the story.
+
+    Args:
+        block: Story block bytes, starting with its ### header line
+
+    Returns:
+        Tuple of (sections, criteria) with offsets relative to the block:
+        sections are [level, title, start] and criteria are
+        [offset of the checkbox state character, state, text]
+    """
+    sections, criteria = [], []
+    in_code_block = False
+    # The first line is the story header, so every line of interest follows a newline
+    for m in AST_LINE.finditer(block):
+        if m.group("hashes") is None and m.group("state") is None:
+            in_code_block = not in_code_block
+        elif in_code_block:
+            continue
+        elif m.group("hashes") is not None:
+            level = len(m.group("hashes"))
+            if level <= 2:
+                break
+            sections.append([level, _ast_text(m.group("heading")), m.start() + 1])
+        else:
+            criteria.append([m.start("state"), m.group("state").decode("ascii"), _ast_text(m.group("item"))])
+    return sections, criteria
+
+
+def _doc_lines(data):
+    # (line start, match) for every fence and level 1-2 heading
+    m = DOC_LINE_AT_START.match(data)
+    if m:
+        yield 0, m
+    for m in DOC_LINE.finditer(data):
+        yield m.start() + 1, m
+
+
+def document_sections(data: bytes) -> list:
+    """
+    Return the level 1 and 2 headings of a PRD outside code fences.
+
+    Returns:
+        List of {level, title, start, end} dicts; a section ends at the
+        next heading of the same or a higher level
+    """
+    sections, still_open = [], []
+    in_code_block = False
+    for offset, m in _doc_lines(data):
+        if m.group("hashes") is None:
+            in_code_block = not in_code_block
+        elif not in_code_block:
+            section = {"level": len(m.group("hashes")), "title": _ast_text(m.group("heading")),
+                       "start": offset, "end": len(data)}
+            while still_open and still_open[-1]["level"] >= section["level"]:
+                still_open.pop()["end"] = offset
+            still_open.append(section)
+            sections.append(section)
+    return sections
+
+
+def build_prd_ast(data: bytes, index: dict, reuse: dict = None) -> dict:
+    """
+    Build the AST of a PRD from its contents and story index.
+
+    Args:
+        data: PRD contents
+        index: Story index for the same contents
+        reuse: Parsed story blocks by block hash, from an earlier AST
+
+    Returns:
+        Dict with the index keys (size, hash), document "sections", and
+        "stories" carrying id, title, status, start, end, hash, and the
+        block's "sections" and "criteria" (offsets relative to start)
+    """
+    reuse = reuse or {}
+    stories = []
+    for story in index["stories"]:
+        parsed = reuse.get(story["hash"])
+        if parsed is None:
+            parsed = parse_story_ast(data[story["start"]:story["end"]])
+        stories.append(dict({k: story[k] for k in ("id", "title", "status", "start", "end", "hash")},
+                            sections=parsed[0], criteria=parsed[1]))
+    return {
+        "version": PRD_AST_VERSION,
+        "size": index["size"],
+        "hash": index["hash"],
+        "sections": document_sections(data),
+        "stories": stories,
+    }
+
+
+def _story_progress(story: dict) -> list:
+    done = sum(1 for c in story["criteria"] if c[1] in "xX")
+    return [story["id"], story["title"], story["status"], len(story["criteria"]), done]
+
+
+def _write_prd_ast(ast_path: Path, ast: dict) -> None:
+    header = {k: v for k, v in ast.items() if k not in ("stories", "progress")}
+    rows = [[s["start"], s["end"], s["hash"], s["sections"], s["criteria"]] for s in ast["stories"]]
+    lines = [json.dumps(header, separators=(",", ":")), json.dumps(ast["progress"], separators=(",", ":")),
+             json.dumps(rows, separators=(",", ":"))]
+
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+    tmp = ast_path.with_name(f"{ast_path.name}.tmp.{os.getpid()}")
+    try:
+        with _span("write"):
+            tmp.write_bytes(payload)
+            os.replace(tmp, ast_path)
+        _io(written=len(payload))
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def load_prd_ast(prd_path, progress_only: bool = False) -> dict:
+    """
+    Load the cached AST of a PRD, rebuilding it if the PRD changed.
+
+    A cache whose size and mtime match the PRD is used without reading the
+    PRD at all (unless it was built within MTIME_GRANULARITY_NS of that
+    mtime). Otherwise the PRD is re-indexed and only story blocks whose
+    content hash changed are parsed again.
+
+    The cache holds a JSON header line (document sections and criteria
+    totals), a line of per-story progress rows and a line of parsed story
+    blocks, so progress_only=True skips the largest part.
+
+    Args:
+        prd_path: Path to PRD file
+        progress_only: Return the header and "progress" rows
+            ([id, title, status, criteria_total, criteria_done]) only
+
+    Returns:
+        The AST dict (see build_prd_ast), with "progress" rows added
+    """
+    prd_path = Path(prd_path)
+    ast_path = prd_ast_path(prd_path)
+    st = prd_path.stat()
+
+    reuse = None
+    try:
+        with open(ast_path, "r", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") == PRD_AST_VERSION:
+                fresh = (header.get("size") == st.st_size and header.get("mtime_ns") == st.st_mtime_ns and
+                         header.get("checked_ns", 0) - st.st_mtime_ns > MTIME_GRANULARITY_NS)
+                with _span("read"):
+                    progress = json.loads(f.readline())
+                    if fresh and progress_only:
+                        header["progress"] = progress
+                        return header
+                    rows = json.loads(f.readline())
+                if fresh:
+                    header["progress"] = progress
+                    header["stories"] = [
+                        dict(zip(("id", "title", "status"), p[:3]), start=r[0], end=r[1], hash=r[2],
+                             sections=r[3], criteria=r[4])
+                        for p, r in zip(progress, rows)
+                    ]
+                    return header
+                reuse = {r[2]: (r[3], r[4]) for r in rows}
+    except (OSError, ValueError, AttributeError, TypeError, IndexError):
+        reuse = None
+
+    index, data = load_story_index(prd_path)
+    with _span("parse"):
+        ast = build_prd_ast(data, index, reuse)
+    ast["mtime_ns"] = st.st_mtime_ns
+    ast["checked_ns"] = time.time_ns()
+    ast["progress"] = [_story_progress(s) for s in ast["stories"]]
+    ast["criteria_total"] = sum(p[3] for p in ast["progress"])
+    ast["criteria_done"] = sum(p[4] for p in ast["progress"])
+    _write_prd_ast(ast_path, ast)
+    return ast
+
+
+def _fraction(done: int, total: int) -> float:
+    return round(done / total, 4) if total else 0.0
+
+
+def progress(prd_path: str) -> None:
+    """
+    Print per-story and overall completion from the cached PRD AST.
+
+    A story's fraction is its share of checked checkbox items; a story
+    without any counts as 0 or 1 by its header checkbox. The overall
+    fraction is the mean over stories.
+
+    Args:
+        prd_path: Path to PRD file
+
+    Prints:
+        {"total", "done", "criteria_total", "criteria_done", "fraction", "stories": [...]}
+    """
+    ast = load_prd_ast(prd_path, progress_only=True)
+    stories = []
+    for story_id, title, status, total, done in ast["progress"]:
+        closed = status.strip().lower() == "x"
+        stories.append({
+            "id": story_id,
+            "title": title,
+            "done": closed,
+            "criteria_total": total,
+            "criteria_done": done,
+            "fraction": _fraction(done, total) if total else float(closed),
+        })
+    print(json.dumps({
+        "total": len(stories),
+        "done": sum(1 for s in stories if s["done"]),
+        "criteria_total": ast["criteria_total"],
+        "criteria_done": ast["criteria_done"],
+        "fraction": round(sum(s["fraction"] for s in stories) / len(stories), 4) if stories else 0.0,
+        "stories": stories,
+    }, indent=2))
+
+
+def prd_ast(prd_path: str) -> None:
+    """
+    Print the cached PRD AST with absolute byte offsets.
+
+    Args:
+        prd_path: Path to PRD file
+
+    Prints:
+        {"size", "hash", "sections": [...], "stories": [{id, title, status,
+        start, end, sections: [{level, title, start}], criteria: [{offset,
+        done, text}]}]}
+    """
+    ast = load_prd_ast(prd_path)
+    print(json.dumps({
+        "size": ast["size"],
+        "hash": ast["hash"],
+        "sections": ast["sections"],
+        "stories": [
+            {
+                "id": s["id"],
+                "title": s["title"],
+                "status": s["status"],
+                "start": s["start"],
+                "end": s["end"],
+                "sections": [{"level": lv, "title": t, "start": s["start"] + off} for lv, t, off in s["sections"]],
+                "criteria": [{"offset": s["start"] + off, "done": state in "xX", "text": t}
+                             for off, state, t in s["criteria"]],
+            }
+            for s in ast["stories"]
+        ],
+    }, indent=2))
+
+
+def _parse_options(args: tuple, defaults: dict) -> dict:
+    """Parse "--name value" pairs into a copy of defaults (names use dashes)."""
+    opts = dict(defaults)
+    args = list(args)
+    while args:
+        flag = args.pop(0)
+        key = flag[2:].replace("-", "_") if flag.startswith("--") else ""
+        if key not in opts or not args:
+            raise UsageError(f"Unknown or incomplete option: {flag}")
+        opts[key] = args.pop(0)
+    return opts
+
+
+def claims_dir(prd_path) -> Path:
+    """Return the directory holding story claim files for a PRD."""
+    return Path(prd_path).parent / ".claims"
+
+
+def _read_claim(path: Path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_claim_file(path: Path, claim: dict, exclusive: bool) -> bool:
+    """
+    Publish a claim file with its contents in one step.
+
+    The claim is written to a temp file first, then linked into place
+    (exclusive, fails if a claim exists) or renamed over the old claim,
+    so readers never see an empty or partial claim.
+
+    Returns:
+        True if the claim was written
+    """
+    tmp = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+    tmp.write_text(json.dumps(claim) + "\n")
+    try:
+        if exclusive:
+            os.link(tmp, path)
+        else:
+            os.replace(tmp, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class _ClaimsLock:
+    """flock on .claims/.lock serializing every change to an existing claim."""
+
+    def __init__(self, cdir: Path):
+        self.path = cdir / ".lock"
+
+    def __enter__(self):
+        import fcntl
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        return False
+
+
+def _swap_claim(path: Path, claim: dict, lease: float, now: float):
+    """
+    Compare-and-swap a claim: renew it if it is ours, take it if it expired.
+
+    Runs under the claims lock, which renewals, breaks and releases all
+    take, so the claim checked here is the one replaced. A claim that
+    cannot be read is treated as live until `lease` seconds after it was
+    last written.
+
+    Returns:
+        "held" (renewed), "fresh" (taken) or None (claimed by another worker)
+    """
+    with _ClaimsLock(path.parent):
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return "fresh" if _write_claim_file(path, claim, exclusive=True) else None
+        existing = _read_claim(path)
+        if existing is None:
+            if mtime + lease > now:
+                return None
+        elif existing.get("worker") == claim["worker"]:
+            _write_claim_file(path, dict(existing, expires_at=claim["expires_at"]), exclusive=False)
+            return "held"
+        elif existing.get("expires_at", 0) > now:
+            return None
+        _write_claim_file(path, claim, exclusive=False)
+        return "fresh"
+
+
+def claim_stories(prd_path: str, *options) -> None:
+    """
+    Atomically claim up to N ready stories for a parallel worker.
+
+    Each claim is a .claims/<story-id>.claim file linked into place
+    exclusively with its contents, so workers never block each other and
+    never receive the same story. Claims carry a lease; renewing or taking
+    over an expired claim is a compare-and-swap under .claims/.lock. Stories this
+    worker already holds are returned first with their lease renewed.
+    Candidates are the dependency-ready stories in critical-path order.
+
+    Options:
+        --count N         Maximum stories to claim (default 1)
+        --worker ID       Worker identity (default: pid)
+        --lease SECONDS   Lease length (default $RALPH_TIMEOUT_ITERATION or 5400)
+        --block-dir DIR   Write each claimed story block to DIR/<id>.md
+
+    Prints:
+        {"ok", "worker", "claimed": [{id, title, expires_at, block_path?}], "ready"}
+    """
+    opts = _parse_options(options, {
+        "count": "1",
+        "worker": str(os.getpid()),
+        "lease": os.environ.get("RALPH_TIMEOUT_ITERATION", "5400"),
+        "block_dir": "",
+    })
+    count = int(opts["count"])
+    lease = float(opts["lease"])
+    worker = opts["worker"]
+
+    index, data = load_story_index(prd_path)
+    ready = story_graph(index["stories"])["ready"]
+    by_id = {s["id"]: s for s in index["stories"]}
+
+    cdir = claims_dir(prd_path)
+    cdir.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    claim = {"worker": worker, "claimed_at": now, "expires_at": now + lease}
+
+    held, fresh = [], []
+    for entry in ready:
+        if len(held) + len(fresh) >= count:
+            break
+        path = cdir / f"{entry['id']}.claim"
+        if _write_claim_file(path, claim, exclusive=True):
+            fresh.append(entry)
+            continue
+        outcome = _swap_claim(path, claim, lease, now)
+        if outcome == "held":
+            held.append(entry)
+        elif outcome == "fresh":
+            fresh.append(entry)
+
+    claimed = []
+    for entry in held + fresh:
+        item = {"id": entry["id"], "title": entry["title"], "expires_at": claim["expires_at"]}
+        if opts["block_dir"]:
+            block_path = Path(opts["block_dir"]) / f"{entry['id']}.md"
+            block_path.parent.mkdir(parents=True, exist_ok=True)
+            block_path.write_text(story_block_text(data, by_id[entry["id"]]))
+            item["block_path"] = str(block_path)
+        claimed.append(item)
+
+    print(json.dumps({"ok": True, "worker": worker, "claimed": claimed, "ready": len(ready)}, indent=2))
+
+
+def release_claim(prd_path: str, story_id: str, worker: str = "") -> None:
+    """
+    Release a story claim (only the owning worker's, when worker is given).
+
+    Args:
+        prd_path: Path to PRD file
+        story_id: Claimed story id
+        worker: Optional worker identity that must own the claim
+
+    Prints:
+        "released" or "not-held"
+    """
+    path = claims_dir(prd_path) / f"{story_id}.claim"
+    if not path.parent.is_dir():
+        print("not-held")
+        return
+    with _ClaimsLock(path.parent):
+        existing = _read_claim(path)
+        if existing is None or (worker and existing.get("worker") != worker):
+            print("not-held")
+            return
+        path.unlink()
+    print("released")
+
+
+def summarize_prd(prd_path: str) -> dict:
+    """
+    Summarize one PRD from its story index: totals and the next open story.
+
+    Args:
+        prd_path: Path to PRD file
+
+    Returns:
+        Dict with path, ok, total, remaining and next ({id, title} or None)
+    """
+    try:
+        index, _ = load_story_index(prd_path, summary_only=True)
+    except OSError as e:
+        return {"path": str(prd_path), "ok": False, "error": str(e)}
+    nxt = index.get("next")
+    return {
+        "path": str(prd_path),
+        "ok": index["total"] > 0,
+        "total": index["total"],
+        "remaining": index["remaining"],
+        "next": {"id": nxt["id"], "title": nxt["title"]} if nxt else None,
+    }
+
+
+def find_prd_files(ralph_dir: str = ".ralph") -> list:
+    """
+    Find the prd.md of every PRD-N (and legacy prd-N) folder, in PRD number order.
+
+    Args:
+        ralph_dir: Path to the .ralph directory
+
+    Returns:
+        List of (folder name, prd path) tuples
+    """
+    root = Path(ralph_dir)
+    found = []
+    for folder in list(root.glob("PRD-*")) + list(root.glob("prd-*")):
+        prd = folder / "prd.md"
+        if folder.is_dir() and prd.is_file():
+            num = folder.name.split("-", 1)[1]
+            found.append((int(num) if num.isdigit() else float("inf"), folder.name, prd))
+    found.sort(key=lambda f: (f[0], f[1]))
+    return [(name, prd) for _, name, prd in found]
+
+
+def scan_all(ralph_dir: str = ".ralph", workers: str = "") -> None:
+    """
+    Summarize every PRD under a .ralph directory in one JSON document.
+
+    PRDs are summarized in a process pool sized to the CPU count (or
+    --workers), each reusing its cached story index.
+
+    Args:
+        ralph_dir: Path to the .ralph directory
+        workers: Optional worker count (defaults to os.cpu_count())
+
+    Prints:
+        {"ok", "prds": [{prd, path, ok, total, remaining, next}], "total", "remaining"}
+    """
+    prds = find_prd_files(ralph_dir)
+    max_workers = int(workers) if workers else (os.cpu_count() or 1)
+    max_workers = max(1, min(max_workers, len(prds)))
+
+    paths = [str(prd) for _, prd in prds]
+    if max_workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            summaries = list(pool.map(summarize_prd, paths, chunksize=max(1, len(paths) // (max_workers * 4))))
+    else:
+        summaries = [summarize_prd(p) for p in paths]
+
+    for (name, _), summary in zip(prds, summaries):
+        summary["prd"] = name
+
+    print(json.dumps({
+        "ok": True,
+        "prds": [dict(prd=s.pop("prd"), **s) for s in summaries],
+        "total": sum(s.get("total", 0) for s in summaries),
+        "remaining": sum(s.get("remaining", 0) for s in summaries),
+    }, indent=2))
+
+
+# Story id range for query --ids: "US-040..US-090", "US-040..", "..US-090" or one id
+ID_RANGE = re.compile(r'^(?:US-)?(\d+)?(\.\.)?(?:US-)?(\d+)?$', re.IGNORECASE)
+
+
+def _id_range(spec: str) -> tuple:
+    m = ID_RANGE.match(spec.strip())
+    if not spec.strip() or m is None or (m.group(2) is None and m.group(3) is not None):
+        raise UsageError(f"Invalid id range: {spec} (expected e.g. US-040..US-090)")
+    low = int(m.group(1)) if m.group(1) else 0
+    if m.group(2) is None:
+        return low, low
+    return low, int(m.group(3)) if m.group(3) else float("inf")
+
+
+def _select_prds(ralph_dir: str, selection: str) -> list:
+    # Comma-separated PRD numbers, folder names or prd.md paths; empty for all
+    prds = find_prd_files(ralph_dir)
+    if not selection:
+        return prds
+    chosen = []
+    for item in (i.strip() for i in selection.split(",")):
+        if not item:
+            continue
+        if item.endswith(".md") or "/" in item:
+            chosen.append((Path(item).parent.name, Path(item)))
+            continue
+        name = f"PRD-{item}" if item.isdigit() else item
+        matches = [p for p in prds if p[0].lower() == name.lower()]
+        if not matches:
+            raise UsageError(f"Unknown PRD: {item}")
+        chosen.extend(matches)
+    return chosen
+
+
+def query(*options) -> None:
+    """
+    Stream the stories matching a set of filters as NDJSON.
+
+    Stories come from each PRD's cached story index, so PRDs are not
+    re-parsed unless they changed. Rows are flushed after every PRD, so
+    consumers see results while later PRDs are still being read.
+
+    Options:
+        --ralph-dir DIR   .ralph directory to search (default .ralph)
+        --prd LIST        Comma-separated PRD numbers, folders or prd.md paths (default all)
+        --status S        open, done or any (default any)
+        --ids RANGE       Story id or range, e.g. US-040..US-090, US-040.. or ..US-090
+        --title REGEX     Case-insensitive regex searched in the title
+        --has-deps B      yes, no or any (default any)
+
+    Prints:
+        One {"prd", "path", "id", "title", "status", "done", "deps", "start", "end"}
+        object per line
+    """
+    opts = _parse_options(options, {"ralph_dir": ".ralph", "prd": "", "status": "any",
+                                    "ids": "", "title": "", "has_deps": "any"})
+    if opts["status"] not in ("open", "done", "any"):
+        raise UsageError(f"Invalid --status: {opts['status']} (expected open, done or any)")
+    if opts["has_deps"] not in ("yes", "no", "any"):
+        raise UsageError(f"Invalid --has-deps: {opts['has_deps']} (expected yes, no or any)")
+    low, high = _id_range(opts["ids"]) if opts["ids"] else (0, float("inf"))
+    try:
+        title = re.compile(opts["title"], re.IGNORECASE) if opts["title"] else None
+    except re.error as e:
+        raise UsageError(f"Invalid --title regex: {e}")
+
+    for name, prd in _select_prds(opts["ralph_dir"], opts["prd"]):
+        try:
+            index, _ = load_story_index(prd)
+        except OSError as e:
+            print(f"Warning: cannot read {prd}: {e}", file=sys.stderr)
+            continue
+        rows = []
+        for story in index["stories"]:
+            done = is_done(story)
+            if opts["status"] != "any" and done != (opts["status"] == "done"):
+                continue
+            if opts["has_deps"] != "any" and bool(story["deps"]) != (opts["has_deps"] == "yes"):
+                continue
+            if not low <= int(story["id"][3:]) <= high:
+                continue
+            if title is not None and not title.search(story["title"]):
+                continue
+            rows.append(json.dumps({
+                "prd": name,
+                "path": str(prd),
+                "id": story["id"],
+                "title": story["title"],
+                "status": story["status"],
+                "done": done,
+                "deps": story["deps"],
+                "start": story["start"],
+                "end": story["end"],
+            }, separators=(",", ":")) + "\n")
+        sys.stdout.writelines(rows)
+        sys.stdout.flush()
+
+
+def remaining_stories(meta_file: str) -> None:
+    """
+    Get the count of remaining stories from a metadata file.
+
+    Args:
+        meta_file: Path to story metadata JSON file
+
+    Prints:
+        The remaining story count
+    """
+    data = json.loads(Path(meta_file).read_text())
+    print(data.get("remaining", "unknown"))
+
+
+def story_field(meta_file: str, field: str) -> None:
+    """
+    Get a specific field from a story metadata file.
+
+    Args:
+        meta_file: Path to story metadata JSON file
+        field: Name of the field to extract
+
+    Prints:
+        The field value or empty string if not found
+    """
+    data = json.loads(Path(meta_file).read_text())
+    print(data.get(field, ""))
+
+
+def activity_summary_path(activity_log_path: str) -> Path:
+    """Return the append-only run summary sidecar of an activity log."""
+    return Path(f"{activity_log_path}.summary")
+
+
+# Live logs are locked the way lib/state (BuildStateManager) locks them: a
+# <log>.lock directory holding a JSON pid file, stale once its holder has
+# died or after LOG_LOCK_STALE_S. RALPH_LOG_LOCK_WAIT overrides how long to
+# wait for it
+LOG_LOCK_WAIT_S = float(os.environ.get("RALPH_LOG_LOCK_WAIT", "30"))
+LOG_LOCK_STALE_S = 300.0
+
+
+class _LogLock:
+    """
+    mkdir lock on <log>.lock, shared with every writer of a live log.
+
+    `acquired` is False if the lock could not be taken within
+    LOG_LOCK_WAIT_S; callers then skip their rewrite.
+    """
+
+    def __init__(self, log_path):
+        self.dir = Path(f"{log_path}.lock")
+        self.acquired = False
+
+    def _stale(self) -> bool:
+        try:
+            info = json.loads((self.dir / "pid").read_text())
+            if time.time() - info.get("timestamp", 0) / 1000 > LOG_LOCK_STALE_S:
+                return True
+            os.kill(int(info["pid"]), 0)
+            return False
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # No pid file yet: stale only if the holder never wrote one
+            try:
+                return time.time() - self.dir.stat().st_mtime > 5
+            except OSError:
+                return False
+
+    def __enter__(self):
+        import shutil
+
+        deadline = time.monotonic() + LOG_LOCK_WAIT_S
+        while True:
+            try:
+                self.dir.mkdir()
+                break
+            except FileExistsError:
+                if self._stale():
+                    shutil.rmtree(self.dir, ignore_errors=True)
+                    continue
+                if time.monotonic() > deadline:
+                    return self
+                time.sleep(0.05)
+            except OSError:
+                return self
+        (self.dir / "pid").write_text(json.dumps({
+            "pid": os.getpid(),
+            "lockId": f"{os.getpid()}-prd-parser",
+            "hostname": os.uname().nodename,
+            "timestamp": int(time.time() * 1000),
+        }))
+        self.acquired = True
+        return self
+
+    def __exit__(self, *exc):
+        import shutil
+
+        if self.acquired:
+            shutil.rmtree(self.dir, ignore_errors=True)
+        return False
+
+
+def _merge_run_summaries(text: str, entries: list) -> str:
+    # Same result as inserting each entry after "## Run Summary" in turn:
+    # newest first, creating the header structure if it doesn't exist
+    bullets = [f"- {entry}" for entry in reversed(entries)]
+    lines = text.splitlines()
+    for i, l in enumerate(lines):
+        if l.strip() == "## Run Summary":
+            out = lines[:i + 1] + bullets + lines[i + 1:]
+            break
+    else:
+        out = ["# Activity Log", "", "## Run Summary"] + bullets + ["", "## Events", ""] + lines
+    return "\n".join(out).rstrip() + "\n"
+
+
+def _run_summary_parts(activity_log_path: str) -> list:
+    # Leftovers of interrupted merges (oldest first), then the live sidecar
+    sidecar = activity_summary_path(activity_log_path)
+    parts = sorted(sidecar.parent.glob(f"{sidecar.name}.merging.*"), key=lambda p: p.stat().st_mtime_ns)
+    return parts + ([sidecar] if sidecar.exists() else [])
+
+
+def _read_run_summaries(parts: list) -> list:
+    entries = []
+    for part in parts:
+        with open(part, encoding="utf-8") as f:
+            entries.extend(l.rstrip("\n") for l in f if l.strip())
+    return entries
+
+
+def append_run_summary(activity_log_path: str, line: str) -> None:
+    """
+    Append a run summary line to the activity log.
+
+    The line goes into an append-only sidecar (<activity_log>.summary) with
+    a single write and is then folded into the log, since readers of
+    activity.log (lib/state, the UI) do not know about the sidecar. If the
+    log's writer lock is busy the line stays in the sidecar until the next
+    append or materialize_activity_log (loop.sh runs it on exit);
+    activity_log prints the merged view meanwhile.
+
+    Args:
+        activity_log_path: Path to activity log file
+        line: The summary line to append
+    """
+    record = (" ".join(line.splitlines()) + "\n").encode("utf-8")
+    with _span("write"):
+        fd = os.open(activity_summary_path(activity_log_path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            _io(written=os.write(fd, record))
+        finally:
+            os.close(fd)
+
+        materialize_activity_log(activity_log_path)
+
+
+def materialize_activity_log(activity_log_path: str) -> None:
+    """
+    Fold pending run summaries from the sidecar into the activity log.
+
+    The sidecar is renamed aside first, so summaries appended meanwhile go
+    to a fresh sidecar and are picked up next time. Leftovers of an
+    interrupted merge are folded in too. The log is rewritten under its
+    writer lock; if that is busy the summaries stay pending.
+
+    Args:
+        activity_log_path: Path to activity log file
+    """
+    with _LogLock(activity_log_path) as lock:
+        if lock.acquired:
+            _materialize_locked(activity_log_path)
+
+
+def _materialize_locked(activity_log_path: str) -> None:
+    sidecar = activity_summary_path(activity_log_path)
+    try:
+        os.rename(sidecar, sidecar.with_name(f"{sidecar.name}.merging.{os.getpid()}"))
+    except OSError:
+        pass
+
+    parts = [p for p in _run_summary_parts(activity_log_path) if p != sidecar]
+    entries = _read_run_summaries(parts)
+    if entries:
+        path = Path(activity_log_path)
+        tmp = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+        if not _stream_run_summaries(path, tmp, entries):
+            tmp.write_text(_merge_run_summaries(path.read_text(), entries))
+        os.replace(tmp, path)
+    for part in parts:
+        part.unlink()
+
+
+def _stream_run_summaries(path: Path, tmp: Path, entries: list) -> bool:
+    """
+    Write `path` with entries merged in to `tmp` without loading the log.
+
+    Lines up to "## Run Summary" are copied, the new bullets written, and
+    the rest block-copied, then trailing whitespace is trimmed as
+    _merge_run_summaries does. Returns False, having written nothing
+    useful, when the log has no run summary header.
+    """
+    import shutil
+
+    bullets = "".join(f"- {entry}\n" for entry in reversed(entries)).encode("utf-8")
+    with open(path, "rb") as src, open(tmp, "w+b") as dst:
+        for line in src:
+            dst.write(line)
+            if line.strip() == b"## Run Summary":
+                break
+        else:
+            return False
+        if not line.endswith(b"\n"):
+            dst.write(b"\n")
+        dst.write(bullets)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        # Trim trailing whitespace to a single newline
+        end = dst.tell()
+        dst.seek(max(0, end - 4096))
+        tail = dst.read()
+        dst.seek(end - len(tail))
+        dst.write(tail.rstrip() + b"\n")
+        dst.truncate()
+    return True
+
+
+def activity_log(activity_log_path: str) -> None:
+    """
+    Print the activity log with pending run summaries merged in.
+
+    Args:
+        activity_log_path: Path to activity log file
+    """
+    text = Path(activity_log_path).read_text()
+    entries = _read_run_summaries(_run_summary_parts(activity_log_path))
+    sys.stdout.write(_merge_run_summaries(text, entries) if entries else text)
+
+
+# Log rotation: sealed segments of activity.log/errors.log live gzipped in
+# <prd_folder>/logs/ with an index of their time ranges and entry counts
+ROTATED_LOGS = ("activity.log", "errors.log")
+LOG_SEGMENT_BYTES = 1024 * 1024
+LOG_INDEX_VERSION = 1
+# Newest run summaries kept in the live activity log after rotation
+KEEP_RUN_SUMMARIES = 20
+
+# Timestamped log entries: "[YYYY-MM-DD HH:MM:SS] event" and
+# "- YYYY-MM-DD HH:MM:SS | run summary"; other lines continue the entry above
+LOG_ENTRY = re.compile(r'(?:\[|- )(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})[\] ]')
+
+
+def log_archive_dir(prd_folder: str) -> Path:
+    """Return the directory holding sealed log segments of a PRD folder."""
+    return Path(prd_folder) / "logs"
+
+
+def load_log_index(prd_folder: str) -> dict:
+    """Load the segment index of a PRD folder, empty when missing."""
+    try:
+        index = json.loads((log_archive_dir(prd_folder) / "index.json").read_text())
+        if index.get("version") == LOG_INDEX_VERSION:
+            return index
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {"version": LOG_INDEX_VERSION, "segments": []}
+
+
+def _write_log_index(prd_folder: str, index: dict) -> None:
+    path = log_archive_dir(prd_folder) / "index.json"
+    tmp = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+    tmp.write_text(json.dumps(index, indent=2) + "\n")
+    os.replace(tmp, path)
+
+
+def _split_for_rotation(lines: list) -> tuple:
+    """
+    Split log lines into (kept, sealed).
+
+    Everything from the first timestamped entry on is sealed, except that in
+    an activity log only the events section is: the header structure and
+    the newest KEEP_RUN_SUMMARIES run summaries stay in place.
+    """
+    events_at = next((i for i, l in enumerate(lines) if l.strip() == "## Events"), None)
+    if events_at is None:
+        first = next((i for i, l in enumerate(lines) if LOG_ENTRY.match(l)), len(lines))
+        return lines[:first], lines[first:]
+
+    kept, sealed = [], []
+    summaries = 0
+    for l in lines[:events_at + 1]:
+        if LOG_ENTRY.match(l) and l.startswith("- "):
+            summaries += 1
+            if summaries > KEEP_RUN_SUMMARIES:
+                sealed.append(l)
+                continue
+        kept.append(l)
+    kept.append("\n")
+    events = lines[events_at + 1:]
+    while events and not events[0].strip():
+        events.pop(0)
+    return kept, sealed + events
+
+
+def _seal_segment(prd_folder: str, log_name: str, sealed: list, index: dict) -> dict:
+    import gzip
+
+    stamps = [m.group(1) for m in map(LOG_ENTRY.match, sealed) if m]
+    seq = 1 + max((s["seq"] for s in index["segments"] if s["log"] == log_name), default=0)
+    name = f"{Path(log_name).stem}-{seq:06d}.log.gz"
+    data = "".join(sealed).encode("utf-8")
+    with gzip.open(log_archive_dir(prd_folder) / name, "wb", compresslevel=6) as f:
+        f.write(data)
+    return {
+        "log": log_name,
+        "seq": seq,
+        "file": name,
+        "first": min(stamps) if stamps else "",
+        "last": max(stamps) if stamps else "",
+        "entries": len(stamps),
+        "bytes": len(data),
+    }
+
+
+def rotate_log(prd_folder: str, log_name: str, max_bytes: int, max_age: int) -> dict:
+    """
+    Seal a log's older entries into a compressed segment if it is due.
+
+    A log is due when it is larger than max_bytes or (with max_age > 0) its
+    oldest entry is older than max_age seconds. Rotation runs under the
+    log's writer lock and decides from the log as read after taking it. The
+    live log is replaced before index.json, so a crash in between leaves an
+    unindexed segment rather than entries that are in neither place. Should
+    a writer that skips the lock append meanwhile, the segment is dropped and
+    the rotation retried.
+
+    Returns:
+        The new segment's index entry, or None if nothing was rotated
+    """
+    path = Path(prd_folder) / log_name
+    # Cheap exit for the common case, re-checked under the lock
+    try:
+        if not max_age and path.stat().st_size <= max_bytes:
+            return None
+    except OSError:
+        return None
+    with _LogLock(path) as lock:
+        if not lock.acquired:
+            return None
+        if log_name == "activity.log" and path.exists():
+            _materialize_locked(str(path))
+
+        for _ in range(3):
+            try:
+                before = path.stat()
+            except OSError:
+                return None
+            lines = path.read_text(encoding="utf-8", errors="replace").splitlines(keepends=True)
+            kept, sealed = _split_for_rotation(lines)
+            stamps = sorted(m.group(1) for m in map(LOG_ENTRY.match, sealed) if m)
+            too_old = bool(max_age and stamps and
+                           time.mktime(time.strptime(stamps[0], "%Y-%m-%d %H:%M:%S")) < time.time() - max_age)
+            if not sealed or (before.st_size <= max_bytes and not too_old):
+                return None
+
+            log_archive_dir(prd_folder).mkdir(parents=True, exist_ok=True)
+            index = load_log_index(prd_folder)
+            segment = _seal_segment(prd_folder, log_name, sealed, index)
+            tmp = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+            tmp.write_text("".join(kept), encoding="utf-8")
+            after = path.stat()
+            if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+                tmp.unlink()
+                (log_archive_dir(prd_folder) / segment["file"]).unlink()
+                continue
+
+            os.replace(tmp, path)
+            segment["sealed_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            index["segments"].append(segment)
+            _write_log_index(prd_folder, index)
+            return segment
+    return None
+
+
+def rotate_logs(prd_folder: str, *options) -> None:
+    """
+    Rotate a PRD folder's activity.log and errors.log into sealed segments.
+
+    Options:
+        --max-bytes N      Rotate logs larger than N bytes (default 1MB)
+        --max-age SECONDS  Also rotate logs whose oldest entry is older (default off)
+
+    Prints:
+        JSON {"rotated": [segment index entries]}
+    """
+    opts = _parse_options(options, {"max_bytes": str(LOG_SEGMENT_BYTES), "max_age": "0"})
+    rotated = []
+    for log_name in ROTATED_LOGS:
+        segment = rotate_log(prd_folder, log_name, int(opts["max_bytes"]), int(opts["max_age"]))
+        if segment:
+            rotated.append(segment)
+    print(json.dumps({"rotated": rotated}, indent=2))
+
+
+def _entries_in_range(lines, since: str, until: str):
+    # Yield timestamped entries (with continuation lines) inside [since, until];
+    # both bounds are timestamp prefixes, so "2026-01-16" covers the whole day
+    # (blank lines and headings end an entry)
+    keep = False
+    for l in lines:
+        m = LOG_ENTRY.match(l)
+        if m:
+            stamp = m.group(1)
+            keep = (not since or stamp >= since) and (not until or stamp[:len(until)] <= until)
+        elif not l.strip() or l.startswith("#"):
+            keep = False
+        if keep:
+            yield l if l.endswith("\n") else l + "\n"
+
+
+def log_query(prd_folder: str, log_name: str, *options) -> None:
+    """
+    Print a log's entries within a time range, sealed segments included.
+
+    Only segments whose recorded time range overlaps the query are
+    decompressed; the live log is read last.
+
+    Options:
+        --since TS   Earliest timestamp or prefix (e.g. 2026-01-16 or "2026-01-16 10:00")
+        --until TS   Latest timestamp or prefix, inclusive
+    """
+    import gzip
+
+    opts = _parse_options(options, {"since": "", "until": ""})
+    since, until = opts["since"], opts["until"]
+    for segment in load_log_index(prd_folder)["segments"]:
+        if segment["log"] != log_name:
+            continue
+        if segment["entries"] and ((since and segment["last"] < since) or
+                                   (until and segment["first"][:len(until)] > until)):
+            continue
+        with gzip.open(log_archive_dir(prd_folder) / segment["file"], "rt", encoding="utf-8") as f:
+            sys.stdout.writelines(_entries_in_range(f, since, until))
+
+    path = Path(prd_folder) / log_name
+    if path.exists():
+        with open(path, encoding="utf-8", errors="replace") as f:
+            sys.stdout.writelines(_entries_in_range(f, since, until))
+
+
+def profile_report(source: str, command: str = "") -> None:
+    """
+    Print per-command percentiles of RALPH_PROFILE records as JSON.
+
+    Args:
+        source: Profile file, or a PRD folder holding .profile.jsonl
+        command: Only report this command
+    """
+    print(json.dumps(_profile_module().report(source, command), indent=2))
+
+
+def batch(manifest_path: str) -> None:
+    """
+    Run a manifest of operations in one process and print all results.
+
+    The manifest (a file, or "-" for stdin) is either a JSON document
+    {"vars": {...}, "ops": [...]} / a JSON array of ops, or NDJSON with one
+    op per line. Each op is {"id": ..., "command": <name>, "args": [...]}
+    ("method"/"params" are accepted too). An argument of "@vars" is replaced
+    by the manifest's shared vars, so render operations need no vars file.
+    Operations run in order and later ones see earlier ones' files; a
+    failing op is reported and the rest still run.
+
+    Args:
+        manifest_path: Path to the manifest, or "-" for stdin
+
+    Prints:
+        {"ok": bool, "results": [{"id", "command", "ok", "output", "value" | "error"}]}
+    """
+    raw = sys.stdin.read() if manifest_path == "-" else Path(manifest_path).read_text()
+
+    shared_vars = {}
+    try:
+        doc = json.loads(raw)
+        if isinstance(doc, dict) and "ops" in doc:
+            shared_vars = doc.get("vars") or {}
+            ops = doc["ops"] or []
+        elif isinstance(doc, dict):
+            ops = [doc]
+        else:
+            ops = doc
+    except json.JSONDecodeError:
+        ops = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    results = []
+    for i, op in enumerate(ops):
+        command = op.get("command") or op.get("method") or ""
+        args = [shared_vars if a == "@vars" else a for a in (op.get("args") or op.get("params") or [])]
+        result = {"id": op.get("id", i), "command": command}
+        try:
+            output, value = run_captured(command, args)
+            result.update({"ok": True, "output": output, "value": value})
+        except Exception as e:
+            message = str(e) if isinstance(e, UsageError) else f"{type(e).__name__}: {e}"
+            result.update({"ok": False, "error": message})
+        results.append(result)
+
+    print(json.dumps({"ok": all(r["ok"] for r in results), "results": results}, indent=2))
+
+
+# Command table shared by the CLI dispatcher and the serve loop.
+# Each entry maps a command name to (handler, required_args, usage).
+COMMANDS = {
+    "render_prompt": (
+        render_prompt, 3,
+        "render_prompt <src> <dst> <vars_file> [story_meta] [story_block]",
+    ),
+    "render_retry_prompt": (
+        render_retry_prompt, 3,
+        "render_retry_prompt <src> <dst> <vars_file> [story_meta] [story_block] [failure_context] [retry_attempt] [retry_max]",
+    ),
+    "classify_failure": (
+        classify_failure_log, 1,
+        "classify_failure <log_file>",
+    ),
+    "retry_outcome": (
+        retry_outcome, 3,
+        "retry_outcome <prd_path> <story_id> <success|failure>",
+    ),
+    "failure_context": (
+        failure_context, 1,
+        "failure_context <log_file> [budget_bytes]",
+    ),
+    "select_story": (
+        select_story, 3,
+        "select_story <prd_path> <meta_out> <block_out>",
+    ),
+    "story_index": (
+        story_index, 1,
+        "story_index <prd_path>",
+    ),
+    "complete_story": (
+        complete_story, 2,
+        "complete_story <prd_path> <story_id>",
+    ),
+    "ready_stories": (
+        ready_stories, 1,
+        "ready_stories <prd_path>",
+    ),
+    "progress": (
+        progress, 1,
+        "progress <prd_path>",
+    ),
+    "prd_ast": (
+        prd_ast, 1,
+        "prd_ast <prd_path>",
+    ),
+    "claim_stories": (
+        claim_stories, 1,
+        "claim_stories <prd_path> [--count N] [--worker ID] [--lease SECONDS] [--block-dir DIR]",
+    ),
+    "release_claim": (
+        release_claim, 2,
+        "release_claim <prd_path> <story_id> [worker]",
+    ),
+    "scan_all": (
+        scan_all, 0,
+        "scan_all [ralph_dir] [workers]",
+    ),
+    "query": (
+        query, 0,
+        "query [--ralph-dir DIR] [--prd LIST] [--status open|done|any] [--ids US-N..US-M] [--title REGEX] [--has-deps yes|no|any]",
+    ),
+    "batch": (
+        batch, 1,
+        "batch <manifest_file|->",
+    ),
+    "remaining_stories": (
+        remaining_stories, 1,
+        "remaining_stories <meta_file>",
+    ),
+    "story_field": (
+        story_field, 2,
+        "story_field <meta_file> <field>",
+    ),
+    "append_run_summary": (
+        append_run_summary, 2,
+        "append_run_summary <activity_log_path> <line>",
+    ),
+    "materialize_activity_log": (
+        materialize_activity_log, 1,
+        "materialize_activity_log <activity_log_path>",
+    ),
+    "activity_log": (
+        activity_log, 1,
+        "activity_log <activity_log_path>",
+    ),
+    "rotate_logs": (
+        rotate_logs, 1,
+        "rotate_logs <prd_folder> [--max-bytes N] [--max-age SECONDS]",
+    ),
+    "log_query": (
+        log_query, 2,
+        "log_query <prd_folder> <log_name> [--since TS] [--until TS]",
+    ),
+    "profile_report": (
+        profile_report, 1,
+        "profile_report <profile.jsonl|prd_folder> [command]",
+    ),
+}
+
+
+class UsageError(Exception):
+    """Raised when a command is unknown or called with too few arguments."""
+
+
+def dispatch(command: str, args: list):
+    """
+    Run a command from the COMMANDS table with positional string arguments.
+
+    Args:
+        command: Command name
+        args: Positional arguments, required ones first, then any optional ones
+
+    Returns:
+        Whatever the command handler returns
+
+    Raises:
+        UsageError: If the command is unknown or gets too few or too many args
+    """
+    if command not in COMMANDS:
+        raise UsageError(f"Unknown command: {command}")
+    handler, required, usage = COMMANDS[command]
+    if len(args) < required or len(args) > _max_args(handler):
+        raise UsageError(f"Usage: {usage}")
+    args = [a if isinstance(a, dict) else str(a) for a in args]
+    if PROFILER is None and os.environ.get("RALPH_PROFILE"):
+        return _profiled(command, handler, args)
+    return handler(*args)
+
+
+def _max_args(handler) -> float:
+    """Most positional args a handler takes (inf for *args), checked before the call."""
+    code = handler.__code__
+    if code.co_flags & 0x04:  # CO_VARARGS
+        return float("inf")
+    return code.co_argcount
+
+
+def _profile_module():
+    # ralph_profile.py sits next to this script, which is not a package
+    try:
+        import ralph_profile
+    except ImportError:
+        sys.path.insert(0, str(Path(__file__).resolve().parent))
+        import ralph_profile
+    return ralph_profile
+
+
+def _profiled(command: str, handler, args: list):
+    """
+    Run a handler under a profiler and append its record.
+
+    Commands nested in this one (batch operations) count towards the same
+    record. The import span is only reported by the first command of a
+    process, since later ones in serve mode do not pay it.
+    """
+    global PROFILER, _IMPORT_SECONDS
+    PROFILER = _profile_module().Profiler("prd-parser", command, args, _IMPORT_SECONDS)
+    _IMPORT_SECONDS = None
+    ok = False
+    try:
+        result = handler(*args)
+        ok = True
+        return result
+    finally:
+        PROFILER.finish(ok)
+        PROFILER = None
+
+
+def run_captured(command: str, args: list) -> tuple:
+    """
+    Run a command, capturing anything it prints.
+
+    Returns:
+        Tuple of (captured stdout, handler return value)
+
+    Raises:
+        UsageError: If the command is unknown or required args are missing
+    """
+    import io
+    from contextlib import redirect_stdout
+
+    buf = io.StringIO()
+    with redirect_stdout(buf):
+        value = dispatch(command, args)
+    return buf.getvalue(), value
+
+
+def handle_request(line: str, stdin_requests: bool = False) -> dict:
+    """
+    Handle one line-delimited JSON-RPC request for serve mode.
+
+    The request is {"id": ..., "method": <command>, "params": [args...]}.
+    Anything a command prints is captured and returned as result.output,
+    so callers get the same text the CLI would have written to stdout.
+
+    Args:
+        line: Raw request line
+        stdin_requests: Requests arrive on stdin, so commands must not read it
+
+    Returns:
+        JSON-RPC response object
+    """
+    try:
+        req = json.loads(line)
+    except json.JSONDecodeError as e:
+        return {"jsonrpc": "2.0", "id": None,
+                "error": {"code": -32700, "message": f"Parse error: {e}"}}
+
+    req_id = req.get("id")
+    method = req.get("method", "")
+    params = req.get("params") or []
+
+    if method == "ping":
+        return {"jsonrpc": "2.0", "id": req_id, "result": {"output": "pong\n", "value": None}}
+
+    if stdin_requests and method == "batch" and params[:1] == ["-"]:
+        return {"jsonrpc": "2.0", "id": req_id,
+                "error": {"code": -32602, "message": "batch - would read the request stream; pass a manifest file"}}
+
+    try:
+        output, value = run_captured(method, params)
+    except UsageError as e:
+        code = -32601 if method not in COMMANDS else -32602
+        return {"jsonrpc": "2.0", "id": req_id, "error": {"code": code, "message": str(e)}}
+    except Exception as e:
+        return {"jsonrpc": "2.0", "id": req_id,
+                "error": {"code": -32000, "message": f"{type(e).__name__}: {e}"}}
+
+    return {"jsonrpc": "2.0", "id": req_id,
+            "result": {"output": output, "value": value}}
+
+
+def _request_method(line: str):
+    """Return the method of a raw request line, or None if it is malformed."""
+    try:
+        return json.loads(line).get("method")
+    except (json.JSONDecodeError, AttributeError):
+        return None
+
+
+def encode_response(resp: dict, frames: bool = False) -> bytes:
+    """
+    Encode a serve response as a JSON line or, with frames, as a
+    "<ok|error> <byte length>" line followed by the output or error message.
+    """
+    if not frames:
+        return (json.dumps(resp) + "\n").encode("utf-8")
+    if "error" in resp:
+        status, body = "error", resp["error"]["message"]
+    else:
+        status, body = "ok", resp["result"]["output"]
+    data = body.encode("utf-8")
+    return f"{status} {len(data)}\n".encode("ascii") + data
+
+
+def serve(socket_path: str = "", frames: bool = False) -> None:
+    """
+    Run as a long-lived helper, answering line-delimited JSON-RPC requests.
+
+    Without a socket path, requests are read from stdin and responses written
+    to stdout, one JSON object per line (suitable for a bash coproc). With a
+    socket path, a Unix domain socket is bound there and each connection is
+    served the same protocol. A request with method "shutdown" stops the
+    server.
+
+    Args:
+        socket_path: Optional Unix socket path to listen on
+        frames: Write length-prefixed frames instead of JSON responses
+    """
+    if not socket_path:
+        out = sys.stdout.buffer
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            if _request_method(line) == "shutdown":
+                break
+            out.write(encode_response(handle_request(line, stdin_requests=True), frames))
+            out.flush()
+        return
+
+    import socketserver
+    import threading
+
+    # redirect_stdout is process-global, so requests run one at a time
+    lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                line = raw.decode("utf-8", errors="replace")
+                if not line.strip():
+                    continue
+                if _request_method(line) == "shutdown":
+                    self.wfile.write(b'{"jsonrpc": "2.0", "id": null, "result": {"output": "", "value": null}}\n')
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                    return
+                with lock:
+                    resp = handle_request(line)
+                self.wfile.write(encode_response(resp, frames))
+                self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with Server(socket_path, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            try:
+                os.unlink(socket_path)
+            except OSError:
+                pass
+
+
+# inotify(7) masks: prd.md written or replaced in a PRD folder, PRD folders
+# created or removed under .ralph
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+# Quiet period to coalesce the several events one editor save produces
+WATCH_SETTLE_SECONDS = 0.05
+WATCH_POLL_SECONDS = 1.0
+
+
+class Inotify:
+    """Minimal ctypes binding for Linux inotify; raises OSError where unavailable."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self._init = libc.inotify_init1
+            self._add = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+        self._errno = ctypes.get_errno
+        self.fd = self._init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._errno(), "inotify_init1 failed")
+        self.dirs = {}
+
+    def watch(self, directory) -> None:
+        wd = self._add(self.fd, os.fsencode(str(directory)), WATCH_MASK)
+        if wd < 0:
+            raise OSError(self._errno(), f"cannot watch {directory}")
+        self.dirs[wd] = Path(directory)
+
+    def read(self) -> list:
+        """Return pending events as (directory, name, mask) tuples."""
+        import struct
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + 16 <= len(buf):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", buf, pos)
+            name = os.fsdecode(buf[pos + 16:pos + 16 + length].rstrip(b"\0"))
+            pos += 16 + length
+            events.append((self.dirs.get(wd), name, mask))
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def _story_event(event: str, name: str, prd: str, story: dict, **extra) -> dict:
+    return dict({"event": event, "prd": name, "path": prd, "id": story["id"],
+                 "title": story["title"], "status": story["status"], "done": is_done(story)}, **extra)
+
+
+class PrdWatcher:
+    """Tracks the stories of every PRD under a .ralph directory and diffs them on change."""
+
+    def __init__(self, ralph_dir: str):
+        self.ralph_dir = Path(ralph_dir)
+        self.names = {}
+        self.stories = {}
+        self.stats = {}
+
+    def _stat(self, prd: str):
+        try:
+            st = os.stat(prd)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def refresh(self, name: str, prd: str) -> list:
+        """
+        Re-index one PRD and return its change events.
+
+        The cached story index is updated incrementally by load_story_index,
+        so only the story blocks that changed are re-parsed.
+        """
+        self.stats[prd] = self._stat(prd)
+        try:
+            index, _ = load_story_index(prd)
+            stories = {s["id"]: dict(s) for s in index["stories"]}
+        except OSError:
+            index = None
+            stories = {}
+        old = self.stories.get(prd, {})
+
+        events = []
+        for story_id, story in stories.items():
+            before = old.get(story_id)
+            if before is None:
+                events.append(_story_event("story_added", name, prd, story))
+            elif is_done(before) != is_done(story):
+                events.append(_story_event("status_changed", name, prd, story, previous=before["status"]))
+            elif before["hash"] != story["hash"] or before["title"] != story["title"]:
+                events.append(_story_event("story_changed", name, prd, story))
+        for story_id, before in old.items():
+            if story_id not in stories:
+                events.append(_story_event("story_removed", name, prd, before))
+
+        if index is None:
+            self.names.pop(prd, None)
+            self.stories.pop(prd, None)
+            self.stats.pop(prd, None)
+        else:
+            self.names[prd] = name
+            self.stories[prd] = stories
+        if events:
+            events.append(self._summary(name, prd, index))
+        return events
+
+    def _summary(self, name: str, prd: str, index) -> dict:
+        if index is None:
+            return {"event": "prd_updated", "prd": name, "path": prd, "total": 0, "remaining": 0, "next": None}
+        nxt = index.get("next")
+        return {"event": "prd_updated", "prd": name, "path": prd, "total": index["total"],
+                "remaining": index["remaining"], "next": nxt["id"] if nxt else None}
+
+    def rescan(self, only_changed: bool = False) -> list:
+        """Refresh every PRD (or those whose stat changed) and drop vanished ones."""
+        events = []
+        seen = set()
+        for name, prd in find_prd_files(str(self.ralph_dir)):
+            prd = str(prd)
+            seen.add(prd)
+            if not only_changed or self._stat(prd) != self.stats.get(prd):
+                events.extend(self.refresh(name, prd))
+        for prd in [p for p in self.stories if p not in seen]:
+            events.extend(self.refresh(self.names[prd], prd))
+        return events
+
+    def snapshot(self) -> dict:
+        prds = []
+        for prd, stories in self.stories.items():
+            remaining = sum(1 for s in stories.values() if not is_done(s))
+            prds.append({"prd": self.names[prd], "path": prd, "total": len(stories), "remaining": remaining})
+        return {"event": "ready", "prds": prds}
+
+
+def watch(*options) -> None:
+    """
+    Keep every PRD's story index current and publish change events.
+
+    Watches .ralph/PRD-*/prd.md with inotify (or stat polling where inotify
+    is unavailable, or with --poll). On change the PRD's cached story index
+    is updated incrementally and the differences are published as NDJSON
+    on a Unix socket; every subscriber first receives a "ready" snapshot.
+
+    Events:
+        story_added, story_removed, story_changed   {prd, path, id, title, status, done}
+        status_changed                              same, plus previous status
+        prd_updated                                 {prd, path, total, remaining, next}
+
+    Options:
+        --ralph-dir DIR     .ralph directory to watch (default .ralph)
+        --socket PATH       Socket to publish on (default <ralph-dir>/.watch.sock),
+                            or - to write events to stdout
+        --poll              Use stat polling even where inotify is available
+        --interval SECONDS  Poll interval (default 1)
+        --max-events N      Exit after publishing N change events
+    """
+    args = list(options)
+    force_poll = "--poll" in args
+    if force_poll:
+        args.remove("--poll")
+    opts = _parse_options(tuple(args), {"ralph_dir": ".ralph", "socket": "", "interval": "",
+                                        "max_events": ""})
+    interval = float(opts["interval"]) if opts["interval"] else WATCH_POLL_SECONDS
+    max_events = int(opts["max_events"]) if opts["max_events"] else 0
+    socket_path = opts["socket"] or str(Path(opts["ralph_dir"]) / ".watch.sock")
+
+    import selectors
+    import signal
+    import socket
+
+    # Exit through the finally block below so the socket is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    watcher = PrdWatcher(opts["ralph_dir"])
+    notify = None
+    if not force_poll:
+        try:
+            notify = Inotify()
+            notify.watch(watcher.ralph_dir)
+        except OSError:
+            if notify is not None:
+                notify.close()
+            notify = None
+    watcher.rescan()
+    if notify is not None:
+        for prd in watcher.stories:
+            notify.watch(Path(prd).parent)
+
+    sel = selectors.DefaultSelector()
+    subscribers = []
+    server = None
+    if socket_path != "-":
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen()
+        server.setblocking(False)
+        sel.register(server, selectors.EVENT_READ, "accept")
+    if notify is not None:
+        sel.register(notify.fd, selectors.EVENT_READ, "inotify")
+
+    def send(conn, event) -> bool:
+        try:
+            conn.sendall((json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8"))
+            return True
+        except OSError:
+            return False
+
+    def publish(events) -> None:
+        if socket_path == "-":
+            for event in events:
+                sys.stdout.write(json.dumps(event, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+            return
+        for conn in list(subscribers):
+            if not all(send(conn, e) for e in events):
+                subscribers.remove(conn)
+                sel.unregister(conn)
+                conn.close()
+
+    if socket_path == "-":
+        publish([watcher.snapshot()])
+
+    published = 0
+    try:
+        while not max_events or published < max_events:
+            events = []
+            for key, _ in sel.select(None if notify is not None else interval):
+                if key.data == "accept":
+                    conn, _ = server.accept()
+                    conn.setblocking(True)
+                    if send(conn, watcher.snapshot()):
+                        subscribers.append(conn)
+                        sel.register(conn, selectors.EVENT_READ, "subscriber")
+                    else:
+                        conn.close()
+                elif key.data == "subscriber":
+                    # Subscribers only listen; readable means they hung up
+                    try:
+                        gone = not key.fileobj.recv(4096)
+                    except OSError:
+                        gone = True
+                    if gone:
+                        subscribers.remove(key.fileobj)
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                elif key.data == "inotify":
+                    pending = notify.read()
+                    while True:
+                        time.sleep(WATCH_SETTLE_SECONDS)
+                        more = notify.read()
+                        if not more:
+                            break
+                        pending.extend(more)
+                    changed = {}
+                    rescan = False
+                    for directory, name, mask in pending:
+                        if mask & IN_Q_OVERFLOW or directory is None:
+                            rescan = True
+                        elif directory == watcher.ralph_dir:
+                            if mask & (IN_CREATE | IN_MOVED_TO) and (directory / name).is_dir():
+                                notify.watch(directory / name)
+                            rescan = True
+                        elif name == "prd.md" or mask & IN_DELETE_SELF:
+                            changed[str(directory / "prd.md")] = directory.name
+                    if rescan:
+                        events.extend(watcher.rescan(only_changed=True))
+                    for prd, name in changed.items():
+                        if prd in watcher.stories or os.path.isfile(prd):
+                            events.extend(watcher.refresh(name, prd))
+            if notify is None:
+                events.extend(watcher.rescan(only_changed=True))
+            if max_events:
+                events = events[:max_events - published]
+            if events:
+                publish(events)
+                published += len(events)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for conn in subscribers:
+            conn.close()
+        if server is not None:
+            server.close()
+            try:
+                os.unlink(socket_path)
+            except OSError:
+                pass
+        if notify is not None:
+            notify.close()
+
+
+def main():
+    """Main entry point for CLI usage."""
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "serve":
+        # serve [--socket <path>] [--frames]
+        args = sys.argv[2:]
+        frames = "--frames" in args
+        if frames:
+            args.remove("--frames")
+        socket_path = ""
+        if len(args) > 1 and args[0] == "--socket":
+            socket_path = args[1]
+        serve(socket_path, frames)
+        return
+
+    if command == "watch":
+        try:
+            watch(*sys.argv[2:])
+        except UsageError as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if command not in COMMANDS:
+        print(f"Unknown command: {command}", file=sys.stderr)
+        print(__doc__)
+        sys.exit(1)
+
+    try:
+        dispatch(command, sys.argv[2:])
+    except UsageError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    except PrdEditError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+_IMPORT_SECONDS = time.perf_counter() - _STARTED
+
+
+if __name__ == "__main__":
+    main()
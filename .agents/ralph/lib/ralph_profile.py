@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Opt-in timing instrumentation for Ralph's Python helpers.
+
+prd-parser.py and run-meta-writer.py import this module only when
+RALPH_PROFILE is set. Each command invocation then appends one NDJSON
+record with its span durations (import, read, parse, substitute, write),
+bytes read and written, and peak RSS.
+
+RALPH_PROFILE values:
+    1, true, yes, on   Append to .profile.jsonl in the PRD-N folder the
+                       command works on (found from its path arguments),
+                       or to .ralph/.profile.jsonl when there is none
+    <path>             Append to this file
+
+Usage:
+    python3 ralph_profile.py report <profile.jsonl|prd_folder> [command]
+"""
+
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+PRD_FOLDER = re.compile(r"PRD-\d+", re.I)
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """Collects spans and I/O counts for one command invocation."""
+
+    def __init__(self, tool: str, command: str, args: list, import_seconds: float = None):
+        self.tool = tool
+        self.command = command
+        self.args = args
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        if import_seconds is not None:
+            self.add("import", import_seconds)
+
+    def span(self, name: str) -> _Span:
+        """Context manager timing one span; repeated spans accumulate."""
+        return _Span(self, name)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def count(self, read: int = 0, written: int = 0) -> None:
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def record(self, ok: bool) -> dict:
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "tool": self.tool,
+            "command": self.command,
+            "ok": ok,
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "spans": {k: round(v * 1000, 3) for k, v in self.spans.items()},
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            # ru_maxrss is KB on Linux and bytes on macOS
+            "max_rss_kb": rss // 1024 if sys.platform == "darwin" else rss,
+            "pid": os.getpid(),
+        }
+
+    def finish(self, ok: bool = True) -> None:
+        """Append this invocation's record; failures to write are ignored."""
+        line = json.dumps(self.record(ok), separators=(",", ":")) + "\n"
+        path = profile_path(self.args)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+def _prd_folder(arg) -> Path:
+    if isinstance(arg, dict):
+        arg = arg.get("PRD_PATH", "")
+    if not isinstance(arg, str) or os.sep not in arg:
+        return None
+    path = Path(arg)
+    for candidate in (path, *path.parents):
+        if PRD_FOLDER.fullmatch(candidate.name):
+            return candidate
+    return None
+
+
+def profile_path(args: list) -> Path:
+    """Return the profile file for a command invoked with `args`."""
+    setting = os.environ.get("RALPH_PROFILE", "")
+    if setting.lower() not in ("1", "true", "yes", "on"):
+        return Path(setting)
+    for arg in args:
+        folder = _prd_folder(arg)
+        if folder is not None:
+            return folder / ".profile.jsonl"
+    return Path(".ralph") / ".profile.jsonl"
+
+
+def _percentile(values: list, pct: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return round(ordered[int(rank) - 1], 3)
+
+
+def _summary(values: list) -> dict:
+    return {"p50": _percentile(values, 50), "p95": _percentile(values, 95), "max": round(max(values), 3)}
+
+
+def report(source: str, command: str = "") -> dict:
+    """
+    Aggregate profile records into per-command percentiles.
+
+    Args:
+        source: Profile file, or a PRD folder holding .profile.jsonl
+        command: Only report this command
+
+    Returns:
+        {"commands": [{tool, command, count, failed, total_ms, spans,
+        bytes_read, bytes_written, max_rss_kb}]}, slowest p95 first
+    """
+    path = Path(source)
+    if path.is_dir():
+        path = path / ".profile.jsonl"
+
+    groups = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if command and rec.get("command") != command:
+                continue
+            groups.setdefault((rec.get("tool", ""), rec.get("command", "")), []).append(rec)
+
+    commands = []
+    for (tool, name), records in groups.items():
+        span_names = sorted({s for r in records for s in r.get("spans", {})})
+        commands.append({
+            "tool": tool,
+            "command": name,
+            "count": len(records),
+            "failed": sum(1 for r in records if not r.get("ok", True)),
+            "total_ms": _summary([r["total_ms"] for r in records]),
+            "spans": {s: _summary([r["spans"].get(s, 0.0) for r in records]) for s in span_names},
+            "bytes_read": _summary([r.get("bytes_read", 0) for r in records]),
+            "bytes_written": _summary([r.get("bytes_written", 0) for r in records]),
+            "max_rss_kb": _summary([r.get("max_rss_kb", 0) for r in records]),
+        })
+    commands.sort(key=lambda c: c["total_ms"]["p95"], reverse=True)
+    return {"commands": commands}
+
+
+def main():
+    """Main entry point for CLI usage."""
+    if len(sys.argv) < 3 or sys.argv[1] != "report":
+        print(__doc__)
+        sys.exit(1)
+    try:
+        result = report(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "")
+    except OSError as e:
+        print(f"Error: cannot read profile: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1226 @@
+#!/usr/bin/env python3
+"""
+Run metadata writer - generates markdown summaries for Ralph build runs.
+
+Usage:
+    python3 run-meta-writer.py <json_file> <output_file>
+    python3 run-meta-writer.py finalize <output_file> [--config <config.sh>] < run.json
+    python3 run-meta-writer.py backfill [ralph_dir] [--workers N] [--config <config.sh>] [--restart]
+    python3 run-meta-writer.py rollup [prd_folder|ralph_dir] [--rebuild]
+
+Where json_file contains all the run metadata as a JSON object.
+
+Each run is also upserted into runs.db, a SQLite database (WAL mode) in the
+PRD folder holding the runs/ directory, with typed columns for queries, and
+its JSON is kept beside the summary (run-X.md -> run-X.json).
+
+finalize reads the run JSON from stdin, computes the actual cost from the
+pricing table (defaults plus config.sh overrides), writes the markdown with
+the cost included and prints the token fields as shell assignments for eval:
+input_tokens, output_tokens, routed_model, token_model and actual_cost.
+
+backfill re-renders every runs/run-*.md under ralph_dir in a process pool,
+from run-X.json where present or else from the parsed markdown, rewriting
+only summaries whose rendering changed. It is resumable: finished runs are
+journaled in ralph_dir/.backfill-journal until the backfill completes.
+
+Every upsert also updates .rollup.json in the PRD folder and in the .ralph
+directory: run totals by status, model and agent, token, cost, retry and
+switch sums, and the running mean and variance of the token estimate error.
+Updates apply only the changed rows, so rollup reads one small file however
+many runs there are; --rebuild recomputes it from runs.db.
+
+Set RALPH_PROFILE=1 to append a timing record to the PRD folder's
+.profile.jsonl (see ralph_profile.py).
+"""
+
+# Taken before the other imports so the profiler's import span covers them
+import time
+_STARTED = time.perf_counter()
+
+import io
+import json
+import os
+import re
+import sys
+
+
+# Pricing per 1M tokens (USD), mirroring DEFAULT_PRICING in lib/tokens/calculator.js;
+# unknown models are priced as "default"
+DEFAULT_PRICING = {
+    "opus": {"input": 15.0, "output": 75.0},
+    "sonnet": {"input": 3.0, "output": 15.0},
+    "haiku": {"input": 0.25, "output": 1.25},
+    "default": {"input": 3.0, "output": 15.0},
+    "codex": {"input": 0.0, "output": 0.0},
+    "droid": {"input": 0.0, "output": 0.0},
+}
+
+# config.sh pricing overrides: (variable, model, field)
+PRICING_OVERRIDES = (
+    ("CLAUDE_PRICING_INPUT", "default", "input"),
+    ("CLAUDE_PRICING_OUTPUT", "default", "output"),
+    ("CLAUDE_OPUS_INPUT", "opus", "input"),
+    ("CLAUDE_OPUS_OUTPUT", "opus", "output"),
+    ("CLAUDE_SONNET_INPUT", "sonnet", "input"),
+    ("CLAUDE_SONNET_OUTPUT", "sonnet", "output"),
+    ("CLAUDE_HAIKU_INPUT", "haiku", "input"),
+    ("CLAUDE_HAIKU_OUTPUT", "haiku", "output"),
+)
+
+# Fields finalize prints as shell assignments
+FINALIZE_FIELDS = ("input_tokens", "output_tokens", "routed_model", "token_model", "actual_cost")
+
+RUN_STORE_VERSION = 2
+RUN_STORE_NAME = "runs.db"
+
+# Typed columns of the runs table; "run" (the summary file stem) is the key
+RUN_STORE_COLUMNS = (
+    ("run", "TEXT PRIMARY KEY"),
+    ("run_id", "TEXT"),
+    ("iteration", "INTEGER"),
+    ("mode", "TEXT"),
+    ("story_id", "TEXT"),
+    ("story_title", "TEXT"),
+    ("status", "TEXT"),
+    ("started", "TEXT"),
+    ("ended", "TEXT"),
+    ("duration_s", "REAL"),
+    ("input_tokens", "INTEGER"),
+    ("output_tokens", "INTEGER"),
+    ("total_tokens", "INTEGER"),
+    ("token_model", "TEXT"),
+    ("token_estimated", "INTEGER"),
+    ("agent", "TEXT"),
+    ("actual_cost", "REAL"),
+    ("iteration_cost", "REAL"),
+    ("retry_count", "INTEGER"),
+    ("retry_time_s", "REAL"),
+    ("switch_count", "INTEGER"),
+    ("switch_from", "TEXT"),
+    ("switch_to", "TEXT"),
+    ("switch_reason", "TEXT"),
+    ("routed_model", "TEXT"),
+    ("complexity_score", "REAL"),
+    ("routing_reason", "TEXT"),
+    ("est_cost", "REAL"),
+    ("est_tokens", "INTEGER"),
+    ("token_variance_pct", "REAL"),
+    ("head_before", "TEXT"),
+    ("head_after", "TEXT"),
+    ("log_file", "TEXT"),
+    ("summary_path", "TEXT"),
+)
+
+
+def format_commits(commit_list: str) -> str:
+    """Format commit list for markdown."""
+    if not commit_list or commit_list.strip() == "":
+        return "- (none)"
+    return commit_list
+
+
+def format_files(files: str) -> str:
+    """Format file list for markdown."""
+    if not files or files.strip() == "":
+        return "- (none)"
+    return files
+
+
+def format_dirty_files(files: str) -> str:
+    """Format uncommitted changes for markdown."""
+    if not files or files.strip() == "":
+        return "- (clean)"
+    return files
+
+
+def is_valid_value(value: object) -> bool:
+    """Check if a value is valid (not None, not "null", not empty)."""
+    return value is not None and value != "null" and value != ""
+
+
+def load_pricing(config_path: str = "") -> dict:
+    """
+    Return the pricing table with any config.sh overrides applied.
+
+    Not cached: each finalize is its own process, so a cache would never be
+    hit there, and backfill loads the table once for all its runs.
+
+    Args:
+        config_path: Path to config.sh (optional)
+
+    Returns:
+        Dict of model -> {"input", "output"} USD per 1M tokens
+    """
+    pricing = {model: dict(rates) for model, rates in DEFAULT_PRICING.items()}
+    if config_path:
+        try:
+            with open(config_path, encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            text = ""
+        for var, model, field in PRICING_OVERRIDES:
+            match = re.search(rf'^{var}\s*=\s*"?([0-9.]+)"?', text, re.M)
+            if match:
+                try:
+                    pricing[model][field] = float(match.group(1))
+                except ValueError:
+                    pass
+    return pricing
+
+
+def calculate_actual_cost(data: dict, pricing: dict):
+    """
+    Compute a run's actual cost from its token counts and model.
+
+    Args:
+        data: Run metadata with input_tokens, output_tokens and routed_model or token_model
+        pricing: Table from load_pricing()
+
+    Returns:
+        Cost in USD rounded to 6 decimals, or None without tokens or a model
+    """
+    routed_model = data.get('routed_model')
+    cost_model = routed_model if is_valid_value(routed_model) else data.get('token_model')
+    if not is_valid_value(cost_model):
+        return None
+    try:
+        input_tokens = int(data.get('input_tokens'))
+        output_tokens = int(data.get('output_tokens'))
+    except (ValueError, TypeError):
+        return None
+    rates = pricing.get(str(cost_model).lower(), pricing["default"])
+    return round(input_tokens / 1_000_000 * rates["input"] + output_tokens / 1_000_000 * rates["output"], 6)
+
+
+def format_cost_value(cost: float) -> str:
+    """Format a cost without trailing zeros (0.0105, 0), as calculator.js prints it."""
+    return f"{cost:.6f}".rstrip("0").rstrip(".")
+
+
+def write_run_metadata(data: dict, output_path: str) -> None:
+    """
+    Write run metadata to markdown file.
+
+    Args:
+        data: Dictionary containing all run metadata
+        output_path: Path to write the markdown file
+    """
+    with open(output_path, 'w') as f:
+        f.write(render_run_metadata(data))
+
+
+def render_run_metadata(data: dict) -> str:
+    """
+    Render run metadata as a markdown summary.
+
+    Args:
+        data: Dictionary containing all run metadata
+
+    Returns:
+        Markdown text
+    """
+    f = io.StringIO()
+
+    # Header
+    f.write("# Ralph Run Summary\n\n")
+
+    # Basic info
+    f.write(f"- Run ID: {data.get('run_id', '')}\n")
+    f.write(f"- Iteration: {data.get('iteration', '')}\n")
+    f.write(f"- Mode: {data.get('mode', '')}\n")
+
+    story_id = data.get('story_id', '')
+    if story_id:
+        story_title = data.get('story_title', '')
+        f.write(f"- Story: {story_id}: {story_title}\n")
+
+    f.write(f"- Started: {data.get('started', '')}\n")
+    f.write(f"- Ended: {data.get('ended', '')}\n")
+    f.write(f"- Duration: {data.get('duration', '')}s\n")
+    f.write(f"- Status: {data.get('status', '')}\n")
+    f.write(f"- Log: {data.get('log_file', '')}\n\n")
+
+    # Git section
+    f.write("## Git\n")
+    head_before = data.get('head_before', 'unknown')
+    head_after = data.get('head_after', 'unknown')
+    f.write(f"- Head (before): {head_before}\n")
+    f.write(f"- Head (after): {head_after}\n\n")
+
+    f.write("### Commits\n")
+    f.write(format_commits(data.get('commit_list', '')) + "\n\n")
+
+    f.write("### Changed Files (commits)\n")
+    f.write(format_files(data.get('changed_files', '')) + "\n\n")
+
+    f.write("### Uncommitted Changes\n")
+    f.write(format_dirty_files(data.get('dirty_files', '')) + "\n\n")
+
+    # Token usage
+    f.write("## Token Usage\n")
+    input_tokens = data.get('input_tokens')
+    output_tokens = data.get('output_tokens')
+
+    if is_valid_value(input_tokens):
+        f.write(f"- Input tokens: {input_tokens}\n")
+    else:
+        f.write("- Input tokens: (unavailable)\n")
+
+    if is_valid_value(output_tokens):
+        f.write(f"- Output tokens: {output_tokens}\n")
+    else:
+        f.write("- Output tokens: (unavailable)\n")
+
+    # Prefer routed_model over token_model
+    routed_model = data.get('routed_model')
+    token_model = data.get('token_model')
+    display_model = routed_model if is_valid_value(routed_model) else token_model
+
+    if is_valid_value(display_model):
+        f.write(f"- Model: {display_model}\n")
+
+    token_estimated = data.get('token_estimated', 'false')
+    f.write(f"- Estimated: {token_estimated}\n")
+
+    if is_valid_value(input_tokens) and is_valid_value(output_tokens):
+        try:
+            total = int(input_tokens) + int(output_tokens)
+            f.write(f"- Total tokens: {total}\n")
+        except (ValueError, TypeError):
+            pass
+
+    f.write("\n")
+
+    # Retry statistics
+    f.write("## Retry Statistics\n")
+    retry_count = int(data.get('retry_count', 0))
+    if retry_count > 0:
+        retry_time = data.get('retry_time', 0)
+        f.write(f"- Retry count: {retry_count}\n")
+        f.write(f"- Total retry wait time: {retry_time}s\n")
+    else:
+        f.write("- Retry count: 0 (succeeded on first attempt)\n")
+    f.write("\n")
+
+    # Agent switches
+    f.write("## Agent Switches\n")
+    switch_count = int(data.get('switch_count', 0))
+    if switch_count > 0:
+        f.write(f"- Switch count: {switch_count}\n")
+        f.write(f"- From: {data.get('switch_from', '')}\n")
+        f.write(f"- To: {data.get('switch_to', '')}\n")
+        f.write(f"- Reason: {data.get('switch_reason', '')}\n")
+    else:
+        f.write("- Switch count: 0 (no agent switches)\n")
+    f.write("\n")
+
+    # Routing decision
+    f.write("## Routing Decision\n")
+    if is_valid_value(routed_model):
+        f.write(f"- Model: {routed_model}\n")
+        complexity_score = data.get('complexity_score')
+        if is_valid_value(complexity_score) and complexity_score != 'n/a':
+            f.write(f"- Complexity score: {complexity_score}/10\n")
+        routing_reason = data.get('routing_reason')
+        if is_valid_value(routing_reason) and routing_reason != 'n/a':
+            f.write(f"- Reason: {routing_reason}\n")
+    else:
+        f.write("- Model: (not routed)\n")
+    f.write("\n")
+
+    # Cost estimate vs actual
+    f.write("## Cost Estimate vs Actual\n")
+    est_cost = data.get('est_cost')
+    est_tokens = data.get('est_tokens')
+
+    if is_valid_value(est_cost) and est_cost not in ('n/a', 'null'):
+        f.write("### Pre-execution Estimate\n")
+        f.write(f"- Estimated cost: ${est_cost}\n")
+        if is_valid_value(est_tokens):
+            f.write(f"- Estimated tokens: {est_tokens}\n")
+    else:
+        f.write("### Pre-execution Estimate\n")
+        f.write("- (estimate unavailable)\n")
+    f.write("\n")
+
+    # Actual usage
+    f.write("### Actual Usage\n")
+    if is_valid_value(input_tokens) and is_valid_value(output_tokens):
+        try:
+            actual_total = int(input_tokens) + int(output_tokens)
+            f.write(f"- Actual tokens: {actual_total} (input: {input_tokens}, output: {output_tokens})\n")
+
+            # Calculate actual cost if model available
+            cost_model = routed_model if is_valid_value(routed_model) else token_model
+            if is_valid_value(cost_model):
+                # Note: Actual cost calculation is done in bash since it requires the routing lib
+                # This placeholder allows bash to optionally append the cost
+                actual_cost = data.get('actual_cost')
+                if is_valid_value(actual_cost):
+                    f.write(f"- Actual cost: ${actual_cost}\n")
+        except (ValueError, TypeError):
+            f.write("- (actual usage unavailable)\n")
+    else:
+        f.write("- (actual usage unavailable)\n")
+    f.write("\n")
+
+    # Estimate accuracy
+    f.write("### Estimate Accuracy\n")
+    if is_valid_value(est_tokens) and is_valid_value(input_tokens) and is_valid_value(output_tokens):
+        try:
+            est_tok = int(est_tokens)
+            actual_total = int(input_tokens) + int(output_tokens)
+            if est_tok > 0:
+                variance_pct = round(((actual_total - est_tok) / est_tok) * 100, 1)
+                f.write(f"- Token variance: {variance_pct}% (estimated: {est_tok}, actual: {actual_total})\n")
+            else:
+                f.write("- (variance not available)\n")
+        except (ValueError, TypeError, ZeroDivisionError):
+            f.write("- (variance not available)\n")
+    else:
+        f.write("- (variance not available)\n")
+    f.write("\n")
+    return f.getvalue()
+
+
+def run_store_path(output_path: str) -> str:
+    """Return runs.db for a summary path: beside runs/ when it sits in one."""
+    runs_dir = os.path.dirname(os.path.abspath(output_path))
+    if os.path.basename(runs_dir) == "runs":
+        runs_dir = os.path.dirname(runs_dir)
+    return os.path.join(runs_dir, RUN_STORE_NAME)
+
+
+def _number(value: object, kind=float):
+    if not is_valid_value(value) or value == "n/a":
+        return None
+    try:
+        return kind(float(value)) if kind is int else kind(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def _text(value: object):
+    return str(value) if is_valid_value(value) else None
+
+
+def run_record(data: dict, output_path: str) -> dict:
+    """
+    Convert run metadata into a row of typed runs-table columns.
+
+    Args:
+        data: Dictionary containing all run metadata
+        output_path: Path of the markdown summary
+
+    Returns:
+        Dict keyed by RUN_STORE_COLUMNS names; unparseable values become None
+    """
+    input_tokens = _number(data.get('input_tokens'), int)
+    output_tokens = _number(data.get('output_tokens'), int)
+    total_tokens = input_tokens + output_tokens if input_tokens is not None and output_tokens is not None else None
+    est_tokens = _number(data.get('est_tokens'), int)
+    variance = None
+    if est_tokens and total_tokens is not None:
+        variance = round(((total_tokens - est_tokens) / est_tokens) * 100, 1)
+    estimated = data.get('token_estimated')
+
+    return {
+        "run": os.path.splitext(os.path.basename(output_path))[0],
+        "run_id": _text(data.get('run_id')),
+        "iteration": _number(data.get('iteration'), int),
+        "mode": _text(data.get('mode')),
+        "story_id": _text(data.get('story_id')),
+        "story_title": _text(data.get('story_title')),
+        "status": _text(data.get('status')),
+        "started": _text(data.get('started')),
+        "ended": _text(data.get('ended')),
+        "duration_s": _number(data.get('duration')),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": total_tokens,
+        "token_model": _text(data.get('token_model')),
+        "agent": _text(data.get('agent')),
+        "token_estimated": None if estimated is None else int(str(estimated).lower() == "true"),
+        "actual_cost": _number(data.get('actual_cost')),
+        "iteration_cost": _number(data.get('iteration_cost')),
+        "retry_count": _number(data.get('retry_count'), int),
+        "retry_time_s": _number(data.get('retry_time')),
+        "switch_count": _number(data.get('switch_count'), int),
+        "switch_from": _text(data.get('switch_from')),
+        "switch_to": _text(data.get('switch_to')),
+        "switch_reason": _text(data.get('switch_reason')),
+        "routed_model": _text(data.get('routed_model')),
+        "complexity_score": _number(data.get('complexity_score')),
+        "routing_reason": _text(data.get('routing_reason')),
+        "est_cost": _number(data.get('est_cost')),
+        "est_tokens": est_tokens,
+        "token_variance_pct": variance,
+        "head_before": _text(data.get('head_before')),
+        "head_after": _text(data.get('head_after')),
+        "log_file": _text(data.get('log_file')),
+        "summary_path": os.path.relpath(os.path.abspath(output_path), os.path.dirname(run_store_path(output_path))),
+    }
+
+
+def open_run_store(db_path: str):
+    """
+    Open (creating if needed) a runs.db in WAL mode with the current schema.
+
+    Returns:
+        sqlite3.Connection
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(db_path, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != RUN_STORE_VERSION:
+        columns = ", ".join(f"{name} {kind}" for name, kind in RUN_STORE_COLUMNS)
+        with conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS runs ({columns})")
+            # Add columns introduced since an existing store was created
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+            for name, kind in RUN_STORE_COLUMNS:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_story_id ON runs (story_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_status ON runs (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_started ON runs (started)")
+            conn.execute(f"PRAGMA user_version = {RUN_STORE_VERSION}")
+    return conn
+
+
+def _upsert_sql() -> str:
+    names = [name for name, _ in RUN_STORE_COLUMNS]
+    updates = ", ".join(f"{name} = excluded.{name}" for name in names[1:])
+    return (f"INSERT INTO runs ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+            f"ON CONFLICT (run) DO UPDATE SET {updates}")
+
+
+def upsert_runs(conn, records: list) -> list:
+    """
+    Upsert runs-table records in one write transaction.
+
+    Returns:
+        List of (previous row dict or None, record) for updating rollups
+    """
+    upsert = _upsert_sql()
+    changes = []
+    with conn:
+        # Take the write lock before reading previous rows, so concurrent
+        # writers cannot both count the same row as new
+        conn.execute("BEGIN IMMEDIATE")
+        for record in records:
+            cur = conn.execute("SELECT * FROM runs WHERE run = ?", (record["run"],))
+            old = cur.fetchone()
+            if old is not None:
+                old = dict(zip([d[0] for d in cur.description], old))
+            conn.execute(upsert, [record[name] for name, _ in RUN_STORE_COLUMNS])
+            changes.append((old, record))
+    return changes
+
+
+def store_run(data: dict, output_path: str, db_path: str = "") -> None:
+    """
+    Upsert one run into the PRD's runs.db, keyed by its summary file name,
+    and apply the change to the PRD and global rollups.
+
+    Args:
+        data: Dictionary containing all run metadata
+        output_path: Path of the markdown summary
+        db_path: Database path (defaults to run_store_path(output_path))
+    """
+    db_path = db_path or run_store_path(output_path)
+    conn = open_run_store(db_path)
+    try:
+        store_records(conn, db_path, [run_record(data, output_path)])
+    finally:
+        conn.close()
+
+
+def store_records(conn, db_path: str, records: list) -> None:
+    """
+    Upsert records into an open runs.db and apply them to its rollups.
+
+    The rollup locks are held across both steps. A writer that finds a
+    rollup missing rebuilds it from runs.db; without the locks, a second
+    writer's row could be committed before that rebuild and then applied
+    again on top of it.
+    """
+    with _RollupLocks(_rollup_paths(db_path)):
+        update_rollups(db_path, upsert_runs(conn, records))
+
+
+ROLLUP_VERSION = 1
+ROLLUP_NAME = ".rollup.json"
+PRD_FOLDER = re.compile(r"PRD-\d+", re.I)
+
+# Summed runs-table columns, and the per-model / per-agent ones
+ROLLUP_SUMS = ("duration_s", "input_tokens", "output_tokens", "actual_cost",
+               "retry_count", "retry_time_s", "switch_count")
+ROLLUP_GROUP_SUMS = ("input_tokens", "output_tokens", "actual_cost")
+
+
+def empty_rollup() -> dict:
+    rollup = {"version": ROLLUP_VERSION, "runs": 0, "by_status": {}, "by_model": {}, "by_agent": {}}
+    rollup.update((field, 0) for field in ROLLUP_SUMS)
+    # Welford accumulator for token estimate error (token_variance_pct)
+    rollup["estimate_error"] = {"n": 0, "mean": 0.0, "m2": 0.0}
+    return rollup
+
+
+def _welford(stats: dict, x: float, sign: int) -> None:
+    # Welford's update; removal (sign=-1) runs the same step backwards
+    n = stats["n"] + sign
+    if n <= 0:
+        stats.update(n=0, mean=0.0, m2=0.0)
+        return
+    mean = stats["mean"]
+    new_mean = mean + (x - mean) / n if sign > 0 else (stats["n"] * mean - x) / n
+    stats.update(n=n, mean=new_mean, m2=max(0.0, stats["m2"] + sign * (x - mean) * (x - new_mean)))
+
+
+def apply_to_rollup(rollup: dict, row: dict, sign: int = 1) -> None:
+    """
+    Add (sign=1) or remove (sign=-1) one runs-table row's contribution.
+
+    Keys whose count drops to zero are kept so readers see a stable shape;
+    rebuild_rollup prunes them.
+    """
+    rollup["runs"] += sign
+    status = row.get("status") or "unknown"
+    rollup["by_status"][status] = rollup["by_status"].get(status, 0) + sign
+
+    model = row.get("routed_model") or row.get("token_model") or "unknown"
+    for group, key in (("by_model", model), ("by_agent", row.get("agent") or "unknown")):
+        entry = rollup[group].setdefault(key, dict({"runs": 0}, **{f: 0 for f in ROLLUP_GROUP_SUMS}))
+        entry["runs"] += sign
+        for field in ROLLUP_GROUP_SUMS:
+            entry[field] += sign * (row.get(field) or 0)
+        if isinstance(entry["actual_cost"], float):
+            entry["actual_cost"] = round(entry["actual_cost"], 6)
+
+    for field in ROLLUP_SUMS:
+        rollup[field] += sign * (row.get(field) or 0)
+    rollup["actual_cost"] = round(rollup["actual_cost"], 6)
+    if row.get("token_variance_pct") is not None:
+        _welford(rollup["estimate_error"], row["token_variance_pct"], sign)
+
+
+def _rollup_paths(db_path: str) -> list:
+    # A PRD folder's runs also count toward the .ralph directory's rollup
+    folder = os.path.dirname(os.path.abspath(db_path))
+    paths = [os.path.join(folder, ROLLUP_NAME)]
+    if PRD_FOLDER.fullmatch(os.path.basename(folder)):
+        paths.append(os.path.join(os.path.dirname(folder), ROLLUP_NAME))
+    return paths
+
+
+def rebuild_rollup(folder: str) -> dict:
+    """
+    Recompute a rollup from runs.db: a PRD folder's own runs, or for a
+    .ralph directory its runs plus those of every PRD-N folder in it.
+    """
+    import sqlite3
+
+    db_paths = [os.path.join(folder, RUN_STORE_NAME)]
+    if not PRD_FOLDER.fullmatch(os.path.basename(os.path.abspath(folder))):
+        try:
+            entries = sorted(os.listdir(folder))
+        except OSError:
+            entries = []
+        db_paths += [os.path.join(folder, e, RUN_STORE_NAME) for e in entries if PRD_FOLDER.fullmatch(e)]
+
+    rollup = empty_rollup()
+    for db_path in db_paths:
+        if not os.path.exists(db_path):
+            continue
+        conn = sqlite3.connect(db_path, timeout=10)
+        try:
+            cur = conn.execute("SELECT * FROM runs")
+            names = [d[0] for d in cur.description]
+            for row in cur:
+                apply_to_rollup(rollup, dict(zip(names, row)))
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+    # Only rebuilds prune; incremental updates keep keys at zero
+    rollup["by_status"] = {k: v for k, v in rollup["by_status"].items() if v > 0}
+    for group in ("by_model", "by_agent"):
+        rollup[group] = {k: v for k, v in rollup[group].items() if v["runs"] > 0}
+    return rollup
+
+
+def read_rollup(path: str):
+    try:
+        with open(path) as f:
+            rollup = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return rollup if isinstance(rollup, dict) and rollup.get("version") == ROLLUP_VERSION else None
+
+
+def _write_rollup(path: str, rollup: dict) -> None:
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, 'w') as f:
+        json.dump(rollup, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+class _RollupLocks:
+    """
+    flock rollup files through their .lock files, PRD before global.
+
+    Held by store_records across the upsert and the rollup update.
+    """
+
+    def __init__(self, paths: list):
+        self.paths = paths
+        self.fds = []
+
+    def __enter__(self):
+        import fcntl
+
+        try:
+            for path in self.paths:
+                self.fds.append(os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644))
+                fcntl.flock(self.fds[-1], fcntl.LOCK_EX)
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        while self.fds:
+            os.close(self.fds.pop())
+        return False
+
+
+def update_rollups(db_path: str, changes: list) -> None:
+    """
+    Apply upserted runs to the PRD and global rollups in O(changes).
+
+    A rewritten run first has its previous row's contribution removed. A
+    missing or outdated rollup is rebuilt from runs.db instead, which
+    already holds the changes. Callers hold _RollupLocks (see store_records).
+    """
+    for path in _rollup_paths(db_path):
+        rollup = read_rollup(path)
+        if rollup is None:
+            rollup = rebuild_rollup(os.path.dirname(path))
+        else:
+            for old, new in changes:
+                if old is not None:
+                    apply_to_rollup(rollup, old, -1)
+                apply_to_rollup(rollup, new)
+        _write_rollup(path, rollup)
+
+
+def rollup_summary(rollup: dict) -> dict:
+    """Return a rollup with derived totals, rates and estimate error statistics."""
+    summary = dict(rollup)
+    runs = rollup["runs"]
+    summary["total_tokens"] = rollup["input_tokens"] + rollup["output_tokens"]
+    summary["success_rate"] = round(rollup["by_status"].get("success", 0) / runs, 4) if runs else 0.0
+    summary["avg_duration_s"] = round(rollup["duration_s"] / runs, 3) if runs else 0.0
+    stats = rollup["estimate_error"]
+    variance = stats["m2"] / (stats["n"] - 1) if stats["n"] > 1 else 0.0
+    summary["estimate_error"] = {
+        "n": stats["n"],
+        "mean_pct": round(stats["mean"], 3),
+        "variance": round(variance, 3),
+        "stddev_pct": round(variance ** 0.5, 3),
+    }
+    return summary
+
+
+def run_source_path(output_path: str) -> str:
+    """Return the JSON source kept beside a summary (run-X.md -> run-X.json)."""
+    return os.path.splitext(output_path)[0] + ".json"
+
+
+def save_run_source(data: dict, output_path: str) -> None:
+    """Keep the run metadata beside its summary so backfill can re-render it."""
+    path = run_source_path(output_path)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _record_run(data: dict, output_path: str, profiler=None) -> None:
+    # The markdown summary is the record of truth; a missing sqlite3 module or
+    # a locked database must not fail the run
+    with _span(profiler, "store"):
+        try:
+            save_run_source(data, output_path)
+            store_run(data, output_path)
+        except Exception as e:
+            print(f"Warning: could not update run store: {e}", file=sys.stderr)
+
+
+# Markdown list sections and the fields they hold
+SUMMARY_LISTS = {
+    "Commits": "commit_list",
+    "Changed Files (commits)": "changed_files",
+    "Uncommitted Changes": "dirty_files",
+}
+
+# (section, label) -> field for "- Label: value" summary lines
+SUMMARY_LINES = {
+    ("Ralph Run Summary", "Run ID"): "run_id",
+    ("Ralph Run Summary", "Iteration"): "iteration",
+    ("Ralph Run Summary", "Mode"): "mode",
+    ("Ralph Run Summary", "Started"): "started",
+    ("Ralph Run Summary", "Ended"): "ended",
+    ("Ralph Run Summary", "Duration"): "duration",
+    ("Ralph Run Summary", "Status"): "status",
+    ("Ralph Run Summary", "Log"): "log_file",
+    ("Git", "Head (before)"): "head_before",
+    ("Git", "Head (after)"): "head_after",
+    ("Token Usage", "Input tokens"): "input_tokens",
+    ("Token Usage", "Output tokens"): "output_tokens",
+    ("Token Usage", "Model"): "token_model",
+    ("Token Usage", "Estimated"): "token_estimated",
+    ("Retry Statistics", "Retry count"): "retry_count",
+    ("Retry Statistics", "Total retry wait time"): "retry_time",
+    ("Agent Switches", "Switch count"): "switch_count",
+    ("Agent Switches", "From"): "switch_from",
+    ("Agent Switches", "To"): "switch_to",
+    ("Agent Switches", "Reason"): "switch_reason",
+    ("Routing Decision", "Model"): "routed_model",
+    ("Routing Decision", "Complexity score"): "complexity_score",
+    ("Routing Decision", "Reason"): "routing_reason",
+    ("Pre-execution Estimate", "Estimated cost"): "est_cost",
+    ("Pre-execution Estimate", "Estimated tokens"): "est_tokens",
+    ("Actual Usage", "Actual cost"): "actual_cost",
+}
+
+# Last section render_run_metadata writes; anything after it (such as the
+# context summary loop.sh appends) is kept when a summary is re-rendered
+LAST_SECTION = "\n### Estimate Accuracy\n"
+
+
+def parse_run_summary(text: str) -> dict:
+    """
+    Recover run metadata from a markdown summary with no JSON source.
+
+    Args:
+        text: Summary written by render_run_metadata
+
+    Returns:
+        Dictionary of the run metadata fields the summary shows
+    """
+    end = text.find(LAST_SECTION)
+    data = {}
+    section = ""
+    for line in text[:end if end >= 0 else len(text)].split("\n"):
+        if line.startswith("#"):
+            section = line.lstrip("#").strip()
+            continue
+        if not line.startswith("- "):
+            continue
+        if section in SUMMARY_LISTS:
+            if line not in ("- (none)", "- (clean)"):
+                field = SUMMARY_LISTS[section]
+                data[field] = f"{data[field]}\n{line}" if field in data else line
+            continue
+        label, sep, value = line[2:].partition(": ")
+        if label == "Story" and sep:
+            data["story_id"], _, data["story_title"] = value.partition(": ")
+            continue
+        field = SUMMARY_LINES.get((section, label))
+        if field is None or not sep or value.startswith("(") and value.endswith(")"):
+            continue
+        if field in ("retry_count", "switch_count"):
+            value = value.split(" ", 1)[0]
+        elif field in ("duration", "retry_time"):
+            value = value[:-1] if value.endswith("s") else value
+        elif field == "complexity_score":
+            value = value[:-3] if value.endswith("/10") else value
+        elif field in ("est_cost", "actual_cost"):
+            value = value.lstrip("$")
+        data[field] = value
+    return data
+
+
+def _summary_trailer(text: str) -> str:
+    pos = text.find(LAST_SECTION)
+    if pos < 0:
+        return ""
+    eol = text.find("\n", pos + len(LAST_SECTION))
+    if eol < 0:
+        return ""
+    rest = text[eol + 1:]
+    return rest[1:] if rest.startswith("\n") else rest
+
+
+def backfill_run(task: tuple) -> tuple:
+    """
+    Re-render one run summary from its source, writing only if it changed.
+
+    Args:
+        task: (source path, summary path, pricing table from load_pricing())
+
+    Returns:
+        (summary path, outcome, runs-table record or None, error or None) where
+        outcome is rewritten, unchanged, skipped or error
+    """
+    source, summary, pricing = task
+    try:
+        try:
+            with open(summary) as f:
+                existing = f.read()
+        except FileNotFoundError:
+            existing = ""
+        if source.endswith(".json"):
+            with open(source) as f:
+                data = json.load(f)
+        elif LAST_SECTION in existing:
+            data = parse_run_summary(existing)
+        else:
+            # Not a summary this module wrote; leave it alone
+            return summary, "skipped", None, None
+
+        if not is_valid_value(data.get('actual_cost')):
+            cost = calculate_actual_cost(data, pricing)
+            if cost is not None:
+                data['actual_cost'] = format_cost_value(cost)
+
+        text = render_run_metadata(data) + _summary_trailer(existing)
+        outcome = "unchanged"
+        if text != existing:
+            tmp = f"{summary}.tmp.{os.getpid()}"
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, summary)
+            outcome = "rewritten"
+        return summary, outcome, run_record(data, summary), None
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        return summary, "error", None, f"{type(e).__name__}: {e}"
+
+
+def discover_run_sources(ralph_dir: str) -> list:
+    """
+    Find every run summary under a .ralph directory and its best source.
+
+    A run's JSON source (run-X.json) is preferred; runs from before sources
+    were kept are re-rendered from their parsed markdown.
+
+    Args:
+        ralph_dir: Path to the .ralph directory
+
+    Returns:
+        Sorted list of (source path, summary path)
+    """
+    runs_dirs = [os.path.join(ralph_dir, "runs")]
+    try:
+        entries = sorted(os.listdir(ralph_dir))
+    except OSError:
+        entries = []
+    runs_dirs += [os.path.join(ralph_dir, e, "runs") for e in entries if e.lower().startswith("prd-")]
+
+    sources = []
+    for runs_dir in runs_dirs:
+        try:
+            names = set(os.listdir(runs_dir))
+        except OSError:
+            continue
+        stems = {n[:-3] for n in names if n.startswith("run-") and n.endswith(".md")}
+        stems |= {n[:-5] for n in names if n.startswith("run-") and n.endswith(".json")}
+        for stem in sorted(stems):
+            summary = os.path.join(runs_dir, stem + ".md")
+            source = summary[:-3] + ".json" if stem + ".json" in names else summary
+            sources.append((source, summary))
+    return sources
+
+
+BACKFILL_JOURNAL = ".backfill-journal"
+
+# Results applied (runs.db upserts and journal lines) per batch
+BACKFILL_BATCH = 256
+
+
+def backfill(ralph_dir: str = ".ralph", workers: int = 0, config_path: str = "",
+             restart: bool = False) -> dict:
+    """
+    Re-render every run summary under a .ralph directory in a process pool.
+
+    Summaries are rewritten only when their rendering changed, and every run
+    is upserted into its PRD's runs.db. Finished summaries are appended to
+    a journal in ralph_dir, so an interrupted backfill resumes where it
+    stopped; the journal is removed once a backfill completes.
+
+    Args:
+        ralph_dir: Path to the .ralph directory
+        workers: Process count (defaults to os.cpu_count())
+        config_path: config.sh holding pricing overrides (optional)
+        restart: Ignore an existing journal and re-render everything
+
+    Returns:
+        Dict with ok, sources, resumed, rewritten, unchanged, skipped,
+        errors (first 20), workers, seconds and runs_per_second
+    """
+    started = time.perf_counter()
+    journal_path = os.path.join(ralph_dir, BACKFILL_JOURNAL)
+    done = set()
+    if restart:
+        try:
+            os.unlink(journal_path)
+        except OSError:
+            pass
+    else:
+        try:
+            with open(journal_path) as f:
+                done = {line.rstrip("\n") for line in f}
+        except OSError:
+            pass
+
+    sources = discover_run_sources(ralph_dir)
+    pricing = load_pricing(config_path)
+    tasks = [(source, summary, pricing) for source, summary in sources if summary not in done]
+    max_workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    counts = {"rewritten": 0, "unchanged": 0, "skipped": 0, "error": 0}
+    errors = []
+    stores = {}
+
+    def apply(batch):
+        rows = {}
+        for summary, outcome, record, error in batch:
+            counts[outcome] += 1
+            if error:
+                errors.append({"path": summary, "error": error})
+            elif record is not None:
+                rows.setdefault(run_store_path(summary), []).append(record)
+        for db_path, records in rows.items():
+            try:
+                if db_path not in stores:
+                    stores[db_path] = open_run_store(db_path)
+                store_records(stores[db_path], db_path, records)
+            except Exception as e:
+                print(f"Warning: could not update run store {db_path}: {e}", file=sys.stderr)
+        # Journal only after the runs are stored, so a resumed backfill redoes
+        # anything an interruption cut short; failed runs are retried
+        with open(journal_path, 'a') as journal:
+            journal.writelines(f"{summary}\n" for summary, outcome, _, _ in batch if outcome != "error")
+
+    def drain(results):
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= BACKFILL_BATCH:
+                apply(batch)
+                batch = []
+        if batch:
+            apply(batch)
+
+    try:
+        if max_workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            chunksize = max(1, min(64, len(tasks) // (max_workers * 4)))
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                drain(pool.map(backfill_run, tasks, chunksize=chunksize))
+        else:
+            drain(map(backfill_run, tasks))
+    finally:
+        for conn in stores.values():
+            conn.close()
+
+    try:
+        os.unlink(journal_path)
+    except OSError:
+        pass
+    seconds = time.perf_counter() - started
+    processed = len(tasks)
+    return {
+        "ok": counts["error"] == 0,
+        "sources": len(sources),
+        "resumed": len(sources) - processed,
+        "rewritten": counts["rewritten"],
+        "unchanged": counts["unchanged"],
+        "skipped": counts["skipped"],
+        "errors": errors[:20],
+        "workers": max_workers,
+        "seconds": round(seconds, 3),
+        "runs_per_second": round(processed / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+def finalize(raw: str, output_path: str, config_path: str = "", profiler=None) -> str:
+    """
+    Render a run summary with its actual cost and return shell assignments.
+
+    Args:
+        raw: Run metadata JSON
+        output_path: Path to write the markdown file
+        config_path: config.sh holding pricing overrides (optional)
+        profiler: Active ralph_profile.Profiler, if any
+
+    Returns:
+        Newline-separated name='value' assignments for FINALIZE_FIELDS
+    """
+    import shlex
+
+    with _span(profiler, "parse"):
+        data = json.loads(raw) if raw.strip() else {}
+    with _span(profiler, "cost"):
+        if not is_valid_value(data.get('actual_cost')):
+            cost = calculate_actual_cost(data, load_pricing(config_path))
+            if cost is not None:
+                data['actual_cost'] = format_cost_value(cost)
+    with _span(profiler, "write"):
+        write_run_metadata(data, output_path)
+    _record_run(data, output_path, profiler)
+
+    lines = []
+    for field in FINALIZE_FIELDS:
+        value = data.get(field)
+        lines.append(f"{field}={shlex.quote('' if value is None else str(value))}")
+    return "\n".join(lines) + "\n"
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _span(profiler, name: str):
+    """Time a block under `name` when profiling; a no-op otherwise."""
+    return _NO_SPAN if profiler is None else profiler.span(name)
+
+
+def _main_backfill(args: list) -> None:
+    # backfill [ralph_dir] [--workers N] [--config PATH] [--restart]
+    ralph_dir, workers, config_path, restart = ".ralph", 0, "", False
+    i = 0
+    try:
+        while i < len(args):
+            if args[i] == "--restart":
+                restart = True
+            elif args[i] == "--workers":
+                i += 1
+                workers = int(args[i])
+            elif args[i] == "--config":
+                i += 1
+                config_path = args[i]
+            else:
+                ralph_dir = args[i]
+            i += 1
+    except (IndexError, ValueError):
+        print(f"Usage: {sys.argv[0]} backfill [ralph_dir] [--workers N] [--config <config.sh>] [--restart]",
+              file=sys.stderr)
+        sys.exit(1)
+    result = backfill(ralph_dir, workers, config_path, restart)
+    print(json.dumps(result, indent=2))
+    if not result["ok"]:
+        sys.exit(1)
+
+
+def _main_rollup(args: list) -> None:
+    # rollup [folder] [--rebuild]
+    rebuild = "--rebuild" in args
+    folders = [a for a in args if a != "--rebuild"]
+    folder = folders[0] if folders else ".ralph"
+    path = os.path.join(folder, ROLLUP_NAME)
+    rollup = None if rebuild else read_rollup(path)
+    if rollup is None:
+        try:
+            # Locked so a concurrent store cannot land between rebuild and write
+            with _RollupLocks([path]):
+                rollup = rebuild_rollup(folder)
+                _write_rollup(path, rollup)
+        except OSError:
+            if rollup is None:
+                rollup = rebuild_rollup(folder)
+    print(json.dumps(rollup_summary(rollup), indent=2))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        _main_backfill(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "rollup":
+        _main_rollup(sys.argv[2:])
+        return
+
+    finalizing = len(sys.argv) > 1 and sys.argv[1] == "finalize"
+    config_path = ""
+    if finalizing:
+        # finalize <output_file> [--config <config.sh>]
+        if len(sys.argv) == 5 and sys.argv[3] == "--config":
+            config_path = sys.argv[4]
+        elif len(sys.argv) != 3:
+            print(f"Usage: {sys.argv[0]} finalize <output_file> [--config <config.sh>] < run.json", file=sys.stderr)
+            sys.exit(1)
+        json_file = "stdin"
+    elif len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} <json_file> <output_file>", file=sys.stderr)
+        sys.exit(1)
+    else:
+        json_file = sys.argv[1]
+    output_file = sys.argv[2]
+
+    profiler = None
+    ok = False
+    if os.environ.get("RALPH_PROFILE"):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import ralph_profile
+        profiler = ralph_profile.Profiler("run-meta-writer", "finalize" if finalizing else "write",
+                                          sys.argv[2:] if finalizing else sys.argv[1:],
+                                          time.perf_counter() - _STARTED)
+
+    try:
+        with _span(profiler, "read"):
+            if finalizing:
+                raw = sys.stdin.read()
+            else:
+                with open(json_file, 'r') as f:
+                    raw = f.read()
+        if finalizing:
+            sys.stdout.write(finalize(raw, output_file, config_path, profiler))
+        else:
+            with _span(profiler, "parse"):
+                data = json.loads(raw)
+            with _span(profiler, "write"):
+                write_run_metadata(data, output_file)
+            _record_run(data, output_file, profiler)
+        if profiler:
+            profiler.count(read=len(raw), written=os.path.getsize(output_file))
+
+    except FileNotFoundError:
+        print(f"Error: JSON file not found: {json_file}", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError as e:
+        print(f"Error: Invalid JSON in {json_file}: {e}", file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error writing metadata: {e}", file=sys.stderr)
+        sys.exit(1)
+    else:
+        ok = True
+    finally:
+        if profiler:
+            profiler.finish(ok)
+
+
+if __name__ == '__main__':
+    main()
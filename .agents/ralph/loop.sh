@@ -70,6 +70,11 @@ source "$SCRIPT_DIR/lib/watchdog.sh"
 # shellcheck source=lib/notify.sh
 source "$SCRIPT_DIR/lib/notify.sh"
 
+# Source the prd-parser.py client: one persistent helper process per build
+# instead of a python3 startup per call (also JSON escaping for vars files)
+# shellcheck source=lib/prd-helper.sh
+source "$SCRIPT_DIR/lib/prd-helper.sh"
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Dependency availability checks for graceful degradation (P2.5)
 # These flags allow features to degrade gracefully when deps are missing
@@ -80,7 +85,12 @@ GIT_AVAILABLE=false
 
 if command -v python3 >/dev/null 2>&1; then
   PYTHON3_AVAILABLE=true
+  # Precompile the Python helpers so every call loads cached bytecode, even
+  # where PYTHONDONTWRITEBYTECODE keeps Python from writing it on first import.
+  # compileall skips modules whose bytecode is already up to date.
+  python3 -m compileall -q "$SCRIPT_DIR/lib" >/dev/null 2>&1 || true
 fi
+PRD_PARSER_PY="$SCRIPT_DIR/lib/prd-parser.py"
 
 if command -v node >/dev/null 2>&1; then
   NODE_AVAILABLE=true
@@ -967,77 +977,42 @@ fi
 
 RUN_TAG="$(date +%Y%m%d-%H%M%S)-$$"
 
+# Write the template variables shared by build and retry prompts as JSON
+# Usage: write_prompt_vars <vars_file> <run_id> <iter> <run_log> <run_meta>
+write_prompt_vars() {
+  local vars_file="$1"
+  local -a names=(PRD_PATH PLAN_PATH AGENTS_PATH PROGRESS_PATH REPO_ROOT GUARDRAILS_PATH
+    ERRORS_LOG_PATH ACTIVITY_LOG_PATH GUARDRAILS_REF CONTEXT_REF ACTIVITY_CMD NO_COMMIT
+    RUN_ID ITERATION RUN_LOG_PATH RUN_META_PATH HISTORICAL_CONTEXT)
+  local -a values=("$PRD_PATH" "$PLAN_PATH" "$AGENTS_PATH" "$PROGRESS_PATH" "$ROOT_DIR" "$GUARDRAILS_PATH"
+    "$ERRORS_LOG_PATH" "$ACTIVITY_LOG_PATH" "$GUARDRAILS_REF" "$CONTEXT_REF" "$ACTIVITY_CMD" "$NO_COMMIT"
+    "$2" "$3" "$4" "$5" "${HISTORICAL_CONTEXT:-}")
+  local json="" i
+  for i in "${!names[@]}"; do
+    json+="${json:+,}\"${names[$i]}\":\"$(prd_helper_json_escape "${values[$i]}")\""
+  done
+  printf '{%s}\n' "$json" > "$vars_file"
+}
+
+# Render a prompt template through prd-parser.py (compiled templates, the
+# story block streamed from its file)
+# Usage: render_prompt <src> <dst> <story_meta> <story_block> <run_id> <iter> <run_log> <run_meta>
 render_prompt() {
   local src="$1"
   local dst="$2"
   local story_meta="$3"
   local story_block="$4"
-  local run_id="$5"
-  local iter="$6"
-  local run_log="$7"
-  local run_meta="$8"
-  python3 - "$src" "$dst" "$PRD_PATH" "$PLAN_PATH" "$AGENTS_PATH" "$PROGRESS_PATH" "$ROOT_DIR" "$GUARDRAILS_PATH" "$ERRORS_LOG_PATH" "$ACTIVITY_LOG_PATH" "$GUARDRAILS_REF" "$CONTEXT_REF" "$ACTIVITY_CMD" "$NO_COMMIT" "$story_meta" "$story_block" "$run_id" "$iter" "$run_log" "$run_meta" <<'PY'
-import sys
-import os
-from pathlib import Path
-
-src = Path(sys.argv[1]).read_text()
-prd, plan, agents, progress, root = sys.argv[3:8]
-guardrails = sys.argv[8]
-errors_log = sys.argv[9]
-activity_log = sys.argv[10]
-guardrails_ref = sys.argv[11]
-context_ref = sys.argv[12]
-activity_cmd = sys.argv[13]
-no_commit = sys.argv[14]
-meta_path = sys.argv[15] if len(sys.argv) > 15 else ""
-block_path = sys.argv[16] if len(sys.argv) > 16 else ""
-run_id = sys.argv[17] if len(sys.argv) > 17 else ""
-iteration = sys.argv[18] if len(sys.argv) > 18 else ""
-run_log = sys.argv[19] if len(sys.argv) > 19 else ""
-run_meta = sys.argv[20] if len(sys.argv) > 20 else ""
-# Get historical context from environment (US-XXX Historical Log Context)
-historical_context = os.environ.get("HISTORICAL_CONTEXT", "")
-repl = {
-    "PRD_PATH": prd,
-    "PLAN_PATH": plan,
-    "AGENTS_PATH": agents,
-    "PROGRESS_PATH": progress,
-    "REPO_ROOT": root,
-    "GUARDRAILS_PATH": guardrails,
-    "ERRORS_LOG_PATH": errors_log,
-    "ACTIVITY_LOG_PATH": activity_log,
-    "GUARDRAILS_REF": guardrails_ref,
-    "CONTEXT_REF": context_ref,
-    "ACTIVITY_CMD": activity_cmd,
-    "NO_COMMIT": no_commit,
-    "RUN_ID": run_id,
-    "ITERATION": iteration,
-    "RUN_LOG_PATH": run_log,
-    "RUN_META_PATH": run_meta,
-    "HISTORICAL_CONTEXT": historical_context,
-}
-story = {"id": "", "title": "", "block": ""}
-if meta_path:
-    try:
-        import json
-        meta = json.loads(Path(meta_path).read_text())
-        story["id"] = meta.get("id", "") or ""
-        story["title"] = meta.get("title", "") or ""
-    except Exception:
-        pass
-if block_path and Path(block_path).exists():
-    story["block"] = Path(block_path).read_text()
-repl["STORY_ID"] = story["id"]
-repl["STORY_TITLE"] = story["title"]
-repl["STORY_BLOCK"] = story["block"]
-for k, v in repl.items():
-    src = src.replace("{{" + k + "}}", v)
-Path(sys.argv[2]).write_text(src)
-PY
+  local vars_file="${dst}.vars.json"
+  local status=0
+  write_prompt_vars "$vars_file" "$5" "$6" "$7" "$8"
+  prd_helper_call render_prompt "$src" "$dst" "$vars_file" "$story_meta" "$story_block" || status=$?
+  rm -f "$vars_file"
+  return "$status"
 }
 
-# Render retry prompt with failure context variables (US-002)
+# Render retry prompt with failure context variables (US-002). prd-parser.py
+# reads a bounded tail of the failure context and reuses the PRD's failure
+# cache for the analysis.
 # Usage: render_retry_prompt <src> <dst> <story_meta> <story_block> <run_id> <iter> <run_log> <run_meta> \
 #                            <failure_context_file> <retry_attempt> <retry_max>
 render_retry_prompt() {
@@ -1045,159 +1020,23 @@ render_retry_prompt() {
   local dst="$2"
   local story_meta="$3"
   local story_block="$4"
-  local run_id="$5"
-  local iter="$6"
-  local run_log="$7"
-  local run_meta="$8"
   local failure_context_file="${9:-}"
   local retry_attempt="${10:-1}"
   local retry_max="${11:-3}"
-  python3 - "$src" "$dst" "$PRD_PATH" "$PLAN_PATH" "$AGENTS_PATH" "$PROGRESS_PATH" "$ROOT_DIR" "$GUARDRAILS_PATH" "$ERRORS_LOG_PATH" "$ACTIVITY_LOG_PATH" "$GUARDRAILS_REF" "$CONTEXT_REF" "$ACTIVITY_CMD" "$NO_COMMIT" "$story_meta" "$story_block" "$run_id" "$iter" "$run_log" "$run_meta" "$failure_context_file" "$retry_attempt" "$retry_max" <<'PY'
-import sys
-from pathlib import Path
-
-src = Path(sys.argv[1]).read_text()
-prd, plan, agents, progress, root = sys.argv[3:8]
-guardrails = sys.argv[8]
-errors_log = sys.argv[9]
-activity_log = sys.argv[10]
-guardrails_ref = sys.argv[11]
-context_ref = sys.argv[12]
-activity_cmd = sys.argv[13]
-no_commit = sys.argv[14]
-meta_path = sys.argv[15] if len(sys.argv) > 15 else ""
-block_path = sys.argv[16] if len(sys.argv) > 16 else ""
-run_id = sys.argv[17] if len(sys.argv) > 17 else ""
-iteration = sys.argv[18] if len(sys.argv) > 18 else ""
-run_log = sys.argv[19] if len(sys.argv) > 19 else ""
-run_meta = sys.argv[20] if len(sys.argv) > 20 else ""
-failure_context_file = sys.argv[21] if len(sys.argv) > 21 else ""
-retry_attempt = sys.argv[22] if len(sys.argv) > 22 else "1"
-retry_max = sys.argv[23] if len(sys.argv) > 23 else "3"
-
-def analyze_previous_approach(context):
-    """Analyze what the previous approach tried based on failure context."""
-    if not context:
-        return "No previous failure context available."
-
-    lines = context.split('\n')
-    analysis = []
-
-    # Look for common patterns
-    for line in lines:
-        line_lower = line.lower()
-        if 'import' in line_lower and ('error' in line_lower or 'fail' in line_lower):
-            analysis.append("- Import statements may have issues")
-        if 'route' in line_lower and ('not found' in line_lower or '404' in line_lower):
-            analysis.append("- Route registration may be missing")
-        if 'expect' in line_lower and 'received' in line_lower:
-            analysis.append("- Test assertions did not match expected values")
-        if 'undefined' in line_lower or 'null' in line_lower:
-            analysis.append("- Some variables or properties were undefined/null")
-        if 'type' in line_lower and 'error' in line_lower:
-            analysis.append("- Type mismatches were detected")
-
-    if not analysis:
-        analysis.append("- Review the full log for specific failure details")
-
-    return '\n'.join(list(set(analysis))[:5])  # Dedupe and limit to 5
-
-def suggest_alternatives(context):
-    """Suggest alternative approaches based on failure patterns."""
-    if not context:
-        return "- Try a simpler approach first\n- Double-check the requirements"
-
-    context_lower = context.lower()
-    suggestions = []
-
-    # Pattern-based suggestions
-    if 'import' in context_lower and ('error' in context_lower or 'module' in context_lower):
-        suggestions.append("- Verify all import paths are correct and modules exist")
-        suggestions.append("- Check for circular dependencies")
-
-    if 'route' in context_lower or '404' in context_lower:
-        suggestions.append("- Ensure the route is registered in the router/app")
-        suggestions.append("- Check route path spelling and parameters")
-
-    if 'expect' in context_lower or 'assert' in context_lower:
-        suggestions.append("- Match the expected output format exactly")
-        suggestions.append("- Check data types (string vs number, etc.)")
-
-    if 'undefined' in context_lower or 'null' in context_lower:
-        suggestions.append("- Add null checks and default values")
-        suggestions.append("- Verify object properties exist before accessing")
-
-    if 'timeout' in context_lower:
-        suggestions.append("- Reduce operation complexity or add pagination")
-        suggestions.append("- Check for infinite loops or blocking operations")
-
-    if 'permission' in context_lower or 'access' in context_lower:
-        suggestions.append("- Check file/directory permissions")
-        suggestions.append("- Verify authentication/authorization is set up")
-
-    if 'syntax' in context_lower:
-        suggestions.append("- Check for missing brackets, semicolons, or quotes")
-        suggestions.append("- Validate JSON/YAML/config file formats")
-
-    if not suggestions:
-        suggestions.append("- Read the failing test/verification command carefully")
-        suggestions.append("- Check if dependencies are installed")
-        suggestions.append("- Try a more incremental approach")
-
-    return '\n'.join(suggestions[:4])  # Limit to 4 suggestions
-
-# Read failure context from file
-failure_context = ""
-if failure_context_file and Path(failure_context_file).exists():
-    failure_context = Path(failure_context_file).read_text()
-
-# Analyze previous approach from failure context
-previous_approach = analyze_previous_approach(failure_context)
-
-# Generate suggestions based on failure patterns
-suggestions = suggest_alternatives(failure_context)
-
-repl = {
-    "PRD_PATH": prd,
-    "PLAN_PATH": plan,
-    "AGENTS_PATH": agents,
-    "PROGRESS_PATH": progress,
-    "REPO_ROOT": root,
-    "GUARDRAILS_PATH": guardrails,
-    "ERRORS_LOG_PATH": errors_log,
-    "ACTIVITY_LOG_PATH": activity_log,
-    "GUARDRAILS_REF": guardrails_ref,
-    "CONTEXT_REF": context_ref,
-    "ACTIVITY_CMD": activity_cmd,
-    "NO_COMMIT": no_commit,
-    "RUN_ID": run_id,
-    "ITERATION": iteration,
-    "RUN_LOG_PATH": run_log,
-    "RUN_META_PATH": run_meta,
-    "FAILURE_CONTEXT": failure_context,
-    "PREVIOUS_APPROACH": previous_approach,
-    "SUGGESTIONS": suggestions,
-    "RETRY_ATTEMPT": retry_attempt,
-    "RETRY_MAX": retry_max,
+  local vars_file="${dst}.vars.json"
+  local status=0
+  write_prompt_vars "$vars_file" "$5" "$6" "$7" "$8"
+  prd_helper_call render_retry_prompt "$src" "$dst" "$vars_file" "$story_meta" "$story_block" \
+    "$failure_context_file" "$retry_attempt" "$retry_max" || status=$?
+  rm -f "$vars_file"
+  return "$status"
 }
-story = {"id": "", "title": "", "block": ""}
-if meta_path:
-    try:
-        import json
-        meta = json.loads(Path(meta_path).read_text())
-        story["id"] = meta.get("id", "") or ""
-        story["title"] = meta.get("title", "") or ""
-    except Exception:
-        pass
-if block_path and Path(block_path).exists():
-    story["block"] = Path(block_path).read_text()
-repl["STORY_ID"] = story["id"]
-repl["STORY_TITLE"] = story["title"]
-repl["STORY_BLOCK"] = story["block"]
-for k, v in repl.items():
-    src = src.replace("{{" + k + "}}", v)
-Path(sys.argv[2]).write_text(src)
-PY
+
+# Record whether a retry rendered from the failure cache fixed the failure,
+# so later retries of the same failure report how its suggestions fared
+# Usage: record_retry_outcome <story_id> <success|failure>
+record_retry_outcome() {
+  prd_helper_call retry_outcome "$PRD_PATH" "$1" "$2" >/dev/null 2>&1 || true
 }
 
 # TypeScript story selection module path (US-015)
@@ -1216,61 +1055,8 @@ select_story() {
     return 0
   fi
 
-  # Fallback to inline Python implementation
-  python3 - "$PRD_PATH" "$meta_out" "$block_out" <<'PY'
-import json
-import re
-import sys
-from pathlib import Path
-
-prd_path = Path(sys.argv[1])
-meta_out = Path(sys.argv[2])
-block_out = Path(sys.argv[3])
-
-text = prd_path.read_text().splitlines()
-pattern = re.compile(r'^###\s+(\[(?P<status>[ xX])\]\s+)?(?P<id>US-\d+):\s*(?P<title>.+)$')
-
-stories = []
-current = None
-for line in text:
-    m = pattern.match(line)
-    if m:
-        if current:
-            stories.append(current)
-        current = {
-            "id": m.group("id"),
-            "title": m.group("title").strip(),
-            "status": (m.group("status") or " "),
-            "lines": [line],
-        }
-    elif current is not None:
-        current["lines"].append(line)
-if current:
-    stories.append(current)
-
-if not stories:
-    meta_out.write_text(json.dumps({"ok": False, "error": "No stories found in PRD"}, indent=2) + "\n")
-    block_out.write_text("")
-    sys.exit(0)
-
-def is_done(story):
-    return str(story.get("status", "")).strip().lower() == "x"
-
-remaining = [s for s in stories if not is_done(s)]
-meta = {"ok": True, "total": len(stories), "remaining": len(remaining)}
-
-if remaining:
-    target = remaining[0]
-    meta.update({
-        "id": target["id"],
-        "title": target["title"],
-    })
-    block_out.write_text("\n".join(target["lines"]))
-else:
-    block_out.write_text("")
-
-meta_out.write_text(json.dumps(meta, indent=2) + "\n")
-PY
+  # Fallback to the Python helper (the build's persistent process when running)
+  prd_helper_call select_story "$PRD_PATH" "$meta_out" "$block_out"
 }
 
 remaining_stories() {
@@ -1291,14 +1077,7 @@ remaining_stories() {
   fi
 
   # Fallback to Python
-  python3 - "$meta_file" <<'PY'
-import json
-import sys
-from pathlib import Path
-
-data = json.loads(Path(sys.argv[1]).read_text())
-print(data.get("remaining", "unknown"))
-PY
+  prd_helper_call remaining_stories "$meta_file"
 }
 
 story_field() {
@@ -1320,15 +1099,7 @@ story_field() {
   fi
 
   # Fallback to Python
-  python3 - "$meta_file" "$field" <<'PY'
-import json
-import sys
-from pathlib import Path
-
-data = json.loads(Path(sys.argv[1]).read_text())
-field = sys.argv[2]
-print(data.get(field, ""))
-PY
+  prd_helper_call story_field "$meta_file" "$field"
 }
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -1389,6 +1160,12 @@ select_story_locked() {
   local block_out="$3"
   local prd_path="${prd_folder}/prd.md"
 
+  # Leased per-story claims, so parallel workers never block on one lock
+  if [ "${STORY_CLAIMS:-false}" = "true" ] && [ -f "$prd_path" ] && [ -f "$PRD_PARSER_PY" ]; then
+    select_story_claimed "$prd_path" "$meta_out" "$block_out"
+    return $?
+  fi
+
   # Use TypeScript atomic select-and-lock if available (US-015)
   # This is more reliable than bash-level locking for race conditions
   if [ -f "$STORY_CLI" ] && command -v node >/dev/null 2>&1 && [ -f "$prd_path" ]; then
@@ -1406,6 +1183,58 @@ select_story_locked() {
   fi
 }
 
+# Worker identity for story claims; one per loop process
+CLAIM_WORKER="loop-$(hostname 2>/dev/null || echo local)-$$"
+CLAIMED_STORY=""
+CLAIMED_PRD=""
+
+select_story_claimed() {
+  # Claim the next ready story through prd-parser.py claim_stories and write
+  # the same meta/block files as select_story. When every ready story is
+  # claimed by another worker, waits for one to be released or completed.
+  # Usage: select_story_claimed "$prd_path" "$meta_out" "$block_out"
+  local prd_path="$1"
+  local meta_out="$2"
+  local block_out="$3"
+  local block_dir="$TMP_DIR/claims-$$"
+  local claim total remaining id title
+
+  release_story_claim
+  while true; do
+    # Totals (and the no-stories case) come from the plain selection
+    select_story "$meta_out" "$block_out" || return 1
+    remaining="$(story_field "$meta_out" remaining)"
+    [ -n "$remaining" ] && [ "$remaining" != "0" ] || return 0
+    total="$(story_field "$meta_out" total)"
+
+    claim="$(prd_helper_call claim_stories "$prd_path" --worker "$CLAIM_WORKER" --block-dir "$block_dir")" || return 1
+    if [[ "$claim" =~ \"id\":\ \"([^\"]+)\" ]]; then
+      id="${BASH_REMATCH[1]}"
+      title=""
+      if [[ "$claim" =~ \"title\":\ \"((\\.|[^\"\\])*)\" ]]; then
+        title="${BASH_REMATCH[1]}"
+      fi
+      # title is still JSON-escaped, so it is written back as is
+      printf '{\n  "ok": true,\n  "total": %s,\n  "remaining": %s,\n  "id": "%s",\n  "title": "%s"\n}\n' \
+        "$total" "$remaining" "$id" "$title" > "$meta_out"
+      mv -f "$block_dir/$id.md" "$block_out"
+      CLAIMED_STORY="$id"
+      CLAIMED_PRD="$prd_path"
+      return 0
+    fi
+    msg_dim "All ready stories are claimed by other workers; waiting..."
+    sleep 5
+  done
+}
+
+release_story_claim() {
+  # Release this worker's claim on its current story, if it holds one
+  # Usage: release_story_claim
+  [ -n "$CLAIMED_STORY" ] || return 0
+  prd_helper_call release_claim "$CLAIMED_PRD" "$CLAIMED_STORY" "$CLAIM_WORKER" >/dev/null 2>&1 || true
+  CLAIMED_STORY=""
+}
+
 # ─────────────────────────────────────────────────────────────────────────────
 # TypeScript Story Selection Integration (US-015)
 # NOTE: The TypeScript module is now integrated into the main functions above
@@ -1446,6 +1275,55 @@ get_state_cli() {
   get_lib_cli "state/cli.js"
 }
 
+# True if a <log>.lock directory was left behind: the same rules as
+# BuildStateManager and prd-parser.py use (holder dead, lock older than five
+# minutes, or no pid file written within a few seconds)
+log_lock_is_stale() {
+  local lock="$1"
+  local info="" pid="" stamp="" mtime
+  info="$(cat "$lock/pid" 2>/dev/null)" || info=""
+  if [[ "$info" =~ \"pid\":[[:space:]]*([0-9]+) ]] || [[ "$info" =~ ^([0-9]+)$ ]]; then
+    pid="${BASH_REMATCH[1]}"
+  fi
+  if [ -z "$pid" ]; then
+    mtime=$(stat -c %Y "$lock" 2>/dev/null || stat -f %m "$lock" 2>/dev/null || echo "")
+    [ -n "$mtime" ] && [ $(( $(date +%s) - mtime )) -gt 5 ]
+    return
+  fi
+  if [[ "$info" =~ \"timestamp\":[[:space:]]*([0-9]+) ]]; then
+    stamp="${BASH_REMATCH[1]}"
+    [ $(( $(date +%s) - stamp / 1000 )) -gt 300 ] && return 0
+  fi
+  ! kill -0 "$pid" 2>/dev/null && ! ps -p "$pid" >/dev/null 2>&1
+}
+
+# Append a line to a live log under its <log>.lock directory, the lock
+# BuildStateManager and prd-parser.py rotate_logs take. Stale locks are
+# broken; a lock still held after 30s drops the line with a warning rather
+# than appending unlocked.
+append_log_line() {
+  local file="$1"
+  local line="$2"
+  local lock="${file}.lock"
+  local tries=0
+
+  while ! mkdir "$lock" 2>/dev/null; do
+    if log_lock_is_stale "$lock"; then
+      rm -rf "$lock"
+      continue
+    fi
+    tries=$((tries + 1))
+    if [ "$tries" -ge 600 ]; then
+      msg_warn "Log lock $lock held for 30s; dropped: $line" >&2
+      return 1
+    fi
+    sleep 0.05
+  done
+  printf '{"pid":%d,"timestamp":%d000}' "$BASHPID" "$(date +%s)" > "$lock/pid" 2>/dev/null || true
+  echo "$line" >> "$file"
+  rm -rf "$lock"
+}
+
 # Transactional log_activity using BuildStateManager (US-016)
 # Falls back to direct append if Node.js not available
 log_activity() {
@@ -1459,10 +1337,10 @@ log_activity() {
   if [[ -n "$state_cli" && -n "${PRD_FOLDER:-}" ]]; then
     # Use transactional update via BuildStateManager
     node "$state_cli" log-activity "$PRD_FOLDER" "$message" --json >/dev/null 2>&1 || \
-      echo "[$timestamp] $message" >> "$ACTIVITY_LOG_PATH"
+      append_log_line "$ACTIVITY_LOG_PATH" "[$timestamp] $message"
   else
     # Fallback: direct append
-    echo "[$timestamp] $message" >> "$ACTIVITY_LOG_PATH"
+    append_log_line "$ACTIVITY_LOG_PATH" "[$timestamp] $message"
   fi
 }
 
@@ -1502,7 +1380,7 @@ log_error() {
   local message="$1"
   local timestamp
   timestamp=$(date '+%Y-%m-%d %H:%M:%S')
-  echo "[$timestamp] $message" >> "$ERRORS_LOG_PATH"
+  append_log_line "$ERRORS_LOG_PATH" "[$timestamp] $message"
 }
 
 # Get path to checkpoint CLI (returns empty if unavailable)
@@ -2435,6 +2313,15 @@ print_summary_table() {
 
 append_run_summary() {
   local line="$1"
+  # The helper appends to the run-summary sidecar instead of rewriting
+  # activity.log on every iteration. Its failures are not retried inline,
+  # since the line may already be in the sidecar
+  if [ -f "$PRD_PARSER_PY" ]; then
+    prd_helper_call append_run_summary "$ACTIVITY_LOG_PATH" "$line"
+    return $?
+  fi
+
+  # Fallback: rewrite the log inline if the helper is missing
   python3 - "$ACTIVITY_LOG_PATH" "$line" <<'PY'
 import sys
 from pathlib import Path
@@ -2463,6 +2350,22 @@ Path(path).write_text("\n".join(out).rstrip() + "\n")
 PY
 }
 
+# Seal old activity.log/errors.log entries of the PRD folder into gzipped
+# segments under logs/ once a log outgrows the rotation size (1MB default)
+rotate_prd_logs() {
+  local prd_folder
+  prd_folder="$(dirname "$PRD_PATH")"
+  [ "$(dirname "$ACTIVITY_LOG_PATH")" = "$prd_folder" ] || return 0
+  prd_helper_call rotate_logs "$prd_folder" >/dev/null 2>&1 || true
+}
+
+# Fold run summaries still pending in the sidecar (lock was busy) into
+# activity.log, so readers of the log see every run
+flush_activity_log() {
+  [ -f "${ACTIVITY_LOG_PATH:-}" ] && [ -f "$PRD_PARSER_PY" ] || return 0
+  prd_helper_call materialize_activity_log "$ACTIVITY_LOG_PATH" 2>/dev/null || true
+}
+
 # Write run metadata using external Python script
 # Usage: write_run_meta <output_path> <json_data>
 # Where json_data is a JSON object containing all metadata fields
@@ -2470,14 +2373,14 @@ write_run_meta() {
   local output_path="$1"
   local json_data="$2"
 
-  # Create temporary JSON file
-  local json_tmp
-  json_tmp="$(mktemp)"
-  register_temp_file "$json_tmp"  # P2.1: register for cleanup
-  echo "$json_data" > "$json_tmp"
-
-  # Call Python script to generate markdown
-  if ! python3 "$SCRIPT_DIR/lib/run-meta-writer.py" "$json_tmp" "$output_path" 2>/dev/null; then
+  # Render the markdown with the actual cost and read back the token fields
+  # in one process (pricing comes from config.sh overrides or the defaults);
+  # the fields are declared local so the eval does not leak them
+  local input_tokens="" output_tokens="" routed_model="" token_model="" actual_cost=""
+  local finalized
+  if finalized="$(printf '%s\n' "$json_data" | python3 "$SCRIPT_DIR/lib/run-meta-writer.py" finalize "$output_path" --config "$CONFIG_FILE" 2>/dev/null)"; then
+    eval "$finalized"
+  else
     # Fallback: write minimal metadata if Python script fails
     {
       echo "# Ralph Run Summary"
@@ -2488,32 +2391,6 @@ write_run_meta() {
       echo "$json_data"
     } > "$output_path"
   fi
-
-  # Clean up temp file
-  rm -f "$json_tmp"
-
-  # Handle actual cost calculation if needed (requires bash routing lib)
-  # Extract values from JSON for cost calculation
-  local input_tokens output_tokens routed_model token_model
-  input_tokens="$(echo "$json_data" | python3 -c "import json,sys; d=json.load(sys.stdin); print(d.get('input_tokens',''))" 2>/dev/null || echo "")"
-  output_tokens="$(echo "$json_data" | python3 -c "import json,sys; d=json.load(sys.stdin); print(d.get('output_tokens',''))" 2>/dev/null || echo "")"
-  routed_model="$(echo "$json_data" | python3 -c "import json,sys; d=json.load(sys.stdin); print(d.get('routed_model',''))" 2>/dev/null || echo "")"
-  token_model="$(echo "$json_data" | python3 -c "import json,sys; d=json.load(sys.stdin); print(d.get('token_model',''))" 2>/dev/null || echo "")"
-
-  # Calculate and append actual cost if we have the data
-  if [[ -n "$input_tokens" ]] && [[ "$input_tokens" != "null" ]] && [[ -n "$output_tokens" ]] && [[ "$output_tokens" != "null" ]]; then
-    local cost_model="${routed_model:-$token_model}"
-    if [[ -n "$cost_model" ]] && [[ "$cost_model" != "null" ]]; then
-      local actual_cost_json actual_cost
-      actual_cost_json="$(calculate_actual_cost "$input_tokens" "$output_tokens" "$cost_model" 2>/dev/null || echo "")"
-      actual_cost="$(parse_routing_field "$actual_cost_json" "totalCost" 2>/dev/null || echo "")"
-      if [[ -n "$actual_cost" ]] && [[ "$actual_cost" != "null" ]]; then
-        # Insert actual cost into the markdown file (replace placeholder line)
-        sed -i.bak "s|- Actual tokens: \([0-9]*\) (input: \([0-9]*\), output: \([0-9]*\))|- Actual tokens: \1 (input: \2, output: \3)\n- Actual cost: \$$actual_cost|g" "$output_path"
-        rm -f "${output_path}.bak"
-      fi
-    fi
-  fi
 }
 
 # Generate context summary for a story
@@ -3327,8 +3204,12 @@ stop_progress_indicator() {
 }
 
 # Ensure progress indicator is stopped and temp files cleaned on exit/interrupt (P2.1)
-# Ensure cleanup on exit/interrupt: stop indicators, stall detector, and clean temp files (P2.1, US-009)
-trap 'stop_progress_indicator; stop_stall_detector; cleanup_temp_files' EXIT INT TERM
+# Ensure cleanup on exit/interrupt: stop indicators, stall detector, flush pending run summaries, stop the prd-parser helper, and clean temp files (P2.1, US-009)
+trap 'stop_progress_indicator; stop_stall_detector; flush_activity_log; release_story_claim; prd_helper_stop; cleanup_temp_files' EXIT INT TERM
+
+# Keep one prd-parser.py process for the whole build; prd_helper_call spawns
+# python3 per call instead if it cannot start
+prd_helper_start || true
 
 # Resume mode handling
 START_ITERATION=1
@@ -3793,6 +3674,7 @@ for i in $(seq $START_ITERATION "$MAX_ITERATIONS"); do
     'input_tokens': '$TOKEN_INPUT',
     'output_tokens': '$TOKEN_OUTPUT',
     'token_model': '$TOKEN_MODEL',
+    'agent': '$DEFAULT_AGENT_NAME',
     'token_estimated': '$TOKEN_ESTIMATED',
     'retry_count': '$LAST_RETRY_COUNT',
     'retry_time': '$LAST_RETRY_TOTAL_TIME',
@@ -3834,6 +3716,7 @@ for i in $(seq $START_ITERATION "$MAX_ITERATIONS"); do
   else
     append_run_summary "$(date '+%Y-%m-%d %H:%M:%S') | run=$RUN_TAG | iter=$i | mode=$MODE | duration=${ITER_DURATION}s | status=$STATUS_LABEL | cost=${ITERATION_COST:-0}"
   fi
+  rotate_prd_logs
 
   if [ "$MODE" = "build" ]; then
     # Use locked story selection to prevent parallel builds picking same story (P1.3)
@@ -3936,6 +3819,11 @@ for i in $(seq $START_ITERATION "$MAX_ITERATIONS"); do
 
               RETRY_END=$(date +%s)
               RETRY_DURATION=$((RETRY_END - RETRY_START))
+              if [ "$RETRY_STATUS" -eq 0 ]; then
+                record_retry_outcome "${STORY_ID:-unknown}" success
+              else
+                record_retry_outcome "${STORY_ID:-unknown}" failure
+              fi
 
               # Track retry attempt in history (P1.4)
               if [ -n "$RETRY_HISTORY_THIS_ITERATION" ]; then
@@ -3986,6 +3874,7 @@ for i in $(seq $START_ITERATION "$MAX_ITERATIONS"); do
                   'input_tokens': '',
                   'output_tokens': '',
                   'token_model': '',
+                  'agent': '$DEFAULT_AGENT_NAME',
                   'token_estimated': 'false',
                   'retry_count': '0',
                   'retry_time': '0',
@@ -47,6 +47,12 @@ ${pc.bold("Examples:")}
       }
       fs.mkdirSync(path.dirname(localDir), { recursive: true });
       fs.cpSync(globalDir, localDir, { recursive: true, force: true });
+      // Precompile the Python helpers so the loop loads cached bytecode
+      try {
+        execSync(`python3 -m compileall -q "${path.join(localDir, "lib")}"`, { stdio: "ignore" });
+      } catch {
+        // No python3 here; loop.sh compiles them on its first run
+      }
       success(`Installed .agents/ralph to ${pc.cyan(localDir)}`);
     }
 
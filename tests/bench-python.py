@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the Python helper libraries (prd_parser, run_meta_writer).
+
+Generates synthetic fixtures (PRDs from 10 to 100k stories with code fences,
+a huge story block, large failure and activity logs), runs each helper
+command as a fresh process the way loop.sh does, and reports median/p95
+wall time and peak RSS per case as JSON. Results are compared against a
+stored baseline; a case regresses when its median time or peak RSS grows
+by more than the threshold. Importing each helper module must also stay
+within its import-time budget (time over bare interpreter startup), measured
+with bytecode precompiled the way `ralph install` and loop.sh leave it.
+
+Usage:
+    python3 tests/bench-python.py [--quick] [--runs N] [--output FILE]
+                                  [--baseline FILE] [--update-baseline]
+                                  [--threshold RATIO]
+
+Exit status is 1 when any case regressed against the baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+RALPH_DIR = ROOT_DIR / ".agents" / "ralph"
+LIB_DIR = RALPH_DIR / "lib"
+PRD_PARSER = LIB_DIR / "prd-parser.py"
+RUN_META_WRITER = LIB_DIR / "run-meta-writer.py"
+DEFAULT_BASELINE = ROOT_DIR / "tests" / "fixtures" / "bench" / "python-baseline.json"
+
+# Medians below this many milliseconds apart are treated as noise
+NOISE_FLOOR_MS = 5.0
+
+# Allowed median import time of each helper module over bare startup ("startup")
+IMPORT_BUDGET_MS = {
+    "prd_parser": 25.0,
+    "run_meta_writer": 15.0,
+}
+
+
+def write_prd(path: Path, stories: int, fence_every: int = 10) -> None:
+    """Write a PRD with `stories` stories; the first half are done and every
+    `fence_every`-th block carries a code fence with a fake story header."""
+    with open(path, "w") as f:
+        f.write("# Product Requirements\n\n## Overview\nSynthetic PRD for benchmarks.\n\n")
+        for i in range(1, stories + 1):
+            status = "x" if i <= stories // 2 else " "
+            f.write(f"### [{status}] US-{i:03d}: Story number {i}\n")
+            f.write(f"As a user I want feature {i} so that things work.\n\n")
+            f.write("#### Acceptance Criteria\n- [ ] First criterion\n- [ ] Second criterion\n")
+            if i > 1 and i % 7 == 0:
+                f.write(f"Depends on: US-{i - 1:03d}\n")
+            if i % fence_every == 0:
+                f.write("```\n### [ ] US-999999: Header inside a code fence\n```\n")
+            f.write("\n")
+
+
+def write_huge_block_prd(path: Path, block_bytes: int) -> None:
+    """Write a PRD whose only open story has a block of about `block_bytes`."""
+    line = "Detailed notes about the implementation of this story. " * 2 + "\n"
+    with open(path, "w") as f:
+        f.write("# PRD\n\n### [x] US-001: Done\nDone.\n\n### [ ] US-002: Huge story\n")
+        f.write(line * (block_bytes // len(line)))
+
+
+def write_failure_log(path: Path, size: int) -> None:
+    """Write an agent log of about `size` bytes ending in a test failure."""
+    noise = "  compiling src/components/widget.ts ... ok (12ms)\n"
+    with open(path, "w") as f:
+        f.write(noise * (size // len(noise)))
+        f.write("FAIL src/app.test.ts\nTypeError: Cannot read properties of undefined (reading 'id')\n")
+        f.write("  expect(received).toBe(expected)\nTests: 1 failed, 41 passed\n")
+
+
+def write_activity_log(path: Path, size: int) -> None:
+    """Write an activity log of about `size` bytes."""
+    event = "[2026-01-16 10:00:00] ITERATION 1 start (mode=build story=US-001)\n"
+    with open(path, "w") as f:
+        f.write("# Activity Log\n\n## Run Summary\n- 2026-01-16 10:00:00 | run=1 | status=success\n\n")
+        f.write("## Events\n\n")
+        f.write(event * (size // len(event)))
+
+
+def build_fixtures(work: Path, quick: bool) -> dict:
+    """Generate fixtures under `work` and return the paths by name."""
+    sizes = (10, 1000, 10000) if quick else (10, 1000, 100000)
+    fx = {"prd_sizes": sizes}
+    for n in sizes:
+        write_prd(work / f"prd-{n}.md", n)
+    write_huge_block_prd(work / "prd-huge-block.md", (2 if quick else 20) * 1024 * 1024)
+    write_failure_log(work / "failure.log", (5 if quick else 50) * 1024 * 1024)
+    write_activity_log(work / "activity-small.log", 8 * 1024)
+    write_activity_log(work / "activity-large.log", (5 if quick else 20) * 1024 * 1024)
+
+    (work / "vars.json").write_text(json.dumps({
+        "PRD_PATH": str(work / "prd-1000.md"), "PLAN_PATH": "plan.md", "AGENTS_PATH": "AGENTS.md",
+        "PROGRESS_PATH": "progress.md", "REPO_ROOT": str(work), "GUARDRAILS_PATH": "guardrails.md",
+        "ERRORS_LOG_PATH": "errors.log", "ACTIVITY_LOG_PATH": "activity.log", "RUN_ID": "bench",
+        "ITERATION": "1", "RUN_LOG_PATH": "run.log", "RUN_META_PATH": "run.md",
+    }))
+    (work / "meta.json").write_text(json.dumps({"id": "US-501", "title": "Story number 501"}))
+    (work / "block.txt").write_text("### [ ] US-501: Story number 501\nAs a user I want things.\n")
+    (work / "run.json").write_text(json.dumps({
+        "mode": "build", "iteration": "3", "run_id": "bench", "story_id": "US-501",
+        "story_title": "Story number 501", "started": "2026-01-16 10:00:00",
+        "ended": "2026-01-16 10:05:00", "duration": "300", "status": "success",
+        "log_file": "run.log", "head_before": "abc1234", "head_after": "def5678",
+        "commit_list": "- def5678 Add feature", "changed_files": "- src/app.ts",
+        "dirty_files": "", "input_tokens": "12000", "output_tokens": "3400",
+        "token_model": "sonnet", "token_estimated": "false", "retry_count": "0", "retry_time": "0",
+    }))
+    return fx
+
+
+def build_cases(work: Path, fx: dict) -> list:
+    """Return benchmark cases as (name, argv, reset) tuples; reset runs
+    before every measured run to restore the starting state."""
+    py = sys.executable
+    pp = [py, str(PRD_PARSER)]
+
+    def drop_index(prd):
+        def reset():
+            for p in work.glob(f".{Path(prd).stem}.story-index.json"):
+                p.unlink()
+        return reset
+
+    def noop():
+        pass
+
+    cases = [("startup", [py, "-c", "pass"], noop)]
+    for module in IMPORT_BUDGET_MS:
+        cases.append((f"import/{module}",
+                      [py, "-c", f"import sys; sys.path.insert(0, {str(LIB_DIR)!r}); import {module}"], noop))
+    for n in fx["prd_sizes"]:
+        prd = str(work / f"prd-{n}.md")
+        argv = pp + ["select_story", prd, str(work / "sel-meta.json"), str(work / "sel-block.txt")]
+        cases.append((f"select_story/{n}/cold", argv, drop_index(prd)))
+        cases.append((f"select_story/{n}/warm", argv, noop))
+    huge = str(work / "prd-huge-block.md")
+    cases.append(("select_story/huge_block", pp + ["select_story", huge, str(work / "hb-meta.json"),
+                                                   str(work / "hb-block.txt")], noop))
+
+    template = str(RALPH_DIR / "PROMPT_build.md")
+    retry_template = str(RALPH_DIR / "PROMPT_retry.md")
+    cases.append(("render_prompt", pp + ["render_prompt", template, str(work / "out.md"),
+                                         str(work / "vars.json"), str(work / "meta.json"),
+                                         str(work / "block.txt")], noop))
+    cases.append(("render_prompt/huge_block", pp + ["render_prompt", template, str(work / "out.md"),
+                                                    str(work / "vars.json"), str(work / "hb-meta.json"),
+                                                    str(work / "hb-block.txt")], noop))
+
+    def drop_failure_cache():
+        for p in work.glob(".failure-cache.json"):
+            p.unlink()
+
+    cases.append(("render_retry_prompt/large_log", pp + ["render_retry_prompt", retry_template,
+                                                         str(work / "out.md"), str(work / "vars.json"),
+                                                         str(work / "meta.json"), str(work / "block.txt"),
+                                                         str(work / "failure.log"), "2", "3"],
+                  drop_failure_cache))
+
+    for name in ("small", "large"):
+        log = str(work / f"activity-{name}.log")
+        cases.append((f"append_run_summary/{name}_log",
+                      pp + ["append_run_summary", log, "2026-01-16 10:05:00 | run=bench | status=success"],
+                      noop))
+
+    cases.append(("write_run_metadata", [py, str(RUN_META_WRITER), str(work / "run.json"),
+                                         str(work / "run.md")], noop))
+    return cases
+
+
+# Child processes inherit the spawning process's resident size in ru_maxrss
+# (Linux keeps the high-water mark across fork and exec), so commands are
+# spawned by this small launcher, started before any fixture is generated,
+# instead of by the benchmark process itself.
+LAUNCHER_SRC = r"""
+import json, os, sys, time
+for line in sys.stdin:
+    req = json.loads(line)
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0); os.dup2(devnull, 1); os.dup2(devnull, 2)
+        os.chdir(req["cwd"])
+        try:
+            os.execv(req["argv"][0], req["argv"])
+        finally:
+            os._exit(127)
+    _, status, usage = os.wait4(pid, 0)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(json.dumps({"ms": elapsed, "maxrss": usage.ru_maxrss,
+                      "status": os.waitstatus_to_exitcode(status)}), flush=True)
+"""
+
+
+class Launcher:
+    """Runs commands from a separate small process and reports their usage."""
+
+    def __init__(self):
+        self.proc = subprocess.Popen([sys.executable, "-S", "-c", LAUNCHER_SRC],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def measure(self, argv: list, cwd: Path) -> tuple:
+        """Run argv once; return (wall milliseconds, peak RSS in KB)."""
+        self.proc.stdin.write(json.dumps({"argv": argv, "cwd": str(cwd)}) + "\n")
+        self.proc.stdin.flush()
+        result = json.loads(self.proc.stdout.readline())
+        if result["status"] != 0:
+            raise RuntimeError(f"command failed ({result['status']}): {' '.join(argv)}")
+        # ru_maxrss is KB on Linux and bytes on macOS
+        rss = result["maxrss"] // 1024 if sys.platform == "darwin" else result["maxrss"]
+        return result["ms"], rss
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def run_cases(launcher: Launcher, cases: list, work: Path, runs: int) -> dict:
+    results = {}
+    for name, argv, reset in cases:
+        reset()
+        launcher.measure(argv, work)  # warm the page cache and any on-disk caches
+        times, rss = [], []
+        for _ in range(runs):
+            reset()
+            elapsed, peak = launcher.measure(argv, work)
+            times.append(elapsed)
+            rss.append(peak)
+        results[name] = {
+            "median_ms": round(percentile(times, 50), 2),
+            "p95_ms": round(percentile(times, 95), 2),
+            "max_rss_kb": max(rss),
+        }
+        print(f"  {name:<36} median {results[name]['median_ms']:>9.2f} ms  "
+              f"p95 {results[name]['p95_ms']:>9.2f} ms  rss {results[name]['max_rss_kb']:>8} KB",
+              file=sys.stderr)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return a list of regression descriptions against the baseline."""
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if (cur["median_ms"] > base["median_ms"] * (1 + threshold) and
+                cur["median_ms"] - base["median_ms"] > NOISE_FLOOR_MS):
+            regressions.append(f"{name}: median {base['median_ms']} -> {cur['median_ms']} ms")
+        if cur["max_rss_kb"] > base["max_rss_kb"] * (1 + threshold):
+            regressions.append(f"{name}: peak RSS {base['max_rss_kb']} -> {cur['max_rss_kb']} KB")
+    return regressions
+
+
+def check_import_budget(results: dict) -> list:
+    """Return a list of modules whose import time exceeds their budget."""
+    over = []
+    for module, budget in IMPORT_BUDGET_MS.items():
+        spent = results[f"import/{module}"]["median_ms"] - results["startup"]["median_ms"]
+        if spent > budget:
+            over.append(f"import/{module}: {spent:.2f} ms over startup exceeds the {budget} ms budget")
+    return over
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Ralph's Python helper libraries")
+    parser.add_argument("--quick", action="store_true", help="smaller fixtures (10k stories max)")
+    parser.add_argument("--runs", type=int, default=5, help="measured runs per case (default 5)")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="baseline JSON to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed growth before a case counts as regressed (default 0.25)")
+    args = parser.parse_args()
+
+    launcher = Launcher()
+    subprocess.run([sys.executable, "-m", "compileall", "-q", str(LIB_DIR)], check=True)
+    work = Path(tempfile.mkdtemp(prefix="ralph-bench-"))
+    try:
+        print(f"Generating fixtures in {work}...", file=sys.stderr)
+        fx = build_fixtures(work, args.quick)
+        results = run_cases(launcher, build_cases(work, fx), work, args.runs)
+    finally:
+        launcher.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": f"{platform.system()}-{platform.machine()}",
+        "quick": args.quick,
+        "runs": args.runs,
+        "results": results,
+    }
+
+    baseline_path = Path(args.baseline)
+    regressions = []
+    if args.update_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Baseline written to {baseline_path}", file=sys.stderr)
+    elif baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text())
+        if baseline.get("quick") != args.quick:
+            print("Baseline was recorded with a different fixture size; skipping comparison", file=sys.stderr)
+        else:
+            regressions = compare(results, baseline.get("results", {}), args.threshold)
+    regressions += check_import_budget(results)
+    report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    print(text)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,7 @@
 // Run: node tests/lib-python.mjs
 
 import { execSync, spawnSync } from 'child_process';
-import { mkdtempSync, writeFileSync, readFileSync, rmSync } from 'fs';
+import { mkdtempSync, mkdirSync, writeFileSync, readFileSync, rmSync, existsSync } from 'fs';
 import { join } from 'path';
 import { tmpdir } from 'os';
 import { fileURLToPath } from 'url';
@@ -50,7 +50,7 @@ function testPrdParser() {
   // Test: Script compiles
   runTest();
   try {
-    const result = spawnSync('python3', ['-m', 'py_compile', prdParser], { encoding: 'utf8' });
+    const result = spawnSync('python3', ['-m', 'py_compile', join(LIB_DIR, 'prd_parser.py')], { encoding: 'utf8' });
     if (result.status === 0) {
       pass('prd-parser.py compiles without error');
     } else {
@@ -74,6 +74,33 @@ function testPrdParser() {
     fail('prd-parser.py usage check error', e.message);
   }
 
+  // Test: too many arguments is a usage error, not a traceback
+  runTest();
+  try {
+    const result = spawnSync('python3', [prdParser, 'story_index', 'a', 'b'], { encoding: 'utf8' });
+    if (result.status === 1 && result.stderr.trim() === 'Usage: story_index <prd_path>') {
+      pass('prd-parser.py rejects extra arguments with the command usage');
+    } else {
+      fail('prd-parser.py extra arguments unexpected', result.stderr.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py extra arguments error', e.message);
+  }
+
+  // Test: the module runs with python3 -m once the lib directory is on the path
+  runTest();
+  try {
+    const env = { ...process.env, PYTHONPATH: LIB_DIR };
+    const result = spawnSync('python3', ['-m', 'prd_parser', 'unknown_command'], { encoding: 'utf8', env });
+    if (result.stdout.includes('Commands:') && result.stderr.includes('Unknown command')) {
+      pass('prd_parser runs as python3 -m prd_parser');
+    } else {
+      fail('python3 -m prd_parser did not run the CLI', result.stderr.substring(0, 200));
+    }
+  } catch (e) {
+    fail('python3 -m prd_parser error', e.message);
+  }
+
   // Test: select_story command with PRD
   runTest();
   const tempDir = mkdtempSync(join(tmpdir(), 'ralph-test-'));
@@ -136,6 +163,686 @@ Test PRD
     fail('prd-parser.py story_field error', e.message);
   }
 
+  // Test: story index is cached next to the PRD and refreshed after an edit
+  runTest();
+  try {
+    const editedPrd = join(tempDir, 'prd-edit.md');
+    writeFileSync(editedPrd, testPrd);
+    spawnSync('python3', [prdParser, 'select_story', editedPrd, join(tempDir, 'm2.json'), join(tempDir, 'b2.txt')], { encoding: 'utf8' });
+    writeFileSync(editedPrd, testPrd.replace('### [ ] US-001', '### [x] US-001'));
+    spawnSync('python3', [prdParser, 'select_story', editedPrd, join(tempDir, 'm2.json'), join(tempDir, 'b2.txt')], { encoding: 'utf8' });
+    const meta = JSON.parse(readFileSync(join(tempDir, 'm2.json'), 'utf8'));
+    const hasIndex = existsSync(join(tempDir, '.prd-edit.story-index.json'));
+    if (hasIndex && meta.ok && meta.remaining === 0 && meta.total === 2) {
+      pass('prd-parser.py story index tracks checkbox edits');
+    } else {
+      fail('prd-parser.py story index returned stale data', JSON.stringify(meta));
+    }
+  } catch (e) {
+    fail('prd-parser.py story index error', e.message);
+  }
+
+  // Test: render_prompt substitutes in one pass and reports unresolved placeholders
+  runTest();
+  try {
+    const tplFile = join(tempDir, 'tpl.md');
+    const varsFile = join(tempDir, 'vars.json');
+    const renderOut = join(tempDir, 'rendered.md');
+    writeFileSync(tplFile, 'Story {{STORY_ID}} in {{PRD_PATH}} ({{MISSING_VAR}})\n');
+    writeFileSync(varsFile, JSON.stringify({ PRD_PATH: '{{STORY_ID}}' }));
+    const result = spawnSync('python3', [prdParser, 'render_prompt', tplFile, renderOut, varsFile, metaOut], { encoding: 'utf8' });
+    const rendered = readFileSync(renderOut, 'utf8');
+    if (rendered === 'Story US-001 in {{STORY_ID}} ({{MISSING_VAR}})\n' && result.stderr.includes('MISSING_VAR')) {
+      pass('prd-parser.py render_prompt reports unresolved placeholders');
+    } else {
+      fail('prd-parser.py render_prompt output unexpected', `${rendered} | ${result.stderr}`);
+    }
+  } catch (e) {
+    fail('prd-parser.py render_prompt error', e.message);
+  }
+
+  // Test: loop.sh render_prompt writes a vars file and renders through prd-parser.py
+  runTest();
+  try {
+    const loopSh = join(LIB_DIR, '..', 'loop.sh');
+    const tplFile = join(tempDir, 'tpl-loop.md');
+    writeFileSync(tplFile, '{{STORY_ID}}|{{CONTEXT_REF}}|{{ACTIVITY_CMD}}|{{RUN_ID}}|{{HISTORICAL_CONTEXT}}\n');
+    const script = [
+      `source "${join(LIB_DIR, 'prd-helper.sh')}"`,
+      'eval "$(sed -n \'/^write_prompt_vars() {/,/^}/p;/^render_prompt() {/,/^}/p\' "$1")"',
+      'PRD_PATH=prd.md PLAN_PATH= AGENTS_PATH= PROGRESS_PATH= ROOT_DIR= GUARDRAILS_PATH= ERRORS_LOG_PATH= ACTIVITY_LOG_PATH=',
+      'GUARDRAILS_REF= NO_COMMIT=false CONTEXT_REF=$\'a\\tb "c"\' ACTIVITY_CMD=\'ralph log "x\\y"\' HISTORICAL_CONTEXT=$\'h\\x01\'',
+      'render_prompt "$2" "$3" "$4" "" RUN-1 1 run.log run.md',
+    ].join('\n');
+    const renderOut = join(tempDir, 'rendered-loop.md');
+    spawnSync('bash', ['-c', script, '_', loopSh, tplFile, renderOut, metaOut], { encoding: 'utf8' });
+    const rendered = readFileSync(renderOut, 'utf8');
+    if (rendered === 'US-001|a\tb "c"|ralph log "x\\y"|RUN-1|h\x01\n' && !existsSync(`${renderOut}.vars.json`)) {
+      pass('loop.sh render_prompt renders through prd-parser.py with a vars file');
+    } else {
+      fail('loop.sh render_prompt output unexpected', JSON.stringify(rendered));
+    }
+  } catch (e) {
+    fail('loop.sh render_prompt error', e.message);
+  }
+
+  // Test: loop.sh story and prompt helpers reuse the build's helper process
+  runTest();
+  try {
+    const loopSh = join(LIB_DIR, '..', 'loop.sh');
+    const script = [
+      `source "${join(LIB_DIR, 'prd-helper.sh')}"`,
+      'eval "$(sed -n \'/^write_prompt_vars() {/,/^}/p;/^render_prompt() {/,/^}/p;/^select_story() {/,/^}/p\' "$1")"',
+      'PRD_PATH="$2" STORY_CLI=/nonexistent',
+      'prd_helper_start',
+      'spawns="$4/spawns.log"',
+      'python3() { echo spawned >> "$spawns"; command python3 "$@"; }',
+      'select_story "$4/loop-meta.json" "$4/loop-block.txt"',
+      'PLAN_PATH= AGENTS_PATH= PROGRESS_PATH= ROOT_DIR= GUARDRAILS_PATH= ERRORS_LOG_PATH= ACTIVITY_LOG_PATH= GUARDRAILS_REF= CONTEXT_REF= ACTIVITY_CMD= NO_COMMIT=false',
+      'render_prompt "$3" "$4/loop-out.md" "$4/loop-meta.json" "$4/loop-block.txt" RUN-1 1 run.log run.md',
+      'prd_helper_stop',
+    ].join('\n');
+    const tplFile = join(tempDir, 'tpl-helper.md');
+    writeFileSync(tplFile, '{{STORY_ID}} {{RUN_ID}}\n');
+    spawnSync('bash', ['-c', script, '_', loopSh, prdFile, tplFile, tempDir], { encoding: 'utf8' });
+    const rendered = readFileSync(join(tempDir, 'loop-out.md'), 'utf8');
+    if (rendered === 'US-001 RUN-1\n' && !existsSync(join(tempDir, 'spawns.log'))) {
+      pass('loop.sh story and prompt calls go through the persistent helper');
+    } else {
+      fail('loop.sh spawned python3 despite the running helper', rendered);
+    }
+  } catch (e) {
+    fail('loop.sh helper routing error', e.message);
+  }
+
+  // Test: loop.sh append_log_line breaks a dead holder's lock but never writes unlocked
+  runTest();
+  try {
+    const loopSh = join(LIB_DIR, '..', 'loop.sh');
+    const logFile = join(tempDir, 'append-lock.log');
+    mkdirSync(`${logFile}.lock`);
+    writeFileSync(`${logFile}.lock/pid`, JSON.stringify({ pid: 999999, timestamp: Date.now() }));
+    const script = [
+      'msg_warn() { echo "$*"; }',
+      'eval "$(sed -n \'/^log_lock_is_stale() {/,/^}/p;/^append_log_line() {/,/^}/p\' "$1")"',
+      'append_log_line "$2" first || echo append-failed',
+      'mkdir "$2.lock" && printf \'{"pid":%d,"timestamp":%d000}\' $$ "$(date +%s)" > "$2.lock/pid"',
+      'sleep() { :; }',
+      'append_log_line "$2" second || echo append-failed',
+    ].join('\n');
+    const result = spawnSync('bash', ['-c', script, '_', loopSh, logFile], { encoding: 'utf8' });
+    const logged = readFileSync(logFile, 'utf8');
+    if (logged === 'first\n' && result.stdout.includes('append-failed') && existsSync(`${logFile}.lock`)) {
+      pass('loop.sh append_log_line recovers stale locks and drops lines under a live lock');
+    } else {
+      fail('loop.sh append_log_line locking unexpected', JSON.stringify(logged) + result.stdout + result.stderr);
+    }
+  } catch (e) {
+    fail('loop.sh append_log_line error', e.message);
+  }
+
+  // Test: loop.sh with STORY_CLAIMS gives parallel workers different stories
+  runTest();
+  try {
+    const loopSh = join(LIB_DIR, '..', 'loop.sh');
+    const claimDir = join(tempDir, 'claims-loop');
+    mkdirSync(claimDir, { recursive: true });
+    const claimPrd = join(claimDir, 'prd.md');
+    writeFileSync(claimPrd, '# PRD\n\n## User Stories\n\n### [ ] US-001: Say "hi"\nfirst\n\n### [ ] US-002: Second\nsecond\n');
+    const script = [
+      'prd="$2"; dir="$3"',
+      `source "${join(LIB_DIR, 'prd-helper.sh')}"`,
+      'msg_dim() { :; }',
+      'eval "$(sed -n \'/^select_story() {/,/^}/p;/^story_field() {/,/^}/p;/^select_story_claimed() {/,/^}/p;/^release_story_claim() {/,/^}/p\' "$1")"',
+      'PRD_PATH="$prd" STORY_CLI=/nonexistent TMP_DIR="$dir" CLAIMED_STORY=""',
+      'CLAIM_WORKER=a; select_story_claimed "$prd" "$dir/a.json" "$dir/a.md"',
+      'CLAIMED_STORY=""; CLAIM_WORKER=b; select_story_claimed "$prd" "$dir/b.json" "$dir/b.md"',
+      'release_story_claim',
+      'ls "$dir/.claims"',
+    ].join('\n');
+    const result = spawnSync('bash', ['-c', script, '_', loopSh, claimPrd, claimDir], { encoding: 'utf8' });
+    const a = JSON.parse(readFileSync(join(claimDir, 'a.json'), 'utf8'));
+    const b = JSON.parse(readFileSync(join(claimDir, 'b.json'), 'utf8'));
+    if (a.id === 'US-001' && a.title === 'Say "hi"' && a.remaining === 2 && b.id === 'US-002' &&
+        readFileSync(join(claimDir, 'b.md'), 'utf8').includes('second') &&
+        result.stdout.includes('US-001.claim') && !result.stdout.includes('US-002.claim')) {
+      pass('loop.sh story claims hand parallel workers different stories');
+    } else {
+      fail('loop.sh story claims unexpected', JSON.stringify([a, b]) + result.stdout + result.stderr);
+    }
+  } catch (e) {
+    fail('loop.sh story claims error', e.message);
+  }
+
+  // Test: render_prompt streams the story block file into the output
+  runTest();
+  try {
+    const tplFile = join(tempDir, 'tpl-block.md');
+    const varsFile = join(tempDir, 'vars-block.json');
+    const renderOut = join(tempDir, 'rendered-block.md');
+    const bigBlock = '### [ ] US-001: First story\n' + 'detail line\n'.repeat(20000);
+    writeFileSync(join(tempDir, 'big-block.txt'), bigBlock);
+    writeFileSync(tplFile, 'BEGIN\n{{STORY_BLOCK}}END\n');
+    writeFileSync(varsFile, '{}');
+    spawnSync('python3', [prdParser, 'render_prompt', tplFile, renderOut, varsFile, metaOut, join(tempDir, 'big-block.txt')], { encoding: 'utf8' });
+    if (readFileSync(renderOut, 'utf8') === `BEGIN\n${bigBlock}END\n`) {
+      pass('prd-parser.py render_prompt streams large story blocks');
+    } else {
+      fail('prd-parser.py render_prompt streamed output mismatch');
+    }
+  } catch (e) {
+    fail('prd-parser.py render_prompt streaming error', e.message);
+  }
+
+  // Test: batch runs a manifest of operations in one process
+  runTest();
+  try {
+    const manifest = {
+      vars: { PRD_PATH: prdFile },
+      ops: [
+        { id: 'select', command: 'select_story', args: [prdFile, join(tempDir, 'bm.json'), join(tempDir, 'bb.txt')] },
+        { id: 'field', command: 'story_field', args: [join(tempDir, 'bm.json'), 'title'] },
+        { id: 'render', command: 'render_prompt', args: [join(tempDir, 'tpl.md'), join(tempDir, 'batch-out.md'), '@vars', join(tempDir, 'bm.json')] },
+      ],
+    };
+    const result = spawnSync('python3', [prdParser, 'batch', '-'], { input: JSON.stringify(manifest), encoding: 'utf8' });
+    const doc = JSON.parse(result.stdout);
+    const rendered = readFileSync(join(tempDir, 'batch-out.md'), 'utf8');
+    if (doc.ok && doc.results[1].output.trim() === 'First story' && rendered.includes(prdFile)) {
+      pass('prd-parser.py batch runs operations with shared vars');
+    } else {
+      fail('prd-parser.py batch returned unexpected results', result.stdout.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py batch error', e.message);
+  }
+
+  // Test: scan_all summarizes every PRD folder
+  runTest();
+  try {
+    const ralphDir = join(tempDir, '.ralph');
+    for (const n of [1, 2]) {
+      mkdirSync(join(ralphDir, `PRD-${n}`), { recursive: true });
+      writeFileSync(join(ralphDir, `PRD-${n}`, 'prd.md'), testPrd);
+    }
+    const result = spawnSync('python3', [prdParser, 'scan_all', ralphDir, '2'], { encoding: 'utf8' });
+    const doc = JSON.parse(result.stdout);
+    if (doc.prds.length === 2 && doc.total === 4 && doc.remaining === 2 && doc.prds[0].next.id === 'US-001') {
+      pass('prd-parser.py scan_all merges per-PRD summaries');
+    } else {
+      fail('prd-parser.py scan_all returned unexpected summary', result.stdout.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py scan_all error', e.message);
+  }
+
+  // Test: ready_stories honours declared dependencies
+  runTest();
+  try {
+    const depPrd = join(tempDir, 'prd-deps.md');
+    writeFileSync(depPrd, [
+      '### [x] US-001: Base',
+      '### [ ] US-002: API',
+      '**Depends on:** US-001',
+      '### [ ] US-003: UI',
+      '- Depends on: US-002',
+      '### [ ] US-004: Standalone',
+      '```',
+      'Depends on: US-003',
+      '```',
+      '',
+    ].join('\n'));
+    const result = spawnSync('python3', [prdParser, 'ready_stories', depPrd], { encoding: 'utf8' });
+    const doc = JSON.parse(result.stdout);
+    const readyIds = doc.ready.map((s) => s.id).join(',');
+    if (readyIds === 'US-002,US-004' && doc.ready[0].critical_path === 2 && doc.blocked[0].id === 'US-003') {
+      pass('prd-parser.py ready_stories orders ready stories by critical path');
+    } else {
+      fail('prd-parser.py ready_stories returned unexpected ready set', result.stdout.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py ready_stories error', e.message);
+  }
+
+  // Test: claim_stories hands distinct stories to different workers
+  runTest();
+  try {
+    const claimPrd = join(tempDir, 'claims', 'prd.md');
+    mkdirSync(join(tempDir, 'claims'), { recursive: true });
+    writeFileSync(claimPrd, '### [ ] US-001: One\n### [ ] US-002: Two\n### [x] US-003: Done\n');
+    const claim = (worker) => JSON.parse(spawnSync('python3', [prdParser, 'claim_stories', claimPrd, '--count', '1', '--worker', worker], { encoding: 'utf8' }).stdout);
+    const first = claim('w1');
+    const second = claim('w2');
+    const third = claim('w3');
+    const again = claim('w1');
+    if (first.claimed[0].id === 'US-001' && second.claimed[0].id === 'US-002' && third.claimed.length === 0 && again.claimed[0].id === 'US-001') {
+      pass('prd-parser.py claim_stories claims distinct stories per worker');
+    } else {
+      fail('prd-parser.py claim_stories returned unexpected claims', JSON.stringify([first, second, third]));
+    }
+  } catch (e) {
+    fail('prd-parser.py claim_stories error', e.message);
+  }
+
+  // Test: concurrent claimers get distinct stories and a half-written claim is not broken
+  runTest();
+  try {
+    const claimPrd = join(tempDir, 'claims-race', 'prd.md');
+    mkdirSync(join(tempDir, 'claims-race', '.claims'), { recursive: true });
+    writeFileSync(claimPrd, [1, 2, 3, 4, 5, 6, 7].map((i) => `### [ ] US-00${i}: Story ${i}\n`).join(''));
+    // A claim another worker has created but not yet filled in
+    writeFileSync(join(tempDir, 'claims-race', '.claims', 'US-001.claim'), '');
+    const out = spawnSync('bash', ['-c',
+      'for w in 1 2 3 4 5 6; do python3 "$0" claim_stories "$1" --count 1 --worker w$w > "$2.$w" & done; wait; cat "$2".*',
+      prdParser, claimPrd, join(tempDir, 'claims-race', 'out')], { encoding: 'utf8' });
+    const ids = out.stdout.split(/\n(?=\{)/).map((doc) => JSON.parse(doc).claimed.map((c) => c.id)).flat();
+    if (ids.length === 6 && new Set(ids).size === 6 && !ids.includes('US-001')) {
+      pass('prd-parser.py claim_stories never hands out a claimed story under concurrency');
+    } else {
+      fail('prd-parser.py claim_stories handed out overlapping claims', JSON.stringify(ids));
+    }
+  } catch (e) {
+    fail('prd-parser.py claim_stories concurrency error', e.message);
+  }
+
+  // Test: large PRDs (memory-mapped) still honour code fences around fake headers
+  runTest();
+  try {
+    const hugePrd = join(tempDir, 'prd-huge.md');
+    const pastedLog = 'log line '.repeat(10) + '\n';
+    writeFileSync(hugePrd, [
+      '### [x] US-001: Done',
+      '```',
+      '### [ ] US-099: Header inside a pasted log',
+      pastedLog.repeat(20000),
+      '```',
+      '### [ ] US-002: Next',
+      'body',
+      '',
+    ].join('\n'));
+    const result = spawnSync('python3', [prdParser, 'select_story', hugePrd, join(tempDir, 'mh.json'), join(tempDir, 'bh.txt')], { encoding: 'utf8' });
+    const meta = JSON.parse(readFileSync(join(tempDir, 'mh.json'), 'utf8'));
+    if (result.status === 0 && meta.id === 'US-002' && meta.total === 2 && readFileSync(join(tempDir, 'bh.txt'), 'utf8') === '### [ ] US-002: Next\nbody') {
+      pass('prd-parser.py select_story handles large PRDs with fenced headers');
+    } else {
+      fail('prd-parser.py large PRD selection wrong', JSON.stringify(meta));
+    }
+  } catch (e) {
+    fail('prd-parser.py large PRD error', e.message);
+  }
+
+  // Test: failure_context keeps the last error region of a large log within budget
+  runTest();
+  try {
+    const bigLog = join(tempDir, 'agent.log');
+    writeFileSync(bigLog, 'ok line\n'.repeat(50000) + 'FAILED test_login: Error: expected 200\n' + 'summary line\n'.repeat(100));
+    const result = spawnSync('python3', [prdParser, 'failure_context', bigLog, '4096'], { encoding: 'utf8' });
+    const out = result.stdout;
+    if (result.status === 0 && Buffer.byteLength(out) < 4200 && out.includes('FAILED test_login') && out.startsWith('[... ')) {
+      pass('prd-parser.py failure_context bounds large logs around the last error');
+    } else {
+      fail('prd-parser.py failure_context returned unexpected excerpt', out.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py failure_context error', e.message);
+  }
+
+  // Test: classify_failure reports keyword and registry signatures in one pass
+  runTest();
+  try {
+    const failLog = join(tempDir, 'fail.log');
+    writeFileSync(failLog, 'CONFLICT (content): Merge conflict in src/app.js\nTypeError: user is undefined\nok\nTypeError: again\n');
+    const result = spawnSync('python3', [prdParser, 'classify_failure', failLog], { encoding: 'utf8' });
+    const doc = JSON.parse(result.stdout);
+    if (doc.codes[0] === 'RALPH-505' && doc.counts.type === 2 && doc.lines.type.join(',') === '2,4' &&
+        doc.analysis.includes('- Type mismatches were detected') && doc.suggestions.includes('- Add null checks and default values')) {
+      pass('prd-parser.py classify_failure counts signatures with line positions');
+    } else {
+      fail('prd-parser.py classify_failure returned unexpected result', result.stdout.substring(0, 300));
+    }
+  } catch (e) {
+    fail('prd-parser.py classify_failure error', e.message);
+  }
+
+  // Test: retries of the same failure reuse the cached analysis and report outcomes
+  runTest();
+  try {
+    const prdDir = join(tempDir, 'PRD-9');
+    mkdirSync(join(prdDir, 'runs'), { recursive: true });
+    const ctxFile = join(prdDir, 'runs', 'failure-context.log');
+    const retryTpl = join(tempDir, 'retry-tpl.md');
+    const retryVars = join(tempDir, 'retry-vars.json');
+    const retryMeta = join(tempDir, 'retry-meta.json');
+    writeFileSync(retryTpl, '{{SUGGESTIONS}}\n');
+    writeFileSync(retryVars, JSON.stringify({ PRD_PATH: join(prdDir, 'prd.md') }));
+    writeFileSync(retryMeta, JSON.stringify({ id: 'US-004', title: 'Retry me' }));
+    const renderRetry = (context) => {
+      writeFileSync(ctxFile, context);
+      spawnSync('python3', [prdParser, 'render_retry_prompt', retryTpl, join(tempDir, 'retry-out.md'), retryVars, retryMeta, '', ctxFile], { encoding: 'utf8' });
+      return readFileSync(join(tempDir, 'retry-out.md'), 'utf8');
+    };
+    renderRetry('12:00:01 FAIL /tmp/a1/app.test.ts:10\nTypeError: x is undefined\n');
+    const outcome = spawnSync('python3', [prdParser, 'retry_outcome', join(prdDir, 'prd.md'), 'US-004', 'success'], { encoding: 'utf8' });
+    const second = renderRetry('13:45:09 FAIL /home/ci/b2/app.test.ts:12\nTypeError: x is undefined\n');
+    if (outcome.stdout.trim() === 'recorded' && second.includes('led to a successful retry 1 of 1 times') &&
+        existsSync(join(prdDir, '.failure-cache.json'))) {
+      pass('prd-parser.py render_retry_prompt reuses cached failure analysis');
+    } else {
+      fail('prd-parser.py failure cache did not report the earlier outcome', second);
+    }
+  } catch (e) {
+    fail('prd-parser.py failure cache error', e.message);
+  }
+
+  // Test: render_retry_prompt refuses to guess the PRD location
+  runTest();
+  try {
+    const noPrdVars = join(tempDir, 'retry-vars-noprd.json');
+    writeFileSync(noPrdVars, '{}');
+    writeFileSync(join(tempDir, 'noprd-failure.log'), 'Error: boom\n');
+    const result = spawnSync('python3', [prdParser, 'render_retry_prompt', join(tempDir, 'tpl.md'), join(tempDir, 'noprd-out.md'),
+      noPrdVars, metaOut, '', join(tempDir, 'noprd-failure.log')], { encoding: 'utf8' });
+    if (result.status === 1 && result.stderr.includes('must set PRD_PATH') && !existsSync(join(tempDir, 'noprd-out.md'))) {
+      pass('prd-parser.py render_retry_prompt requires PRD_PATH');
+    } else {
+      fail('prd-parser.py render_retry_prompt accepted vars without PRD_PATH', result.stderr);
+    }
+  } catch (e) {
+    fail('prd-parser.py render_retry_prompt PRD_PATH error', e.message);
+  }
+
+  // Test: concurrent retries of different stories all land in the failure cache
+  runTest();
+  try {
+    const cacheFile = join(tempDir, 'PRD-9', '.failure-cache.json');
+    const script = 'for w in alpha bravo charlie delta echo foxtrot golf hotel; do python3 -c "$0" "$1" "$2" "$w" & done; wait';
+    const analyze = [
+      'import sys',
+      'from pathlib import Path',
+      'sys.path.insert(0, sys.argv[1])',
+      'import prd_parser',
+      'prd_parser.cached_failure_analysis(Path(sys.argv[2]), "US-" + sys.argv[3], "TypeError: " + sys.argv[3] + " is undefined")',
+    ].join('\n');
+    spawnSync('bash', ['-c', script, analyze, LIB_DIR, cacheFile]);
+    const cache = JSON.parse(readFileSync(cacheFile, 'utf8'));
+    const stories = Object.keys(cache.pending).filter((id) => id !== 'US-004');
+    if (stories.length === 8) {
+      pass('prd-parser.py failure cache keeps every concurrent update');
+    } else {
+      fail('prd-parser.py failure cache lost concurrent updates', JSON.stringify(Object.keys(cache.pending)));
+    }
+  } catch (e) {
+    fail('prd-parser.py concurrent failure cache error', e.message);
+  }
+
+  // Test: run summaries appended to a large activity log land in the log itself
+  runTest();
+  try {
+    const activityLog = join(tempDir, 'big-activity.log');
+    const original = '# Activity Log\n\n## Run Summary\n- old run\n\n## Events\n\n' + '[2026-01-01 00:00:00] event\n'.repeat(5000);
+    writeFileSync(activityLog, original);
+    spawnSync('python3', [prdParser, 'append_run_summary', activityLog, 'run=1']);
+    spawnSync('python3', [prdParser, 'append_run_summary', activityLog, 'run=2']);
+    const live = readFileSync(activityLog, 'utf8');
+    const view = spawnSync('python3', [prdParser, 'activity_log', activityLog], { encoding: 'utf8' }).stdout;
+    if (original.length > 90000 && live.includes('## Run Summary\n- run=2\n- run=1\n- old run\n') && view === live &&
+        !existsSync(`${activityLog}.summary`)) {
+      pass('prd-parser.py append_run_summary writes run summaries into large activity logs');
+    } else {
+      fail('prd-parser.py activity.log is missing appended run summaries', live.substring(0, 120));
+    }
+  } catch (e) {
+    fail('prd-parser.py activity log append error', e.message);
+  }
+
+  // Test: summaries left in the sidecar while the log is locked are folded in by materialize_activity_log
+  runTest();
+  try {
+    const activityLog = join(tempDir, 'locked-activity.log');
+    writeFileSync(activityLog, '# Activity Log\n\n## Run Summary\n\n## Events\n');
+    const script = [
+      'mkdir "$2.lock" && printf \'{"pid":%d,"timestamp":%d000}\' $$ "$(date +%s)" > "$2.lock/pid"',
+      'RALPH_LOG_LOCK_WAIT=0.2 python3 "$1" append_run_summary "$2" run=locked',
+      'rm -rf "$2.lock"',
+    ].join('\n');
+    spawnSync('bash', ['-c', script, '_', prdParser, activityLog]);
+    const pending = !readFileSync(activityLog, 'utf8').includes('run=locked') && existsSync(`${activityLog}.summary`);
+    spawnSync('python3', [prdParser, 'materialize_activity_log', activityLog]);
+    if (pending && readFileSync(activityLog, 'utf8').includes('- run=locked') && !existsSync(`${activityLog}.summary`)) {
+      pass('prd-parser.py materialize_activity_log folds in summaries held back by the lock');
+    } else {
+      fail('prd-parser.py locked run summary was not materialized', readFileSync(activityLog, 'utf8'));
+    }
+  } catch (e) {
+    fail('prd-parser.py locked activity log error', e.message);
+  }
+
+  // Test: rotate_logs seals old entries into segments that log_query can still read
+  runTest();
+  try {
+    const prdDir = join(tempDir, 'PRD-rotate');
+    mkdirSync(prdDir, { recursive: true });
+    const events = Array.from({ length: 50 }, (_, i) => `[2026-01-${String(10 + (i % 5)).padStart(2, '0')} 10:00:${String(i).padStart(2, '0')}] event ${i}`);
+    writeFileSync(join(prdDir, 'activity.log'), `# Activity Log\n\n## Run Summary\n- 2026-01-14 11:00:00 | run=1 | status=success\n\n## Events\n\n${events.join('\n')}\n`);
+    const rotated = JSON.parse(spawnSync('python3', [prdParser, 'rotate_logs', prdDir, '--max-bytes', '100'], { encoding: 'utf8' }).stdout);
+    writeFileSync(join(prdDir, 'activity.log'), readFileSync(join(prdDir, 'activity.log'), 'utf8') + '[2026-01-15 09:00:00] live event\n');
+    const query = spawnSync('python3', [prdParser, 'log_query', prdDir, 'activity.log', '--since', '2026-01-14'], { encoding: 'utf8' }).stdout;
+    const live = readFileSync(join(prdDir, 'activity.log'), 'utf8');
+    const lines = query.trim().split('\n');
+    if (rotated.rotated[0].entries === 50 && live.includes('- 2026-01-14 11:00:00') && !live.includes('event 0') &&
+        lines.length === 12 && lines[lines.length - 1].includes('live event')) {
+      pass('prd-parser.py rotate_logs archives entries queryable by time range');
+    } else {
+      fail('prd-parser.py log rotation returned unexpected results', query.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py log rotation error', e.message);
+  }
+
+  // Test: rotate_logs waits for the log's writer lock and keeps a line appended under it
+  runTest();
+  try {
+    const prdDir = join(tempDir, 'PRD-rotate-lock');
+    mkdirSync(prdDir, { recursive: true });
+    const events = Array.from({ length: 20 }, (_, i) => `[2026-01-10 10:00:${String(i).padStart(2, '0')}] event ${i}`);
+    writeFileSync(join(prdDir, 'errors.log'), `# Errors\n\n${events.join('\n')}\n`);
+    const script = [
+      'log="$2/errors.log"',
+      'mkdir "$log.lock" && printf \'{"pid":%d,"timestamp":%d000}\' $$ "$(date +%s)" > "$log.lock/pid"',
+      'python3 "$1" rotate_logs "$2" --max-bytes 100 > "$2/rotated.json" &',
+      'sleep 0.5',
+      'echo "[2026-01-11 09:00:00] appended under lock" >> "$log"',
+      'rm -rf "$log.lock"',
+      'wait',
+    ].join('\n');
+    spawnSync('bash', ['-c', script, '_', prdParser, prdDir]);
+    const rotated = JSON.parse(readFileSync(join(prdDir, 'rotated.json'), 'utf8'));
+    const index = JSON.parse(readFileSync(join(prdDir, 'logs', 'index.json'), 'utf8'));
+    const query = spawnSync('python3', [prdParser, 'log_query', prdDir, 'errors.log'], { encoding: 'utf8' }).stdout;
+    if (rotated.rotated[0].entries === 21 && index.segments.length === 1 && query.includes('appended under lock') &&
+        !existsSync(join(prdDir, 'errors.log.lock'))) {
+      pass('prd-parser.py rotate_logs honours the writer lock');
+    } else {
+      fail('prd-parser.py rotate_logs lost a locked append', query.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py locked rotation error', e.message);
+  }
+
+  // Test: progress counts acceptance criteria outside code fences from the cached AST
+  runTest();
+  try {
+    const prdFile = join(tempDir, 'prd-progress.md');
+    const prdText = '# PRD\n\n### [x] US-001: Done\n- [x] a\n- [x] b\n```\n- [ ] fenced\n### [ ] US-009: Fenced\n```\n\n' +
+      '### [ ] US-002: Open\n#### Acceptance Criteria\n- [x] c\n- [ ] d\n\n## Non-goals\n- [ ] not a criterion\n';
+    writeFileSync(prdFile, prdText);
+    const first = JSON.parse(spawnSync('python3', [prdParser, 'progress', prdFile], { encoding: 'utf8' }).stdout);
+    writeFileSync(prdFile, prdText.replace('- [ ] d', '- [x] d'));
+    const second = JSON.parse(spawnSync('python3', [prdParser, 'progress', prdFile], { encoding: 'utf8' }).stdout);
+    const ast = JSON.parse(spawnSync('python3', [prdParser, 'prd_ast', prdFile], { encoding: 'utf8' }).stdout);
+    const criterion = ast.stories[1].criteria[1];
+    if (first.total === 2 && first.criteria_total === 4 && first.criteria_done === 3 && first.fraction === 0.75 &&
+        second.stories[1].fraction === 1 && existsSync(join(tempDir, '.prd-progress.prd-ast.json')) &&
+        readFileSync(prdFile, 'utf8')[criterion.offset] === 'x' && ast.sections[1].title === 'Non-goals') {
+      pass('prd-parser.py progress reports criteria completion from the PRD AST');
+    } else {
+      fail('prd-parser.py progress returned unexpected fractions', JSON.stringify([first, second.stories]));
+    }
+  } catch (e) {
+    fail('prd-parser.py progress error', e.message);
+  }
+
+  // Test: concurrent complete_story calls each flip one checkbox byte and keep the index current
+  runTest();
+  try {
+    const prdFile = join(tempDir, 'prd-complete.md');
+    const prdText = '# PRD\n\n' + [1, 2, 3, 4, 5].map((i) => `### [ ] US-00${i}: Story ${i}\n- [ ] criterion\n`).join('\n');
+    writeFileSync(prdFile, prdText);
+    spawnSync('python3', [prdParser, 'select_story', prdFile, join(tempDir, 'c-meta.json'), join(tempDir, 'c-block.md')]);
+    spawnSync('bash', ['-c', `for i in 1 2 3 4; do python3 "$0" complete_story "$1" US-00$i & done; wait`, prdParser, prdFile]);
+    const missing = spawnSync('python3', [prdParser, 'complete_story', prdFile, 'US-042'], { encoding: 'utf8' });
+    spawnSync('python3', [prdParser, 'select_story', prdFile, join(tempDir, 'c-meta.json'), join(tempDir, 'c-block.md')]);
+    const meta = JSON.parse(readFileSync(join(tempDir, 'c-meta.json'), 'utf8'));
+    const expected = prdText.replace(/### \[ \] US-00([1-4])/g, '### [x] US-00$1');
+    if (readFileSync(prdFile, 'utf8') === expected && meta.remaining === 1 && meta.id === 'US-005' &&
+        missing.status === 1 && missing.stderr.includes('US-042')) {
+      pass('prd-parser.py complete_story patches checkboxes in place under a lock');
+    } else {
+      fail('prd-parser.py complete_story left unexpected state', JSON.stringify(meta));
+    }
+  } catch (e) {
+    fail('prd-parser.py complete_story error', e.message);
+  }
+
+  // Test: query streams matching stories from the cached indexes as NDJSON
+  runTest();
+  try {
+    const ralphDir = join(tempDir, 'query-ralph');
+    mkdirSync(join(ralphDir, 'PRD-1'), { recursive: true });
+    mkdirSync(join(ralphDir, 'PRD-2'), { recursive: true });
+    writeFileSync(join(ralphDir, 'PRD-1', 'prd.md'),
+      '# PRD\n\n### [x] US-001: Login page\n\n### [ ] US-002: Logout\nDepends on: US-001\n\n### [ ] US-003: Profile\n');
+    writeFileSync(join(ralphDir, 'PRD-2', 'prd.md'), '# PRD\n\n### [ ] US-040: Login API\n\n### [x] US-041: Search\n');
+    const rows = (args) => spawnSync('python3', [prdParser, 'query', '--ralph-dir', ralphDir, ...args], { encoding: 'utf8' })
+      .stdout.trim().split('\n').filter(Boolean).map((line) => JSON.parse(line));
+    const open = rows(['--status', 'open', '--title', 'login']);
+    const ranged = rows(['--ids', 'US-002..US-040', '--prd', '1']);
+    const deps = rows(['--has-deps', 'yes']);
+    const bad = spawnSync('python3', [prdParser, 'query', '--ralph-dir', ralphDir, '--ids', 'x'], { encoding: 'utf8' });
+    if (rows([]).length === 5 && open.length === 1 && open[0].id === 'US-040' && open[0].prd === 'PRD-2' &&
+        ranged.map((r) => r.id).join() === 'US-002,US-003' && deps.length === 1 && deps[0].deps[0] === 'US-001' &&
+        bad.status !== 0) {
+      pass('prd-parser.py query filters stories by status, id range, title, deps and PRD');
+    } else {
+      fail('prd-parser.py query returned unexpected rows', JSON.stringify([open, ranged, deps]));
+    }
+  } catch (e) {
+    fail('prd-parser.py query error', e.message);
+  }
+
+  // Test: watch publishes status flips and added stories as NDJSON (inotify and polling)
+  runTest();
+  try {
+    const ralphDir = join(tempDir, 'watch-ralph');
+    const prdFile = join(ralphDir, 'PRD-1', 'prd.md');
+    const prdText = '# PRD\n\n### [ ] US-001: First\n\n### [ ] US-002: Second\n';
+    mkdirSync(join(ralphDir, 'PRD-1'), { recursive: true });
+    const script = 'timeout 20 python3 "$0" watch --ralph-dir "$1" --socket - --max-events 4 $3 | ' +
+      '{ read -r ready; echo "$ready"; sleep 0.3; sed -i "s/### \\[ \\] US-001/### [x] US-001/" "$2"; ' +
+      'sleep 0.3; printf "\\n### [ ] US-003: Third\\n" >> "$2"; cat; }';
+    const runs = ['', '--poll --interval 0.1'].map((mode) => {
+      writeFileSync(prdFile, prdText);
+      const out = spawnSync('bash', ['-c', script, prdParser, ralphDir, prdFile, mode], { encoding: 'utf8' });
+      return out.stdout.trim().split('\n').map((line) => JSON.parse(line));
+    });
+    const ok = runs.every((events) => events.length === 5 && events[0].event === 'ready' &&
+      events[0].prds[0].remaining === 2 &&
+      events[1].event === 'status_changed' && events[1].id === 'US-001' && events[1].done === true &&
+      events[2].event === 'prd_updated' && events[2].remaining === 1 &&
+      events.some((e) => e.event === 'story_added' && e.id === 'US-003'));
+    if (ok) {
+      pass('prd-parser.py watch publishes story changes with inotify and stat polling');
+    } else {
+      fail('prd-parser.py watch published unexpected events', JSON.stringify(runs));
+    }
+  } catch (e) {
+    fail('prd-parser.py watch error', e.message);
+  }
+
+  // Test: RALPH_PROFILE appends one timing record per command to the PRD folder
+  runTest();
+  try {
+    const prdDir = join(tempDir, 'PRD-9');
+    mkdirSync(prdDir, { recursive: true });
+    writeFileSync(join(prdDir, 'prd.md'), '# PRD\n\n### [ ] US-001: Profiled\nBody\n');
+    const env = { ...process.env, RALPH_PROFILE: '1' };
+    for (let i = 0; i < 2; i++) {
+      spawnSync('python3', [prdParser, 'select_story', join(prdDir, 'prd.md'), join(tempDir, 'prof-meta.json'), join(tempDir, 'prof-block.md')], { env });
+    }
+    const records = readFileSync(join(prdDir, '.profile.jsonl'), 'utf8').trim().split('\n').map((l) => JSON.parse(l));
+    const report = JSON.parse(spawnSync('python3', [prdParser, 'profile_report', prdDir], { encoding: 'utf8' }).stdout);
+    if (records.length === 2 && records[0].command === 'select_story' && 'import' in records[0].spans &&
+        records[0].bytes_read > 0 && records[0].max_rss_kb > 0 && report.commands[0].count === 2 &&
+        'p95' in report.commands[0].spans.write) {
+      pass('prd-parser.py RALPH_PROFILE records spans and reports percentiles');
+    } else {
+      fail('prd-parser.py profile records or report mismatch', JSON.stringify(records[0]));
+    }
+  } catch (e) {
+    fail('prd-parser.py profiling error', e.message);
+  }
+
+  // Test: serve mode answers line-delimited JSON-RPC requests on stdin
+  runTest();
+  try {
+    const requests = [
+      { id: 1, method: 'story_field', params: [metaOut, 'id'] },
+      { id: 2, method: 'no_such_command', params: [] },
+      { id: 3, method: 'story_field', params: [metaOut, 'id', 'extra'] },
+    ].map((r) => JSON.stringify(r)).join('\n') + '\n';
+    const result = spawnSync('python3', [prdParser, 'serve'], { input: requests, encoding: 'utf8' });
+    const responses = result.stdout.trim().split('\n').map((l) => JSON.parse(l));
+    if (responses.length === 3 && responses[0].result.output.trim() === 'US-001' && responses[1].error
+      && responses[2].error.code === -32602 && responses[2].error.message.startsWith('Usage: story_field')) {
+      pass('prd-parser.py serve answers requests over stdio');
+    } else {
+      fail('prd-parser.py serve returned unexpected responses', result.stdout.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-parser.py serve error', e.message);
+  }
+
+  // Test: prd-helper.sh decodes frames without jq, falls back in subshells and escapes control characters
+  runTest();
+  try {
+    const script = [
+      `source "${join(LIB_DIR, 'prd-helper.sh')}"`,
+      'prd_helper_start',
+      `echo "call:$(prd_helper_call story_field "${metaOut}" id)"`,
+      `( echo "subshell:$(prd_helper_call story_field "${metaOut}" id)" )`,
+      `prd_helper_call story_field "${metaOut}" id | sed 's/^/pipe:/'`,
+      'prd_helper_call batch - </dev/null 2>&1 || echo "batch:rejected"',
+      `echo "escape:$(prd_helper_json_escape $'a\\x01b\\x1f')"`,
+      'prd_helper_stop',
+    ].join('\n');
+    const result = spawnSync('bash', ['-c', script], { encoding: 'utf8' });
+    const out = result.stdout;
+    if (
+      out.includes('call:US-001') &&
+      out.includes('subshell:US-001') &&
+      out.includes('pipe:US-001') &&
+      out.includes('batch:rejected') &&
+      out.includes('escape:a\\u0001b\\u001f') &&
+      !result.stderr.includes('Bad file descriptor')
+    ) {
+      pass('prd-helper.sh serves frames, falls back outside the coproc and escapes control characters');
+    } else {
+      fail('prd-helper.sh returned unexpected output', out.substring(0, 300) + result.stderr.substring(0, 200));
+    }
+  } catch (e) {
+    fail('prd-helper.sh error', e.message);
+  }
+
   // Cleanup
   rmSync(tempDir, { recursive: true, force: true });
 }
@@ -151,7 +858,7 @@ function testRunMetaWriter() {
   // Test: Script exists and compiles
   runTest();
   try {
-    const result = spawnSync('python3', ['-m', 'py_compile', metaWriter], { encoding: 'utf8' });
+    const result = spawnSync('python3', ['-m', 'py_compile', join(LIB_DIR, 'run_meta_writer.py')], { encoding: 'utf8' });
     if (result.status === 0) {
       pass('run-meta-writer.py compiles without error');
     } else {
@@ -223,6 +930,139 @@ function testRunMetaWriter() {
     fail('run-meta-writer.py section check error', e.message);
   }
 
+  // Test: finalize renders the actual cost and prints shell assignments
+  runTest();
+  try {
+    const configFile = join(tempDir, 'config.sh');
+    const finalOutput = join(tempDir, 'final.md');
+    writeFileSync(configFile, 'CLAUDE_OPUS_INPUT=10.00\n');
+    const run = { ...jsonInput, input_tokens: '1000000', output_tokens: '1000', token_model: 'opus', story_title: "It's done" };
+    const result = spawnSync('python3', [metaWriter, 'finalize', finalOutput, '--config', configFile],
+      { input: JSON.stringify(run), encoding: 'utf8' });
+    const vars = spawnSync('bash', ['-c', 'eval "$1"; echo "$input_tokens|$token_model|$routed_model|$actual_cost"', '_', result.stdout],
+      { encoding: 'utf8' }).stdout.trim();
+    const content = readFileSync(finalOutput, 'utf8');
+    if (result.status === 0 && vars === '1000000|opus||10.075' &&
+        content.includes('- Actual tokens: 1001000 (input: 1000000, output: 1000)\n- Actual cost: $10.075\n')) {
+      pass('run-meta-writer.py finalize writes the actual cost and shell assignments');
+    } else {
+      fail('run-meta-writer.py finalize returned unexpected output', `${vars} ${result.stderr}`);
+    }
+  } catch (e) {
+    fail('run-meta-writer.py finalize error', e.message);
+  }
+
+  // Test: each summary is upserted into the PRD's runs.db with typed columns
+  runTest();
+  try {
+    const runsDir = join(tempDir, 'PRD-1', 'runs');
+    mkdirSync(runsDir, { recursive: true });
+    const summary = join(runsDir, 'run-test-123-iter-1.md');
+    const run = { ...jsonInput, status: 'error', est_tokens: '1200', complexity_score: 'n/a' };
+    spawnSync('python3', [metaWriter, 'finalize', summary], { input: JSON.stringify(run), encoding: 'utf8' });
+    spawnSync('python3', [metaWriter, 'finalize', summary], { input: JSON.stringify({ ...run, status: 'success' }), encoding: 'utf8' });
+    const query = 'import json, sqlite3, sys; c = sqlite3.connect(sys.argv[1]); ' +
+      'print(json.dumps([c.execute("pragma journal_mode").fetchone()[0], c.execute("select count(*), status, total_tokens, ' +
+      'token_variance_pct, complexity_score, summary_path from runs").fetchone()]))';
+    const out = spawnSync('python3', ['-c', query, join(tempDir, 'PRD-1', 'runs.db')], { encoding: 'utf8' });
+    const [mode, row] = JSON.parse(out.stdout);
+    if (mode === 'wal' && JSON.stringify(row) === JSON.stringify([1, 'success', 1500, 25.0, null, 'runs/run-test-123-iter-1.md'])) {
+      pass('run-meta-writer.py upserts runs into the PRD runs.db');
+    } else {
+      fail('run-meta-writer.py run store has unexpected rows', out.stdout + out.stderr);
+    }
+  } catch (e) {
+    fail('run-meta-writer.py run store error', e.message);
+  }
+
+  // Test: backfill re-renders summaries from JSON or parsed markdown, writes only changes and resumes
+  runTest();
+  try {
+    const ralphDir = join(tempDir, 'backfill-ralph');
+    const runsDir = join(ralphDir, 'PRD-2', 'runs');
+    mkdirSync(runsDir, { recursive: true });
+    const fromJson = join(runsDir, 'run-b-iter-1.md');
+    const fromMarkdown = join(runsDir, 'run-b-iter-2.md');
+    writeFileSync(join(runsDir, 'run-b-iter-1.json'), JSON.stringify(jsonInput));
+    spawnSync('python3', [metaWriter, 'finalize', fromMarkdown],
+      { input: JSON.stringify({ ...jsonInput, iteration: '2', est_cost: '0.5', est_tokens: '1000' }), encoding: 'utf8' });
+    rmSync(join(runsDir, 'run-b-iter-2.json'));
+    // An older summary without the variance, with a context section appended by loop.sh
+    const rendered = readFileSync(fromMarkdown, 'utf8');
+    writeFileSync(fromMarkdown, rendered.replace(/- Token variance: .*/, '- (variance not available)') + '\n## Context\nkept\n\n');
+    const backfill = (args) => JSON.parse(spawnSync('python3', [metaWriter, 'backfill', ralphDir, ...args], { encoding: 'utf8' }).stdout);
+    const first = backfill(['--workers', '2']);
+    const second = backfill([]);
+    writeFileSync(join(ralphDir, '.backfill-journal'), fromJson + '\n');
+    const resumed = backfill([]);
+    const content = readFileSync(fromMarkdown, 'utf8');
+    if (first.rewritten === 2 && second.unchanged === 2 && second.rewritten === 0 && resumed.resumed === 1 &&
+        content === rendered + '\n## Context\nkept\n\n' && readFileSync(fromJson, 'utf8').includes('- Run ID: test-123') &&
+        !existsSync(join(ralphDir, '.backfill-journal'))) {
+      pass('run-meta-writer.py backfill re-renders changed summaries and resumes from its journal');
+    } else {
+      fail('run-meta-writer.py backfill returned unexpected results', JSON.stringify([first, second, resumed]));
+    }
+  } catch (e) {
+    fail('run-meta-writer.py backfill error', e.message);
+  }
+
+  // Test: concurrent writers creating the rollups count each run once
+  runTest();
+  try {
+    const ralphDir = join(tempDir, 'rollup-race');
+    mkdirSync(join(ralphDir, 'PRD-1', 'runs'), { recursive: true });
+    const script = [
+      'for i in $(seq 1 12); do',
+      '  echo \'{"status":"success","input_tokens":"10"}\' | python3 "$1" finalize "$2/PRD-1/runs/run-r-iter-$i.md" >/dev/null &',
+      'done',
+      'wait',
+    ].join('\n');
+    spawnSync('bash', ['-c', script, '_', metaWriter, ralphDir], { encoding: 'utf8' });
+    const prdRuns = JSON.parse(readFileSync(join(ralphDir, 'PRD-1', '.rollup.json'), 'utf8')).runs;
+    const globalRuns = JSON.parse(readFileSync(join(ralphDir, '.rollup.json'), 'utf8')).runs;
+    if (prdRuns === 12 && globalRuns === 12) {
+      pass('run-meta-writer.py concurrent writers do not double count rebuilt rollups');
+    } else {
+      fail('run-meta-writer.py concurrent rollup counts unexpected', `${prdRuns} ${globalRuns}`);
+    }
+  } catch (e) {
+    fail('run-meta-writer.py concurrent rollup error', e.message);
+  }
+
+  // Test: PRD and global rollups track rewrites incrementally and match a rebuild
+  runTest();
+  try {
+    const ralphDir = join(tempDir, 'rollup-ralph');
+    const run = (prd, name, fields) => {
+      mkdirSync(join(ralphDir, prd, 'runs'), { recursive: true });
+      spawnSync('python3', [metaWriter, 'finalize', join(ralphDir, prd, 'runs', name)],
+        { input: JSON.stringify({ token_model: 'sonnet', agent: 'claude', output_tokens: '100', est_tokens: '1000', ...fields }), encoding: 'utf8' });
+    };
+    run('PRD-1', 'run-a-iter-1.md', { status: 'success', input_tokens: '1000' });
+    run('PRD-1', 'run-a-iter-2.md', { status: 'success', input_tokens: '2000', retry_count: '2' });
+    run('PRD-2', 'run-b-iter-1.md', { status: 'error', input_tokens: '3000', agent: 'codex', switch_count: '1' });
+    run('PRD-1', 'run-a-iter-2.md', { status: 'error', input_tokens: '2000', retry_count: '2' });
+    const rollup = (args) => JSON.parse(spawnSync('python3', [metaWriter, 'rollup', ...args], { encoding: 'utf8' }).stdout);
+    const global = rollup([ralphDir]);
+    const rebuilt = rollup([ralphDir, '--rebuild']);
+    const prd = rollup([join(ralphDir, 'PRD-1')]);
+    run('PRD-2', 'run-b-iter-1.md', { status: 'success', input_tokens: '3000', agent: 'codex', switch_count: '1' });
+    const flipped = rollup([join(ralphDir, 'PRD-2')]);
+    const flippedRebuilt = rollup([join(ralphDir, 'PRD-2'), '--rebuild']);
+    if (flipped.by_status.error === 0 && !('error' in flippedRebuilt.by_status) && flippedRebuilt.by_status.success === 1 &&
+        global.runs === 3 && global.by_status.error === 2 && global.by_agent.codex.runs === 1 &&
+        global.input_tokens === 6000 && global.retry_count === 2 && global.switch_count === 1 &&
+        global.estimate_error.n === 3 && global.estimate_error.mean_pct === 110 && global.estimate_error.variance === 10000 &&
+        JSON.stringify(global) === JSON.stringify(rebuilt) && prd.runs === 2 && prd.by_status.error === 1) {
+      pass('run-meta-writer.py maintains PRD and global rollups incrementally');
+    } else {
+      fail('run-meta-writer.py rollup returned unexpected totals', JSON.stringify([global, prd]));
+    }
+  } catch (e) {
+    fail('run-meta-writer.py rollup error', e.message);
+  }
+
   // Cleanup
   rmSync(tempDir, { recursive: true, force: true });
 }
@@ -477,20 +477,28 @@ test_python_syntax() {
   echo ""
   echo "Testing Python libraries syntax..."
 
-  # Test: prd-parser.py compiles
+  # Test: prd_parser.py compiles
   run_test
-  if python3 -m py_compile "$LIB_DIR/prd-parser.py" 2>/dev/null; then
-    pass "prd-parser.py syntax valid"
+  if python3 -m py_compile "$LIB_DIR/prd_parser.py" 2>/dev/null; then
+    pass "prd_parser.py syntax valid"
   else
-    fail "prd-parser.py has syntax errors"
+    fail "prd_parser.py has syntax errors"
   fi
 
-  # Test: run-meta-writer.py compiles
+  # Test: run_meta_writer.py compiles
   run_test
-  if python3 -m py_compile "$LIB_DIR/run-meta-writer.py" 2>/dev/null; then
-    pass "run-meta-writer.py syntax valid"
+  if python3 -m py_compile "$LIB_DIR/run_meta_writer.py" 2>/dev/null; then
+    pass "run_meta_writer.py syntax valid"
   else
-    fail "run-meta-writer.py has syntax errors"
+    fail "run_meta_writer.py has syntax errors"
+  fi
+
+  # Test: ralph_profile.py compiles
+  run_test
+  if python3 -m py_compile "$LIB_DIR/ralph_profile.py" 2>/dev/null; then
+    pass "ralph_profile.py syntax valid"
+  else
+    fail "ralph_profile.py has syntax errors"
   fi
 }
 